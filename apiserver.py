@@ -1,74 +1,810 @@
-import json
+import asyncio
+import collections
+import ipaddress
+import os
 import pyglet
+import reprlib
 import socket
-import socketserver
 import threading
+import time
 
+import apitrace
+import campaign
+import framing
+import netsim
+import reliable
+import sendqueue
+import sessions
+import stream
 from ui import event
+import wire
 
 PORT = 2214
 CLIENT_PORT = 2216
+# Interval between the checks for retransmissions and pending
+# acknowledgements.
+TICK = 0.02
+# How often the received messages are dispatched in the main thread, and how
+# much time can be spent on them.
+DRAIN_INTERVAL = 1 / 120
+DRAIN_BUDGET = 0.004
 
 
-class ApiServerImpl(socketserver.UDPServer):
-    address_family = socket.AF_INET6
+def normalize_address(address):
+    """Returns the canonical (host, port) form of an IPv6 socket address."""
+    host = ipaddress.ip_address(address[0]).compressed
+    return host, address[1]
 
-    def __init__(self, event_dispatcher, is_master, port):
-        self.platform_event_loop = pyglet.app.platform_event_loop
-        self.platform_event_loop.start()
-        self.event_dispatcher = event_dispatcher
-        if port is None:
-            port = PORT if is_master else CLIENT_PORT
-        super().__init__(('::', port), None)
 
-    def finish_request(self, request, client_address):
-        self.platform_event_loop.post_event(
-            self.event_dispatcher, 'on_api_request_raw', request, client_address)
+MAX_CHAT_LENGTH = 4096
 
 
-class ApiServer(threading.Thread, event.EventDispatcher):
-    def __init__(self,master=None, port=None):
-        self.server = ApiServerImpl(
-            self, is_master=(master is None), port=port)
-        if type(master) is str:
-            master = (master, PORT)
+def _is_seq(value):
+    return type(value) is int and value >= 0
+
+
+def _is_id(value):
+    return type(value) in (int, str)
+
+
+def _is_patch(params):
+    return (params.get('entity') in campaign.ENTITIES and
+            (params.get('id') is None or _is_id(params['id'])) and
+            type(params.get('set', {})) is dict and
+            type(params.get('unset', [])) is list and
+            all(type(name) is str for name in params.get('unset', [])))
+
+
+def _valid_chat(params):
+    message = params.get('message')
+    return (type(message) is dict and
+            type(message.get('text')) is str and
+            len(message['text']) <= MAX_CHAT_LENGTH)
+
+
+# Checks of the parameters of the messages, by method.
+PARAMS_SCHEMAS = {
+    'hi': lambda p: (
+        type(p.get('player')) is str and
+        type(p.get('session', '')) is str and
+        type(p.get('wire', [])) is list and
+        all(type(v) is int for v in p.get('wire', [])) and
+        type(p.get('spectator', False)) is bool and
+        _is_seq(p.get('relay', 0)) and type(p.get('lost', False)) is bool),
+    'ping': lambda p: type(p.get('t')) in (int, float),
+    'pong': lambda p: type(p.get('t')) in (int, float),
+    'token_temp_position_changed': lambda p: (
+        _is_id(p.get('token_id')) and
+        campaign.is_position(p.get('position')) and
+        ('t' not in p or
+         (type(p['t']) is int and 0 <= p['t'] < 2**32))),
+    'update_token': lambda p: (
+        type(p.get('token')) is dict and _is_id(p['token'].get('id')) and
+        campaign.is_position(p['token'].get('position')) and
+        (p.get('op') is None or _is_seq(p['op']))),
+    'patch': lambda p: (
+        _is_patch(p) and (p.get('op') is None or _is_seq(p['op']))),
+    'patch_rejected': lambda p: _is_patch(p) and _is_seq(p.get('op')),
+    'patch_batch': lambda p: (
+        type(p.get('patches')) is list and
+        all(type(patch) is dict and _is_patch(patch)
+            for patch in p['patches'])),
+    'player_chat': _valid_chat,
+    'new_chat': _valid_chat,
+    'sync': lambda p: p.get('since') is None or _is_seq(p['since']),
+    'veils_resync': lambda p: _is_seq(p.get('page_id')),
+    'relay_parent': lambda p: (
+        type(p.get('parent')) is list and len(p['parent']) == 2 and
+        type(p['parent'][0]) is str and _is_seq(p['parent'][1])),
+    'relay_left': lambda p: type(p.get('player')) is str,
+}
+
+
+def validate(message) -> bool:
+    """Checks the structure of a decoded message."""
+    if (type(message) is not dict or
+        type(message.get('method')) is not str or
+        type(message.get('params', {})) is not dict):
+        return False
+    if 'seq' in message and not _is_seq(message['seq']):
+        return False
+    if 'ack' in message and not _is_seq(message['ack']):
+        return False
+    if 'sack' in message and not (type(message['sack']) is list and
+                                  all(_is_seq(s) for s in message['sack'])):
+        return False
+    if 'version' in message and not _is_seq(message['version']):
+        return False
+    if 'prev' in message and not (message['prev'] is None or
+                                  _is_seq(message['prev'])):
+        return False
+    check = PARAMS_SCHEMAS.get(message['method'])
+    return check is None or check(message.get('params', {}))
+
+
+class ApiProtocol(asyncio.DatagramProtocol):
+    """Receives the datagrams in the network thread."""
+
+    def __init__(self, api_server):
+        self.api_server = api_server
+
+    def datagram_received(self, data, address):
+        self.api_server._datagram_received(data, address)
+
+    def error_received(self, exc):
+        print('ApiServer error:', exc)
+
+
+class ApiEndpoint(event.EventDispatcher):
+    """The sessions of the API peers and the routing of the messages to them.
+
+    The subclasses pass the messages on to a transport in `_queue()`:
+    `ApiServer` sends them over the network, and `replay.ReplayApiServer`
+    only counts them.
+    """
+
+    def __init__(self, master=None, recorder=None, relay_fanout=0,
+                 pacing_rate=sendqueue.PACING_RATE, use_stream=False):
+        """Creates the sessions.
+
+        Args:
+            master: the address of the master, if this is a player's instance.
+            recorder: `apitrace.TraceRecorder` that records the messages.
+            relay_fanout: the number of spectators that a player's instance
+              can relay to.
+            pacing_rate: the limit of the outgoing traffic to each peer, in
+              bytes per second, or None.
+            use_stream: whether the session with the master is over a stream.
+        """
         self.master = master
-        self.players = set()
-        super().__init__()
-        self.start()
+        self.relay_fanout = relay_fanout
+        self.recorder = recorder
+        self.use_stream = use_stream and master is not None
+        # The sessions are shared between the network thread and the main
+        # thread, and are guarded by the lock.
+        self._lock = threading.Lock()
+        self.sessions = sessions.SessionTable(pacing_rate=pacing_rate)
+        if master is not None:
+            self.sessions.connect(None, master, stream=self.use_stream)
 
-    def run(self):
-        print('Starting ApiServer on port', PORT)
-        self.server.serve_forever()
-        print('Stopped ApiServer')
-        self.server.server_close()
+    @property
+    def is_master(self):
+        return self.master is None
 
-    def shutdown(self):
-        self.server.shutdown()
+    def _children(self) -> list:
+        """Returns the sessions of the spectators that this peer relays to."""
+        return [session for session in self.sessions
+                if session.address != self.master]
+
+    def _adopts(self, address, params) -> bool:
+        """Checks whether a relay accepts the `hi` of a spectator."""
+        if (self.is_master or address == self.master or
+            not params.get('spectator')):
+            return False
+        return (self.sessions.get(address) is not None or
+                len(self._children()) < self.relay_fanout)
+
+    def _open_session(self, request, address, stream=False):
+        """Returns the session of the peer, opening it on `hi`.
+
+        Called with the lock held.
+
+        Args:
+            request: the received message.
+            address: the address of the peer.
+            stream: whether the message came over the stream transport.
+        """
+        session = self.sessions.get(address)
+        if session is not None and session.stream != stream:
+            # Another peer with the same address on the other transport.
+            session = None
+        params = request.get('params', {})
+        if request['method'] == 'hi' and (self.is_master or
+                                          self._adopts(address, params)):
+            if (session is None or session.id != params.get('session') or
+                session.player != params['player']):
+                session = self.sessions.connect(
+                    params['player'], address, params.get('session'),
+                    stream=stream)
+                session.spectator = bool(params.get('spectator'))
+        return session
+
+    def drop(self, address, reason):
+        """Counts a rejected message of the peer."""
+        print('Dropping a request from', address, reason)
+        with self._lock:
+            session = self.sessions.get(address)
+            if session is not None:
+                session.dropped += 1
+
+    def set_wire_version(self, address, version):
+        session = self.sessions.get(address)
+        if session is not None:
+            session.wire_version = version
+
+    def _record(self, direction, address, request):
+        if self.recorder is not None:
+            self.recorder.record(direction, address, request)
+
+    def _send_to_session(self, request, session, data=None):
+        """Queues a message for the session.
+
+        Args:
+            request: the message.
+            session: the session of the recipient.
+            data: the message, already encoded with the wire version of the
+              session.
+        """
+        if 'version' in request:
+            # Let the player know which version it should have before
+            # applying this change. Changes of the pages that the player
+            # doesn't view are not sent, so the versions are not consecutive.
+            request = dict(request, prev=session.version_sent)
+            session.version_sent = request['version']
+        self._record(apitrace.OUT, session.address, request)
+        self._queue(request, session, data)
 
-    def on_api_request_raw(self, request, client_address):
-        self.players.add(client_address)
-        request = json.loads(request[0])
-        self.dispatch_event('on_api_request', request, client_address)
+    def _queue(self, request, session, data):
+        """Passes a message on to the transport.
+
+        Args:
+            request: the message, with `prev` if it is versioned.
+            session: the session of the recipient.
+            data: the encoded message, or None.
+        """
+        raise NotImplementedError
 
     def send(self, request, address=None):
         if address is None: address = self.master
         assert address is not None
-        request = json.dumps(request).encode('utf-8')
-        self.server.socket.sendto(request, address)
+        with self._lock:
+            session = self.sessions.get(address)
+            if session is None:
+                print('Not sending to a closed session', address)
+                return
+            self._send_to_session(request, session)
+
+    def resend(self, address, since, changes):
+        """Sends the changes that a player has missed.
+
+        Args:
+            address: the address of the player.
+            since: the version of the campaign that the player has.
+            changes: list of pairs (notification, page).
+        """
+        with self._lock:
+            session = self.sessions.get(address)
+            if session is None:
+                return
+            session.version_sent = since
+            for request, page in changes:
+                if (page is None or session.page is None or
+                    session.page == page):
+                    self._send_to_session(request, session)
+                else:
+                    session.stale_pages.add(page)
+
+    def set_player_page(self, address, page) -> bool:
+        """Records the page that the player is viewing.
+
+        Returns True if the page has been changed since the player has viewed
+        it, and has to be resent to the player.
+        """
+        session = self.sessions.get(address)
+        if session is None:
+            return False
+        session.page = page
+        if page in session.stale_pages:
+            session.stale_pages.remove(page)
+            return True
+        return False
+
+    def release(self, address):
+        """Closes a session once everything sent to it is acknowledged.
 
-    def add_player(self, address):
-        self.players.add(address)
+        Used for the spectators that the master has moved to a relay. They
+        get no notifications in the meantime.
+        """
+        with self._lock:
+            session = self.sessions.get(address)
+            if session is not None:
+                session.released = True
 
-    def notify(self, request):
-        request = json.dumps(request).encode('utf-8')
-        if self.master is not None:
+    def forward(self, request):
+        """Passes a message from the master on to the relayed spectators.
+
+        They view the same page as this player, so all the messages that the
+        player receives concern them too.
+        """
+        with self._lock:
+            for session in self._children():
+                self._send_to_session(request, session)
+
+    def _interested(self, page):
+        """Returns the sessions that have to be notified about the page."""
+        interested = []
+        for session in self.sessions:
+            if session.released:
+                continue
+            if page is None or session.page is None or session.page == page:
+                interested.append(session)
+            else:
+                session.stale_pages.add(page)
+        return interested
+
+    def notify(self, request, page=None):
+        """Sends a notification to the master or to the players.
+
+        Args:
+            request: the notification.
+            page: the page that the notification is about. Players viewing
+              other pages don't receive it.
+        """
+        if not self.is_master:
             print('notify master', request)
-            self.server.socket.sendto(request, self.master)
+            self.send(request)
+            return
+        with self._lock:
+            if reliable.is_reliable(request):
+                for session in self._interested(page):
+                    print('notify', session.player, request)
+                    self._send_to_session(request, session)
+                return
+            # Unreliable messages are the same for all the peers, so they
+            # only have to be encoded once for each wire version.
+            encoded = {}
+            for session in self._interested(page):
+                version = session.wire_version
+                if version not in encoded:
+                    encoded[version] = wire.encode(request, version)
+                self._send_to_session(request, session, encoded[version])
+
+ApiEndpoint.register_event_type('on_api_request')
+ApiEndpoint.register_event_type('on_session_closed')
+
+
+class ApiServer(ApiEndpoint):
+    """The endpoint of the API, over UDP or, optionally, over TCP.
+
+    The master accepts the players over both transports, and every session
+    stays on the transport that its `hi` came over.
+
+    The datagrams are decoded, validated and ordered in the network thread.
+    The resulting messages are queued, and the queue is drained in the main
+    thread, once per frame and with a time budget. Within a drained batch,
+    only the latest temporary position of each token is dispatched.
+
+    The master limits the rate of the messages of every player, per method,
+    and drops the messages that don't pass `validate()`.
+
+    The outgoing messages are queued per peer by priority and paced with a
+    token bucket, see `sendqueue`.
+
+    The master only accepts messages from the players that have opened a
+    session with `hi`. The sessions that don't send anything, not even
+    heartbeats, for `sessions.SESSION_TIMEOUT` are closed. A player that
+    doesn't hear from the master for that long, or is told that its session
+    is unknown, reconnects.
+
+    A player's instance can also relay the changes that it receives to up to
+    `relay_fanout` spectators, see `relay`. The spectators that it relays to
+    have sessions like the players on the master, and a spectator that loses
+    its relay joins the master again.
+    """
+
+    def __init__(self, net, master=None, port=None,
+                 drain_budget=DRAIN_BUDGET, recorder=None, impairment=None,
+                 pacing_rate=sendqueue.PACING_RATE, use_stream=False,
+                 relay_fanout=0):
+        """Starts the API endpoint.
+
+        Args:
+            net: `netloop.NetworkLoop` that runs the endpoint.
+            master: the address of the master, if this is a player's instance.
+            port: the local UDP port.
+            drain_budget: time in seconds that can be spent on dispatching
+              received messages in each frame.
+            recorder: `apitrace.TraceRecorder` that records the messages.
+            impairment: `netsim.Impairment` that is applied to the outgoing
+              datagrams, for testing.
+            pacing_rate: the limit of the outgoing traffic to each peer, in
+              bytes per second, or None.
+            use_stream: whether a player's instance uses the TCP transport
+              of `stream` instead of UDP. The master listens on both, on the
+              same port.
+            relay_fanout: the number of spectators that a player's instance
+              can relay to. Relaying needs UDP, since the stream client
+              doesn't accept connections.
+        """
+        if port is None:
+            port = PORT if master is None else CLIENT_PORT
+        if type(master) is str:
+            master = (master, PORT)
+        if master is not None:
+            master = normalize_address(master)
+        super().__init__(master, recorder, 0 if use_stream else relay_fanout,
+                         pacing_rate, use_stream)
+        self.net = net
+        # The master that a spectator falls back to when its relay is lost.
+        self.origin = master
+        self.player = None
+        self.spectator = False
+        self.drain_budget = drain_budget
+        # Received messages. Appended in the network thread, popped in the
+        # main thread.
+        self._inbox = collections.deque()
+        # Used in the network thread only.
+        self._reassembler = framing.Reassembler()
+        # Sizes of the messages before and after compression.
+        self.bytes_uncompressed = 0
+        self.bytes_compressed = 0
+        self.fragments_sent = 0
+        # The transport of the stream sessions on the master.
+        self.stream_transport = None
+        if not self.use_stream:
+            print('Starting ApiServer on port', port)
+            self.transport, _ = net.run_coroutine(
+                net.loop.create_datagram_endpoint(
+                    lambda: ApiProtocol(self), local_addr=('::', port),
+                    family=socket.AF_INET6))
+        else:
+            self.transport = stream.StreamClient(
+                net.loop, master, self._stream_received)
+        if master is None:
+            port = self.transport.get_extra_info('sockname')[1]
+            print('Starting ApiServer on TCP port', port)
+            self.stream_transport = net.run_coroutine(
+                stream.StreamServer.start(port, self._stream_received))
+        if impairment is not None:
+            print('Impairing the outgoing traffic:', impairment)
+            self.transport = netsim.ImpairedTransport(
+                self.transport, net.loop, impairment,
+                lossless=self.use_stream)
+            if self.stream_transport is not None:
+                self.stream_transport = netsim.ImpairedTransport(
+                    self.stream_transport, net.loop, impairment,
+                    lossless=True)
+        net.call_soon(self._tick)
+        net.call_soon(self._heartbeat)
+        pyglet.clock.schedule_interval(self.drain, DRAIN_INTERVAL)
+
+    def shutdown(self):
+        pyglet.clock.unschedule(self.drain)
+        self.net.call_soon(self.transport.close)
+        if self.stream_transport is not None:
+            self.net.call_soon(self.stream_transport.close)
+        print('Stopped ApiServer')
+
+    def connect(self, player, spectator=None, lost=False):
+        """Opens a session with the master. Called on the players.
+
+        Args:
+            player: the name of the player.
+            spectator: whether to join as a spectator, which only receives
+              the changes. Defaults to the previous value.
+            lost: whether the spectator joins again after losing its relay.
+        """
+        session_id = os.urandom(8).hex()
+        with self._lock:
+            self.player = player
+            if spectator is not None:
+                self.spectator = spectator
+            params = {
+                'player': player,
+                'session': session_id,
+                'wire': wire.VERSIONS
+            }
+            if self.spectator:
+                params['spectator'] = True
+            if self.relay_fanout:
+                params['relay'] = self.relay_fanout
+            if lost:
+                params['lost'] = True
+            session = self.sessions.connect(None, self.master, session_id,
+                                            stream=self.use_stream)
+            self._send_to_session({'method': 'hi', 'params': params}, session)
+
+    def relay_to(self, parent):
+        """Moves the session of a spectator from the master to a relay."""
+        if self.use_stream:
+            # The master doesn't relay to the stream clients, which can
+            # only reach the master.
+            return
+        self.net.call_soon(self._move_upstream, normalize_address(parent),
+                           False)
+
+    def _move_upstream(self, address, lost):
+        """Replaces the session with the upstream. In the network thread."""
+        with self._lock:
+            session = self.sessions.get(self.master)
+            if session is not None:
+                # Acknowledge what has been received before leaving.
+                for data in session.peer.due(
+                        lambda m: self._encode(m, session)):
+                    self._transmit(data, session.address)
+            self.master = address
+            # Replaces the session with the old upstream.
+            self.sessions.connect(None, address, stream=self.use_stream)
+        self.connect(self.player, lost=lost)
+
+    def _stream_received(self, data, address):
+        self._datagram_received(data, address, stream=True)
+
+    def _datagram_received(self, data, address, stream=False):
+        """Called in the network thread.
+
+        Args:
+            data: the received datagram, or a frame of the stream transport.
+            address: the address of the peer.
+            stream: whether the data came over the stream transport.
+        """
+        address = normalize_address(address)
+        try:
+            data = self._reassembler.receive(address, data)
+            if data is None:
+                return
+            request = wire.decode(framing.decompress(data))
+        except (framing.FrameError, wire.DecodeError) as e:
+            self.drop(address, 'malformed: {}'.format(e))
+            return
+        if not validate(request):
+            self.drop(address, 'invalid: {}'.format(reprlib.repr(request)))
+            return
+        method = request['method']
+        with self._lock:
+            session = self._open_session(request, address, stream)
+            if session is None:
+                if self.is_master:
+                    print('Unknown peer', address, method)
+                    self._transmit(wire.encode({'method': 'reconnect'}),
+                                   address, stream)
+                return
+            session.received(len(data))
+            if address != self.master and not session.allow(method):
+                session.throttled += 1
+                if session.stream and reliable.is_reliable(request):
+                    # Nothing is retransmitted over a stream, so the message
+                    # waits for the rate limit.
+                    if len(session.held) >= sessions.MAX_HELD:
+                        self._reset(session)
+                    else:
+                        session.held.append(request)
+                # Otherwise the reliable messages are not acknowledged, and
+                # will be retransmitted later.
+                return
+            self._process(request, session)
+
+    def _process(self, request, session):
+        """Handles a message that has passed the rate limit.
+
+        Called in the network thread, with the lock held.
+        """
+        method = request['method']
+        params = request.get('params', {})
+        address = session.address
+        if method == 'ping':
+            self._transmit(self._encode({
+                'method': 'pong',
+                'params': params
+            }, session), address)
+            return
+        if method == 'pong':
+            session.ping_rtt = time.monotonic() - params['t']
+            return
+        if method == 'reconnect':
+            # Only the upstream can tell a client to join again.
+            if not self.is_master and address == self.master:
+                self.net.loop.call_soon(self.connect, self.player)
+            return
+        for request in session.peer.receive(request):
+            self._record(apitrace.IN, address, request)
+            self._inbox.append((request, address))
+
+    def _tick(self):
+        """Sends retransmissions and acknowledgements in the network thread."""
+        if self.transport.is_closing():
+            return
+        self._reassembler.expire()
+        with self._lock:
+            for session in self.sessions:
+                if (session.released and not session.peer.in_flight and
+                    not session.queue):
+                    self.sessions.close(session)
+                    continue
+                while (session.held and
+                       session.allow(session.held[0]['method'])):
+                    self._process(session.held.popleft(), session)
+                for data in session.peer.due(
+                        lambda m: self._encode(m, session)):
+                    self._transmit(data, session.address)
+                if session.peer.failed:
+                    self._reset(session)
+        self.net.loop.call_later(TICK, self._tick)
+
+    def _reset(self, session):
+        """Replaces a session whose reliable channel has lost a message.
+
+        The peer would buffer everything after the lost message forever.
+        A player joins the master again, and the master or a relay tells
+        its peer to do so. The new session starts with a sync, which resends
+        what the peer has missed. Called in the network thread.
+        """
+        print('Lost a message to', session.address, 'resetting the session')
+        if session.address == self.master:
+            self.net.loop.call_soon(self.connect, self.player)
+            return
+        self.sessions.close(session)
+        # If this is lost, the next message of a player gets the same answer
+        # from the master, and a spectator falls back to the master when its
+        # relay stops answering.
+        self._transmit(wire.encode({'method': 'reconnect'}), session.address,
+                       session.stream)
+
+    def _heartbeat(self):
+        """Pings the peers and closes the expired sessions."""
+        if self.transport.is_closing():
+            return
+        ping = {'method': 'ping', 'params': {'t': time.monotonic()}}
+        with self._lock:
+            if self.is_master:
+                closed = self.sessions.evict_expired()
+            else:
+                now = time.monotonic()
+                closed = [session for session in self._children()
+                          if session.expired(now)]
+                for session in closed:
+                    self.sessions.close(session)
+                master = self.sessions.get(self.master)
+                if master.expired(now) and self.player is not None:
+                    if self.master != self.origin:
+                        print('Lost connection to the relay, rejoining')
+                        self.net.loop.call_soon(
+                            self._move_upstream, self.origin, True)
+                    else:
+                        print('Lost connection to the master, reconnecting')
+                        self.net.loop.call_soon(self.connect, self.player)
+            for session in self.sessions:
+                # The players don't ping the master before sending 'hi'.
+                if self.is_master or session.packets_out > 0:
+                    self._transmit(self._encode(ping, session),
+                                   session.address)
+        for session in closed:
+            print('Closing the session of', session.player)
+            self.net.bridge.post(self, 'on_session_closed', session)
+        self.net.loop.call_later(sessions.HEARTBEAT_INTERVAL, self._heartbeat)
+
+    def drain(self, dt=None):
+        """Dispatches the received messages in the main thread."""
+        deadline = time.perf_counter() + self.drain_budget
+        batch = []
+        while self._inbox:
+            batch.append(self._inbox.popleft())
+
+        # Index of the latest temporary position of every token.
+        latest = {}
+        for i, (request, _) in enumerate(batch):
+            if request['method'] == 'token_temp_position_changed':
+                latest[request['params']['token_id']] = i
+
+        for i, (request, address) in enumerate(batch):
+            if i > 0 and time.perf_counter() > deadline:
+                # Leave the rest for the next frame.
+                self._inbox.extendleft(reversed(batch[i:]))
+                return
+            if (request['method'] == 'token_temp_position_changed' and
+                latest[request['params']['token_id']] != i):
+                continue
+            self.dispatch_event('on_api_request', request, address)
+
+    def stats(self) -> list:
+        """Returns the statistics of all the live sessions."""
+        with self._lock:
+            return [session.stats() for session in self.sessions]
+
+    def framing_stats(self) -> dict:
+        """Returns the counters of the compression and the fragmentation."""
+        with self._lock:
+            ratio = None
+            if self.bytes_uncompressed:
+                ratio = self.bytes_compressed / self.bytes_uncompressed
+            return {
+                'bytes_uncompressed': self.bytes_uncompressed,
+                'bytes_compressed': self.bytes_compressed,
+                'compression_ratio': ratio,
+                'fragments_sent': self.fragments_sent,
+                'reassembled': self._reassembler.reassembled,
+                'reassembly_failures': self._reassembler.failed,
+                'reassembly_pending': self._reassembler.pending,
+            }
+
+    def _encode(self, request, session):
+        return self._compress(wire.encode(request, session.wire_version),
+                              session)
+
+    def _compress(self, data, session):
+        if (session.wire_version == wire.JSON or
+            len(data) <= framing.COMPRESS_THRESHOLD):
+            return data
+        compressed = framing.compress(data)
+        self.bytes_uncompressed += len(data)
+        self.bytes_compressed += len(compressed)
+        return compressed
+
+    def _transmit(self, data, address, stream=False):
+        """Sends a frame, in fragments if needed, in the network thread.
+
+        The peers that use the JSON encoding are older versions, which can't
+        reassemble fragments, so their frames are always sent whole, and the
+        IP layer fragments them if they don't fit the path MTU. Nothing is
+        fragmented over a stream.
+
+        Args:
+            data: the frame.
+            address: the address of the peer.
+            stream: whether to use the stream transport if the peer has no
+              session. Otherwise the transport of the session is used.
+        """
+        session = self.sessions.get(address)
+        if session is not None:
+            stream = session.stream
+        if (len(data) > framing.MAX_DATAGRAM and session is not None and
+            session.wire_version != wire.JSON and not stream):
+            datagrams = framing.fragment(data)
+            self.fragments_sent += len(datagrams)
+        else:
+            datagrams = [data]
+        transport = self.transport
+        if stream and self.stream_transport is not None:
+            transport = self.stream_transport
+        for datagram in datagrams:
+            transport.sendto(datagram, address)
+            if session is not None:
+                session.sent(len(datagram))
+                session.bucket.consume(len(datagram))
+
+    def _schedule_pump(self, session, delay=0):
+        if session.queue.scheduled:
+            return
+        session.queue.scheduled = True
+        if delay:
+            self.net.loop.call_later(delay, self._pump, session)
         else:
-            for address in self.players:
-                print('notify', address, request)
-                self.server.socket.sendto(request, address)
+            self.net.call_soon(self._pump, session)
+
+    def _pump(self, session):
+        """Sends the queued messages as fast as the pacing allows.
+
+        Called in the network thread.
+        """
+        with self._lock:
+            session.queue.scheduled = False
+            if (self.transport.is_closing() or
+                self.sessions.get(session.address) is not session):
+                return
+            while session.queue and session.bucket.ready():
+                item = session.queue.pop()
+                if item is None:
+                    break
+                if reliable.is_reliable({'method': item.method}):
+                    # The sequence number and the acknowledgements are
+                    # attached only now, in the order of sending.
+                    data = session.peer.prepare(
+                        {'method': item.method},
+                        lambda m: self._compress(wire.add_fields(
+                            item.data,
+                            {k: v for k, v in m.items() if k != 'method'}),
+                            session))
+                else:
+                    data = self._compress(item.data, session)
+                self._transmit(data, session.address)
+            if session.queue:
+                self._schedule_pump(session, session.bucket.wait())
 
-ApiServer.register_event_type('on_api_request_raw')
-ApiServer.register_event_type('on_api_request')
+    def _queue(self, request, session, data):
+        if data is None:
+            # The message is encoded right away, since the objects that it
+            # references can change before it is sent.
+            data = wire.encode(request, session.wire_version)
+        session.queue.push(request['method'], data, 'version' in request,
+                           sendqueue.coalesce_key(request))
+        self._schedule_pump(session)
@@ -0,0 +1,70 @@
+"""Recording of the API traffic.
+
+A trace is a JSON Lines file with one API message per line:
+
+    {"t": 1.25, "dir": "in", "peer": ["::1", 2216], "message": {...}}
+
+`t` is the time in seconds since the recording has started, `dir` is "in"
+for the messages received from the peer and "out" for the messages sent to
+it. The inbound messages are recorded once they are delivered by the
+reliability layer, and the outbound ones before they get sequence numbers,
+so the trace contains what `Controller` has seen and sent. Acknowledgements
+and heartbeats are not recorded.
+"""
+
+import json
+import threading
+import time
+
+IN = 'in'
+OUT = 'out'
+
+
+class TraceRecorder(object):
+    """Writes the API messages to a trace file.
+
+    Can be used from the network thread and from the main thread at the same
+    time. The messages are serialized right away, so they can be changed
+    after they have been recorded.
+    """
+
+    def __init__(self, path, clock=time.monotonic):
+        self._file = open(path, 'w')
+        self._clock = clock
+        self._start = clock()
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, direction, peer, message):
+        line = json.dumps({
+            't': round(self._clock() - self._start, 6),
+            'dir': direction,
+            'peer': peer,
+            'message': message
+        }, separators=(',', ':'))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + '\n')
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_trace(path) -> list:
+    """Returns the records of a trace, sorted by time."""
+    records = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get('peer') is not None:
+                record['peer'] = tuple(record['peer'])
+            records.append(record)
+    records.sort(key=lambda r: r['t'])
+    return records
@@ -0,0 +1,153 @@
+"""On-disk cache of the campaign assets downloaded by the players.
+
+The files are stored by the hash of their content, which is also their ETag
+on the resource server and their hash in its manifest, so the same image used
+by several campaigns or under several names is stored once. An index maps the
+paths of the assets in the campaign to the hashes and records when every
+object was last used. When the cache grows over its size limit, the least
+recently used objects are evicted.
+
+The index is not keyed by the URL, since the address of the master often
+changes between the games. An asset listed in the manifest is read by its
+hash, and the others are revalidated with `If-None-Match`, so a warm join
+transfers only the assets that have changed.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+MAX_SIZE = 512 * 1024 * 1024
+
+
+def default_dir():
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'seer')
+
+
+def content_hash(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class AssetCache(object):
+    """Content-addressed files with LRU eviction. Can be used by any thread."""
+
+    def __init__(self, directory, max_size=MAX_SIZE, clock=time.time):
+        self.dir = directory
+        self.max_size = max_size
+        self._clock = clock
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        self._index_path = os.path.join(directory, 'index.json')
+        try:
+            with open(self._index_path) as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            index = {}
+        # The hash of every path, and the size and the last use of every
+        # object.
+        self._paths = index.get('paths', {})
+        self._objects = index.get('objects', {})
+        # Objects that have disappeared from the disk are forgotten.
+        for digest in list(self._objects):
+            if not os.path.isfile(self._object_path(digest)):
+                self._forget(digest)
+
+        self.hits = 0
+        self.misses = 0
+
+    def _object_path(self, digest):
+        return os.path.join(self.dir, 'objects', digest)
+
+    def _forget(self, digest):
+        self._objects.pop(digest, None)
+        for path in [p for p, d in self._paths.items() if d == digest]:
+            del self._paths[path]
+
+    def etag(self, path):
+        """Returns the ETag of the cached content of the path, or None."""
+        with self._lock:
+            return self._paths.get(path)
+
+    def get(self, path):
+        """Returns the cached content of the path, or None."""
+        with self._lock:
+            return self._read(self._paths.get(path))
+
+    def get_object(self, digest):
+        """Returns the cached content with the hash, or None."""
+        with self._lock:
+            return self._read(digest if digest in self._objects else None)
+
+    def _read(self, digest):
+        if digest is None:
+            self.misses += 1
+            return None
+        try:
+            with open(self._object_path(digest), 'rb') as file:
+                data = file.read()
+        except OSError:
+            data = None
+        if data is None or content_hash(data) != digest:
+            self._forget(digest)
+            self.misses += 1
+            return None
+        self._objects[digest]['used'] = self._clock()
+        self.hits += 1
+        return data
+
+    def put(self, path, data, digest=None):
+        """Stores the content of the path.
+
+        Args:
+            path: the path of the asset in the campaign.
+            data: the content.
+            digest: the ETag that the server has sent, if it is the content
+              hash. Checked before it is trusted.
+        """
+        if digest is None or content_hash(data) != digest:
+            digest = content_hash(data)
+        with self._lock:
+            if digest not in self._objects:
+                object_path = self._object_path(digest)
+                temp = '{}.{}.tmp'.format(object_path, threading.get_ident())
+                with open(temp, 'wb') as file:
+                    file.write(data)
+                os.replace(temp, object_path)
+            self._objects[digest] = {'size': len(data),
+                                     'used': self._clock()}
+            self._paths[path] = digest
+            self._evict()
+            self._save()
+
+    def size(self) -> int:
+        with self._lock:
+            return sum(o['size'] for o in self._objects.values())
+
+    def _evict(self):
+        total = sum(o['size'] for o in self._objects.values())
+        for digest in sorted(self._objects,
+                             key=lambda d: self._objects[d]['used']):
+            if total <= self.max_size:
+                break
+            total -= self._objects[digest]['size']
+            self._forget(digest)
+            try:
+                os.remove(self._object_path(digest))
+            except OSError:
+                pass
+
+    def _save(self):
+        temp = self._index_path + '.tmp'
+        with open(temp, 'w') as file:
+            json.dump({'paths': self._paths, 'objects': self._objects},
+                      file)
+        os.replace(temp, self._index_path)
+
+    def save(self):
+        """Saves the recent uses of the objects."""
+        with self._lock:
+            self._save()
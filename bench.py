@@ -0,0 +1,253 @@
+"""Benchmarks for the network code.
+
+Usage:
+    python bench.py <benchmark>
+
+Run without arguments to list the available benchmarks.
+"""
+
+import contextlib
+import http.client
+import io
+import itertools
+import json
+import sys
+import threading
+import time
+import timeit
+import urllib.parse
+
+import netloop
+import netsim
+import resserver
+import seer
+import simulate
+import wire
+
+WIRE_MESSAGES = {
+    'token_temp_position_changed': {
+        'method': 'token_temp_position_changed',
+        'params': {
+            'token_id': 2,
+            'position': [10.28659597365681, 19.060079167868967]
+        }
+    },
+    'update_token': {
+        'method': 'update_token',
+        'params': {
+            'token': {
+                'character': 'pc-aengus',
+                'id': 2,
+                'position': [10, 19]
+            }
+        }
+    },
+    'patch': {
+        'method': 'patch',
+        'params': {
+            'entity': 'token',
+            'id': 2,
+            'set': {'position': [10, 19]}
+        }
+    },
+    'new_chat': {
+        'method': 'new_chat',
+        'params': {
+            'message': {
+                'player': 'Aengus',
+                'text': 'I open the door.',
+                'time': 1591219006.6732361
+            }
+        }
+    },
+}
+
+
+def _time_per_call(func, number=20000):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1E6
+
+
+def bench_wire():
+    """Bytes per message and encode/decode time for each wire encoding."""
+    print('{:30} {:>8} {:>6} {:>11} {:>11}'.format(
+        'message', 'encoding', 'bytes', 'encode, us', 'decode, us'))
+    for name, message in WIRE_MESSAGES.items():
+        for version, version_name in ((wire.JSON, 'json'),
+                                      (wire.BINARY_V1, 'binary')):
+            encoded = wire.encode(message, version)
+            encode_time = _time_per_call(lambda: wire.encode(message, version))
+            decode_time = _time_per_call(lambda: wire.decode(encoded))
+            print('{:30} {:>8} {:>6} {:>11.2f} {:>11.2f}'.format(
+                name, version_name, len(encoded), encode_time, decode_time))
+
+
+SYNC_PROFILES = {
+    'clean': None,
+    'lossy': 'loss=0.05,delay=0.03,jitter=0.01',
+    'bad': 'loss=0.2,delay=0.1,jitter=0.05,duplicate=0.02,reorder=0.05',
+    'narrow': 'delay=0.03,bandwidth=20000',
+}
+
+
+def bench_sync():
+    """Convergence time and traffic of 4 players under simulated networks."""
+    print('{:8} {:>9} {:>12} {:>10} {:>10} {:>11}'.format(
+        'network', 'join, s', 'converge, s', 'master, B', 'players, B',
+        'retransmits'))
+    for name, spec in SYNC_PROFILES.items():
+        impairment = netsim.Impairment.parse(spec) if spec else None
+        result = simulate.simulate(players=4, changes=100,
+                                   impairment=impairment)
+        print('{:8} {:>9.3f} {:>12.3f} {:>10} {:>10} {:>11}'.format(
+            name, result['join_time'], result['convergence_time'],
+            result['master_bytes_out'], result['players_bytes_out'],
+            result['retransmits']))
+
+
+# Only the delay and the bandwidth apply to both transports: TCP doesn't lose
+# or reorder the frames.
+TRANSPORT_PROFILES = {
+    'clean': None,
+    'delayed': 'delay=0.03,jitter=0.005',
+    'narrow': 'delay=0.03,bandwidth=20000',
+}
+
+
+def bench_transport():
+    """UDP and TCP transports compared: latency and throughput."""
+    print('{:8} {:>9} {:>8} {:>12} {:>10} {:>12} {:>10}'.format(
+        'network', 'transport', 'rtt, ms', 'converge, s', 'changes/s',
+        'master, B', 'writes'))
+    for name, spec in TRANSPORT_PROFILES.items():
+        impairment = netsim.Impairment.parse(spec) if spec else None
+        for transport in ('udp', 'tcp'):
+            # The changes are made without pauses, so that the throughput
+            # is limited by the transport.
+            result = simulate.simulate(players=4, changes=300,
+                                       impairment=impairment,
+                                       use_stream=transport == 'tcp',
+                                       interval=0)
+            elapsed = result['script_time'] + result['convergence_time']
+            print('{:8} {:>9} {:>8.2f} {:>12.3f} {:>10.0f} {:>12} {:>10}'
+                  .format(name, transport, (result['rtt'] or 0) * 1000,
+                          result['convergence_time'],
+                          result['changes'] / elapsed,
+                          result['master_bytes_out'],
+                          result.get('writes') or '-'))
+
+
+def bench_relay():
+    """Egress of the master as the audience of spectators grows."""
+    print('{:>10} {:>6} {:>12} {:>10} {:>13} {:>12}'.format(
+        'spectators', 'depth', 'converge, s', 'master, B', 'spectators, B',
+        'master, B/s'))
+    for spectators in (0, 8, 24):
+        result = simulate.simulate(players=4, changes=100,
+                                   spectators=spectators)
+        elapsed = result['script_time'] + result['convergence_time']
+        print('{:>10} {:>6} {:>12.3f} {:>10} {:>13} {:>12.0f}'.format(
+            spectators, result['relay_depth'], result['convergence_time'],
+            result['master_bytes_out'], result['spectators_bytes_out'],
+            result['master_bytes_out'] / elapsed))
+
+
+def _join(provider, paths, prefetch, times, i):
+    """Downloads what a player needs before it can render the game."""
+    start = time.monotonic()
+    if prefetch:
+        provider.prefetch()
+    with provider.open('data.json') as file:
+        file.read()
+    for path in paths:
+        with provider.open(path) as file:
+            file.read()
+    times[i] = time.monotonic() - start
+
+
+def bench_joiners():
+    """Time to first render of players that join at once, per player."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        campaign = simulate.load_campaign('campaign')
+        net = netloop.NetworkLoop()
+        server = resserver.ResourceServer('campaign', campaign, net, port=0)
+    # The players load all the fragments before the first frame.
+    paths = [fragment['path']
+             for fragment in campaign._data['fragments'].values()]
+    print('{:>9} {:>8} {:>8} {:>8}  {}'.format(
+        'download', 'joiners', 'mean, s', 'max, s', 'per player, s'))
+    for prefetch, joiners in itertools.product((False, True), (1, 5, 10)):
+        times = [None] * joiners
+        threads = [
+            threading.Thread(target=_join, args=(
+                seer.RemoteResourceProvider('::1', server.port), paths,
+                prefetch, times, i))
+            for i in range(joiners)
+        ]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        print('{:>9} {:>8} {:>8.3f} {:>8.3f}  {}'.format(
+            'parallel' if prefetch else 'serial', joiners,
+            sum(times) / joiners, max(times),
+            ' '.join('{:.3f}'.format(t) for t in times)))
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.shutdown()
+        net.stop()
+        net.join()
+
+
+def _wire_bytes(connection, path, encoding):
+    """Returns the length of the body of the response as sent."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        connection.request('GET', '/' + urllib.parse.quote(path),
+                           headers={'Accept-Encoding': encoding})
+        return len(connection.getresponse().read())
+
+
+def bench_encoding():
+    """Bytes on the wire for the sample campaign, without and with gzip."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        campaign = simulate.load_campaign('campaign')
+        net = netloop.NetworkLoop()
+        server = resserver.ResourceServer('campaign', campaign, net, port=0)
+        connection = http.client.HTTPConnection('::1', server.port)
+        connection.request('GET', '/manifest')
+        paths = ['data.json', 'manifest'] + sorted(
+            json.loads(connection.getresponse().read())['assets'])
+    print('{:>10} {:>10} {:>6}  {}'.format('identity', 'gzip', 'ratio',
+                                           'path'))
+    totals = [0, 0]
+    for path in paths:
+        identity = _wire_bytes(connection, path, 'identity')
+        gzipped = _wire_bytes(connection, path, 'gzip')
+        totals[0] += identity
+        totals[1] += gzipped
+        print('{:>10} {:>10} {:>6.2f}  {}'.format(
+            identity, gzipped, gzipped / identity, path))
+    print('{:>10} {:>10} {:>6.2f}  total'.format(
+        totals[0], totals[1], totals[1] / totals[0]))
+    connection.close()
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.shutdown()
+        net.stop()
+        net.join()
+
+
+BENCHMARKS = {
+    'wire': bench_wire,
+    'sync': bench_sync,
+    'transport': bench_transport,
+    'relay': bench_relay,
+    'joiners': bench_joiners,
+    'encoding': bench_encoding,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        for name, func in BENCHMARKS.items():
+            print('    {:10} {}'.format(name, func.__doc__))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]]()
@@ -1,13 +1,31 @@
 """The representation of the shared game state."""
 
+import collections
+import copy
 import datetime
 import json
 import os.path
 import pyglet
+import threading
 import time
 
+import movement
 import saviour
 
+# The number of recent changes of the campaign that the master keeps to resend
+# them to the players that have missed them.
+HISTORY_SIZE = 1000
+
+# Kinds of the entities that can be changed with `Campaign.patch`. The
+# campaign itself has the ID None.
+ENTITIES = ('campaign', 'page', 'character', 'token')
+
+
+def is_position(value) -> bool:
+    """Checks a position received from a peer, such as that of a token."""
+    return (type(value) is list and len(value) == 2 and
+            all(type(c) in (int, float) for c in value))
+
 
 class Fragment(object):
     """A sprite representing a token or a map tile.
@@ -66,6 +84,7 @@ class Character(object):
     def __init__(self, id: str, data: dict, campaign):
         self.id = id
         self._data = data
+        self._campaign = campaign
         self.fragment = campaign.fragments[self._data['fragment']]
 
     def controlled_by(self, player):
@@ -83,6 +102,9 @@ class Character(object):
     def maxhp(self):
         return self._data['maxhp']
 
+    def set_hp(self, hp, maxhp):
+        self._campaign.patch('character', self.id, {'hp': hp, 'maxhp': maxhp})
+
 
 class Token(object):
     """A token or a map tile added to a page.
@@ -92,9 +114,10 @@ class Token(object):
     the same `Fragment`, but separate Token.
     """
 
-    def __init__(self, data, campaign):
+    def __init__(self, data, campaign, page_id=None):
         self._data = data
         self._campaign = campaign
+        self.page_id = page_id
         assert 'fragment' in self._data or 'character' in self._data
         if 'fragment' in self._data:
             self._fragment = self._campaign.fragments[self._data['fragment']]
@@ -105,12 +128,17 @@ class Token(object):
         else:
             self.character = None
         self._temp_position = None
+        # The movement by another peer.
+        self.motion = movement.MotionTrack()
 
-    def update_data(self, data, notify=False):
+    def update_data(self, data):
         self._data = data
+        self.patched()
+
+    def patched(self):
+        """Called when the data of the token has been changed in place."""
         self._temp_position = None
-        if notify:
-            self._campaign.dispatch_event('on_token_updated', self)
+        self.motion.reset()
 
     @property
     def is_character(self) -> bool:
@@ -140,15 +168,37 @@ class Token(object):
             self._campaign.dispatch_event(
                 'on_token_temp_position_changed', self.id, self.temp_position)
 
+    def add_sample(self, x, y, t=None):
+        """Sets the temporary position received from another peer.
+
+        Args:
+            x, y: the position.
+            t: the timestamp of the sender in milliseconds, see
+              `movement.MotionTrack.add`.
+        """
+        self._temp_position = (x, y)
+        self.motion.add(x, y, t)
+
+    @property
+    def render_position(self):
+        """The position to draw the token at, smoothed if it is moved by
+        another peer."""
+        if self._temp_position is not None and self.motion.active:
+            return self.motion.position()
+        return self.temp_position
+
     @property
     def position(self):
         return self._data['position']
 
     def set_position(self, x, y, notify=True):
-        self._temp_position = None
-        self._data['position'] = (x, y)
-        if notify:
-            self._campaign.dispatch_event('on_token_updated', self)
+        with self._campaign.lock:
+            self._data['position'] = (x, y)
+            self.patched()
+            if notify:
+                self._campaign.dispatch_event(
+                    'on_entity_patched', 'token', self.id,
+                    {'position': (x, y)}, [])
 
     @property
     def type(self):
@@ -185,22 +235,141 @@ class Page(object):
         self._campaign = campaign
         self.tokens = []
         for token_data in data['tokens']:
-            token = Token(token_data, campaign)
+            token = Token(token_data, campaign, page_id=id)
             self.tokens.append(token)
+        self._next_veil_id = 1 + max(
+            (veil['id'] for veil in self.veils if 'id' in veil), default=0)
+        for veil in self.veils:
+            if 'id' not in veil:
+                veil['id'] = self._next_veil_id
+                self._next_veil_id += 1
 
     @property
     def veils(self):
         return self._data.get('veils', [])
 
-    def set_veils(self, veils):
+    @property
+    def veils_version(self) -> int:
+        """Incremented on every change of the veils of the page."""
+        return self._data.get('veils_version', 0)
+
+    def set_veils(self, veils, version=None):
         self._data['veils'] = veils
+        if version is not None:
+            self._data['veils_version'] = version
+
+    def _veils_patched(self, changed, removed):
+        self._data['veils_version'] = self.veils_version + 1
+        self._campaign.dispatch_event(
+            'on_veils_patched', self.id, self.veils_version, changed, removed)
 
     def toggle_veil(self, x, y):
+        with self._campaign.lock:
+            changed = []
+            for veil in self.veils:
+                if (veil['minx'] < x < veil['maxx'] and
+                    veil['miny'] < y < veil['maxy']):
+                    veil['covered'] = not veil['covered']
+                    changed.append(veil)
+            if changed:
+                self._veils_patched(changed, [])
+
+    def add_veil(self, minx, miny, maxx, maxy, covered=True):
+        veil = {
+            'id': self._next_veil_id,
+            'minx': minx,
+            'miny': miny,
+            'maxx': maxx,
+            'maxy': maxy,
+            'covered': covered
+        }
+        self._next_veil_id += 1
+        with self._campaign.lock:
+            self._data['veils'] = self.veils + [veil]
+            self._veils_patched([veil], [])
+        return veil['id']
+
+    def remove_veil(self, veil_id):
+        with self._campaign.lock:
+            self._data['veils'] = [v for v in self.veils
+                                   if v['id'] != veil_id]
+            self._veils_patched([], [veil_id])
+
+    def apply_veils_patch(self, version, changed, removed) -> bool:
+        """Applies the veil changes received from the master.
+
+        Returns False if some earlier patch was missed and the veils have to
+        be resynced with `set_veils()`.
+        """
+        if version <= self.veils_version:
+            # Already applied.
+            return True
+        if version != self.veils_version + 1:
+            return False
+        removed = set(removed)
+        changed_by_id = {veil['id']: veil for veil in changed}
+        veils = []
         for veil in self.veils:
-            if (veil['minx'] < x < veil['maxx'] and
-                veil['miny'] < y < veil['maxy']):
-                veil['covered'] = not veil['covered']
-        self._campaign.dispatch_event('on_veils_updated', self.id, self.veils)
+            if veil['id'] in removed:
+                continue
+            veils.append(changed_by_id.pop(veil['id'], veil))
+        veils.extend(changed_by_id.values())
+        self.set_veils(veils, version)
+        return True
+
+    def covers(self, minx, miny, maxx, maxy) -> bool:
+        """Checks that the rectangle is entirely under covered veils."""
+        veils = [veil for veil in self.veils
+                 if veil['covered'] and
+                 veil['minx'] < maxx and veil['maxx'] > minx and
+                 veil['miny'] < maxy and veil['maxy'] > miny]
+        if not veils:
+            return False
+        # Split the rectangle along the edges of the veils. Each of the cells
+        # is either entirely covered by some veil or not covered at all.
+        xs = sorted({minx, maxx, *(veil[k] for veil in veils
+                                   for k in ('minx', 'maxx')
+                                   if minx < veil[k] < maxx)})
+        ys = sorted({miny, maxy, *(veil[k] for veil in veils
+                                   for k in ('miny', 'maxy')
+                                   if miny < veil[k] < maxy)})
+        for x0, x1 in zip(xs, xs[1:]):
+            x = (x0 + x1) / 2
+            for y0, y1 in zip(ys, ys[1:]):
+                y = (y0 + y1) / 2
+                if not any(veil['minx'] <= x <= veil['maxx'] and
+                           veil['miny'] <= y <= veil['maxy']
+                           for veil in veils):
+                    return False
+        return True
+
+    def is_hidden(self, token) -> bool:
+        """Checks whether the token is hidden from the players by the veils."""
+        if not any(veil['covered'] for veil in self.veils):
+            return False
+        x, y = token.position
+        width, height = token.fragment.size
+        return self.covers(x, y, x + width, y + height)
+
+    def snapshot(self, exclude=()) -> dict:
+        """Returns the state of the page that can be changed in the game.
+
+        Args:
+            exclude: the IDs of the tokens to leave out.
+        """
+        return {
+            'page_id': self.id,
+            'tokens': [token._data for token in self.tokens
+                       if token.id not in exclude],
+            'veils': self.veils,
+            'veils_version': self.veils_version
+        }
+
+    def apply_snapshot(self, snapshot):
+        tokens = {token.id: token for token in self.tokens}
+        for token_data in snapshot['tokens']:
+            tokens[token_data['id']].update_data(token_data)
+        self.set_veils(snapshot['veils'], snapshot['veils_version'])
 
     def find_token(self, x, y) -> Token:
         for token in self.tokens:
@@ -226,6 +395,10 @@ class Campaign(pyglet.event.EventDispatcher):
         self._resource_provider = resource_provider
         with resource_provider.open('data.json') as data:
             self._data = json.load(data)
+        # Held by the main thread while it changes the data and records the
+        # change, and by the threads that read the data, so that they never
+        # see a change without its version.
+        self.lock = threading.RLock()
         if resource_provider.can_save:
             backup_fname = 'backups/data-{}.json'.format(
                 datetime.datetime.now().strftime('%Y-%m-%dT%H%M%S'))
@@ -252,14 +425,138 @@ class Campaign(pyglet.event.EventDispatcher):
         for player, player_data in self._data['players'].items():
             self.players[player] = Player(player, player_data, self)
 
+        self._history = collections.deque(maxlen=HISTORY_SIZE)
+
+    @property
+    def version(self) -> int:
+        """The version of the campaign state.
+
+        Incremented by the master on every change that is sent to the players.
+        """
+        return self._data.get('version', 0)
+
+    def set_version(self, version):
+        self._data['version'] = version
+
+    def record(self, message, page=None):
+        """Stamps a notification about a change with the next version.
+
+        A copy of the notification is kept in the history, so that the
+        change can be resent to the players as it was made, even if the data
+        that it refers to changes later.
+
+        Args:
+            message: the notification.
+            page: the page that was changed, if any.
+        """
+        with self.lock:
+            self.set_version(self.version + 1)
+            message['version'] = self.version
+            self._history.append(
+                (self.version, copy.deepcopy(message), page))
+
+    def keep(self, message):
+        """Keeps a change received from the master in the history.
+
+        Used by the relays to resend the changes to their spectators. The
+        versions of the kept changes are not consecutive, so the field `prev`
+        tells the version that precedes each of them.
+        """
+        self._history.append(
+            (message['version'], copy.deepcopy(message), None))
+
+    def changes_since(self, version):
+        """Returns the recorded notifications after the given version.
+
+        Returns a list of pairs (notification, page), or None if some of the
+        changes are no longer in the history.
+        """
+        if version >= self.version:
+            return []
+        if not self._history:
+            return None
+        oldest, message, _ = self._history[0]
+        # None if the relay doesn't know what preceded the change.
+        prev = message.get('prev', oldest - 1)
+        if prev is None or prev > version:
+            return None
+        return [(message, page) for v, message, page in self._history
+                if v > version]
+
+    def snapshot(self, exclude=()) -> dict:
+        """Returns the state of the campaign that can be changed in the game.
+
+        Args:
+            exclude: the IDs of the tokens to leave out.
+        """
+        return {
+            'players_page': self.players_page_idx,
+            'chat': self._data.get('chat', []),
+            'characters': {id: character._data
+                           for id, character in self.characters.items()},
+            'pages': [page.snapshot(exclude) for page in self.pages]
+        }
+
+    def apply_snapshot(self, snapshot):
+        for page_snapshot in snapshot['pages']:
+            self.pages[page_snapshot['page_id']].apply_snapshot(page_snapshot)
+        for id, data in snapshot.get('characters', {}).items():
+            if id in self.characters:
+                self.characters[id]._data.update(data)
+        # The chat only grows, so only the new messages have to be added.
+        for message in snapshot['chat'][len(self._data.get('chat', [])):]:
+            self.add_chat(message)
+        if self.players_page_idx != snapshot['players_page']:
+            self.players_page_idx = snapshot['players_page']
+
+    def entity(self, entity, id):
+        """Returns the object of the given kind and ID.
+
+        Raises KeyError if there is no such object.
+        """
+        if entity == 'campaign':
+            return self
+        if entity == 'page':
+            if type(id) is not int or not 0 <= id < len(self.pages):
+                raise KeyError(id)
+            return self.pages[id]
+        if entity == 'character':
+            return self.characters[id]
+        if entity == 'token':
+            return self.tokens[id]
+        raise KeyError(entity)
+
+    def patch(self, entity, id, set=None, unset=(), notify=True):
+        """Changes the fields of an entity in place.
+
+        Args:
+            entity: one of `ENTITIES`.
+            id: the ID of the entity.
+            set: the new values of the fields.
+            unset: the names of the fields to remove.
+            notify: whether to dispatch `on_entity_patched`.
+        """
+        target = self.entity(entity, id)
+        set = set or {}
+        with self.lock:
+            target._data.update(set)
+            for name in unset:
+                target._data.pop(name, None)
+            if entity == 'token':
+                target.patched()
+            if notify:
+                self.dispatch_event('on_entity_patched', entity, id, set,
+                                    list(unset))
+
     @property
     def players_page_idx(self):
         return self._data['players_page']
 
     @players_page_idx.setter
     def players_page_idx(self, i):
-        self._data['players_page'] = i
-        self.dispatch_event('on_page_changed', i)
+        with self.lock:
+            self._data['players_page'] = i
+            self.dispatch_event('on_page_changed', i)
 
     def save(self):
         with self._resource_provider.open_write('data.json') as wfile:
@@ -268,14 +565,15 @@ class Campaign(pyglet.event.EventDispatcher):
     def add_chat(self, message):
         if 'time' not in message:
             message['time'] = time.time()
-        if 'chat' not in self._data:
-            self._data['chat'] = []
-        self._data['chat'].append(message)
-        self.dispatch_event('on_new_chat', message)
+        with self.lock:
+            if 'chat' not in self._data:
+                self._data['chat'] = []
+            self._data['chat'].append(message)
+            self.dispatch_event('on_new_chat', message)
 
 
-Campaign.register_event_type('on_token_updated')
+Campaign.register_event_type('on_entity_patched')
 Campaign.register_event_type('on_token_temp_position_changed')
 Campaign.register_event_type('on_page_changed')
-Campaign.register_event_type('on_veils_updated')
+Campaign.register_event_type('on_veils_patched')
 Campaign.register_event_type('on_new_chat')
@@ -0,0 +1,711 @@
+"""Synchronization of the campaign between the master and the players."""
+
+import copy
+import time
+
+from campaign import HISTORY_SIZE, is_position
+import movement
+import relay
+from state import State
+import wire
+
+
+def _is_hp(value):
+    return type(value) is int
+
+
+def _is_maxhp(value):
+    # The health bars divide by it.
+    return type(value) is int and value > 0
+
+
+# The fields that the players can change, with the checks of their values,
+# by the kind of the entity. The players can only change the entities that
+# they control, and can't unset these fields.
+PLAYER_FIELDS = {
+    'token': {'position': is_position},
+    'character': {'hp': _is_hp, 'maxhp': _is_maxhp},
+}
+# Unversioned messages from the master that the relays pass on to their
+# spectators. The versioned changes are always passed on.
+RELAYED_METHODS = {
+    'token_temp_position_changed', 'page_snapshot', 'veils_updated'
+}
+# Time in seconds after which a patch that the master hasn't confirmed stops
+# holding its fields. Longer than the retransmissions of a message can take.
+PENDING_OP_TIMEOUT = 60
+# The requests that the master accepts from the players.
+PLAYER_METHODS = {
+    'hi', 'sync', 'veils_resync', 'patch', 'update_token',
+    'token_temp_position_changed', 'player_chat', 'relay_left',
+}
+# The requests that the relays accept from their spectators.
+SPECTATOR_METHODS = {'hi', 'sync', 'veils_resync', 'relay_left'}
+
+
+class Controller(object):
+    """Connects the campaign to the API server.
+
+    Applies the changes received from the network to the campaign and sends
+    the local changes to the master or to the players. Doesn't depend on the
+    UI, so it can be run headless.
+    """
+
+    def __init__(self, state: State, api_server,
+                 movement_rate=movement.DEFAULT_RATE, clock=time.monotonic):
+        self.state = state
+        self._clock = clock
+
+        self.campaign = state.campaign
+        self.campaign.push_handlers(self)
+
+        self.api_server = api_server
+        self.api_server.push_handlers(self)
+        self.movement = movement.MovementChannel(
+            self._notify_temp_position, rate=movement_rate)
+        # Versioned notifications that arrived before the ones that the
+        # player has missed.
+        self._pending_changes = {}
+        self._sync_requested = False
+        # The patches made by the player that the master hasn't confirmed
+        # yet: lists of triples (operation ID, changed fields, time sent) by
+        # (entity, ID).
+        self._pending_ops = {}
+        self._next_op = 1
+        # On the master: the tokens hidden from the players by the veils,
+        # and the ones among them whose changes haven't been sent.
+        self._fogged = set()
+        self._withheld = set()
+        # On the master: the data of the fogged tokens as the players have
+        # last seen it, which is served to the joining players instead of the
+        # withheld changes.
+        self._shown = {}
+        # On the master: the clients that relay the changes to the
+        # spectators.
+        self.relays = relay.RelayTree()
+        if self.is_master:
+            for token in self.campaign.tokens.values():
+                if self._is_hidden(token):
+                    self._fog(token)
+
+    @property
+    def is_master(self):
+        return self.state.is_master
+
+    def on_players_page_shown(self):
+        """Called on the players when the master turns the page."""
+        pass
+
+    def on_api_request(self, request, client_address):
+        if self.is_master and request['method'] not in PLAYER_METHODS:
+            self.api_server.drop(client_address,
+                                 'not accepted from the players')
+        elif (not self.is_master and
+              client_address != self.api_server.master):
+            self._on_spectator_request(request, client_address)
+        elif 'version' in request and not self.is_master:
+            self._on_change(request, client_address)
+        else:
+            self._handle_request(request, client_address)
+            if (not self.is_master and
+                request['method'] in RELAYED_METHODS):
+                self.api_server.forward(request)
+
+    def _on_spectator_request(self, request, client_address):
+        """Handles a request of a spectator that this player relays to."""
+        if request['method'] not in SPECTATOR_METHODS:
+            self.api_server.drop(client_address,
+                                 'not accepted from the spectators')
+            return
+        self._handle_request(request, client_address)
+
+    def on_session_closed(self, session):
+        if self.is_master:
+            # The spectators moved to the relays have left the master
+            # already.
+            if (session.player in self.relays and
+                self.relays.parent(session.player) is None):
+                self.relays.leave(session.player)
+        else:
+            self._relay_left(session.player)
+
+    def _relay_left(self, player):
+        """Tells the master that a relayed spectator has disconnected."""
+        self.api_server.send({
+            'method': 'relay_left',
+            'params': {'player': player}
+        })
+
+    def _join(self, params, client_address) -> bool:
+        """Places a client that has said `hi` in the relay tree, on the master.
+
+        Returns False if the client is a spectator that has been sent to a
+        relay instead.
+        """
+        name = params['player']
+        # More children than this would take the upstream of the client.
+        capacity = min(params.get('relay', 0), relay.RELAY_FANOUT)
+        session = self.api_server.sessions.get(client_address)
+        # A client connected over a stream can only reach the master.
+        if not params.get('spectator') or (session is not None and
+                                           session.stream):
+            self.relays.add_player(name, client_address, capacity)
+            return True
+        if params.get('lost') and name in self.relays:
+            lost = self.relays.parent(name)
+            if lost is not None:
+                # The relay can't be reached, at least by this spectator.
+                self.relays.disable(lost)
+        parent = self.relays.place(name, client_address, capacity)
+        if parent is None:
+            return True
+        print('Relaying to spectator {} through {}'.format(name, parent))
+        self.api_server.send({
+            'method': 'relay_parent',
+            'params': {'parent': list(parent)}
+        }, client_address)
+        self.api_server.release(client_address)
+        return False
+
+    def _on_change(self, request, client_address):
+        """Applies a versioned change of the campaign on a player."""
+        version = request['version']
+        if version <= self.campaign.version:
+            # Already included in the state that the player has.
+            return
+        prev = request.get('prev')
+        # The first change sent in a new session has no `prev`, and may
+        # overtake the answer to the sync that follows `hi_ack`, so it waits
+        # for that answer. A snapshot replaces the whole state.
+        if ((prev is None and request['method'] != 'state_snapshot') or
+            (prev is not None and prev > self.campaign.version)):
+            print('Missed changes after version', self.campaign.version)
+            self._pending_changes[version] = request
+            if len(self._pending_changes) > HISTORY_SIZE:
+                self._pending_changes.clear()
+            if not self._sync_requested:
+                self._sync_requested = True
+                self._request_sync()
+            return
+        self._handle_request(request, client_address)
+        self.campaign.set_version(version)
+        # Kept to be resent to the spectators that sync with this relay.
+        self.campaign.keep(request)
+        self.api_server.forward(request)
+        self._sync_requested = False
+        if self._pending_changes:
+            pending = self._pending_changes
+            self._pending_changes = {}
+            for version in sorted(pending):
+                self._on_change(pending[version], client_address)
+
+    def _may_report_left(self, name, client_address) -> bool:
+        """Checks that the sender of `relay_left` relays to the spectator.
+
+        The relays report their children, and the relays above them pass
+        the reports on. The spectators connected to the master are removed
+        when their sessions close instead.
+        """
+        session = self.api_server.sessions.get(client_address)
+        if (name not in self.relays or session is None or
+            self.relays.parent(name) is None):
+            return False
+        if (session.player != name and
+            session.player not in self.relays.ancestors(name)):
+            self.api_server.drop(
+                client_address, '{} does not relay to {}'.format(
+                    session.player, name))
+            return False
+        return True
+
+    def _sender(self, client_address):
+        """Returns the name of the player that has sent a request."""
+        session = self.api_server.sessions.get(client_address)
+        if session is None or session.spectator:
+            return None
+        return session.player
+
+    def _check_control(self, token_id, client_address) -> bool:
+        """Checks that the sender of a request controls the token."""
+        token = self.campaign.tokens.get(token_id)
+        player = self._sender(client_address)
+        if token is None or player is None or not token.controlled_by(player):
+            self.api_server.drop(
+                client_address,
+                '{} does not control token {}'.format(player, token_id))
+            return False
+        return True
+
+    def _check_patch(self, entity, id, set, unset, client_address) -> bool:
+        """Checks that the sender of a patch may make it."""
+        player = self._sender(client_address)
+        try:
+            target = self.campaign.entity(entity, id)
+        except KeyError:
+            target = None
+        checks = PLAYER_FIELDS.get(entity, {})
+        if (target is None or player is None or not set or unset or
+            not all(name in checks and checks[name](value)
+                    for name, value in set.items()) or
+            not target.controlled_by(player)):
+            self.api_server.drop(
+                client_address, '{} may not change {} of {} {}'.format(
+                    player, sorted({*set, *unset}), entity, id))
+            return False
+        return True
+
+    def _is_hidden(self, token) -> bool:
+        """Checks whether the token is hidden from the players by the fog.
+
+        The characters of the players are never hidden, since their players
+        know where they are anyway.
+        """
+        if token.character is not None and not token.character.controlled_by(
+                None):
+            return False
+        return self.campaign.pages[token.page_id].is_hidden(token)
+
+    def _fog(self, token):
+        """Marks a token that the players have seen vanish into the fog."""
+        self._fogged.add(token.id)
+        self._shown[token.id] = copy.deepcopy(token._data)
+
+    def _unfog(self, token):
+        self._fogged.discard(token.id)
+        self._withheld.discard(token.id)
+        self._shown.pop(token.id, None)
+
+    def served_data(self) -> dict:
+        """Returns the campaign data that is served to the joining players.
+
+        The tokens with withheld changes have the data that the players have
+        last seen, as in the snapshots sent through the API. Called by the
+        resource server in its worker threads, with the lock of the campaign.
+        """
+        shown = {id: self._shown[id] for id in list(self._withheld)}
+        data = dict(self.campaign._data)
+        data['pages'] = [
+            dict(page, tokens=[shown.get(token.get('id'), token)
+                               for token in page['tokens']])
+            for page in data['pages']
+        ]
+        return data
+
+    def _withhold(self, token) -> bool:
+        """Decides whether to withhold a change of the token from the players.
+
+        A token that moves under the veils is still sent once, so that it
+        disappears into the fog instead of freezing at the edge. After that
+        its changes are only sent when it is revealed.
+        """
+        if not self._is_hidden(token):
+            self._unfog(token)
+            return False
+        if token.id not in self._fogged:
+            self._fog(token)
+            return False
+        self._withheld.add(token.id)
+        return True
+
+    def _reveal(self, page):
+        """Sends the withheld changes of the tokens revealed on the page."""
+        revealed = []
+        for token in page.tokens:
+            if self._is_hidden(token):
+                if token.id not in self._fogged:
+                    self._fog(token)
+            elif token.id in self._fogged:
+                if token.id in self._withheld:
+                    revealed.append(token)
+                self._unfog(token)
+        if not revealed:
+            return
+        notification = {
+            'method': 'patch_batch',
+            'params': {
+                'patches': [{'entity': 'token', 'id': token.id,
+                             'set': copy.deepcopy(token._data)}
+                            for token in revealed]
+            }
+        }
+        self._broadcast(notification, page=page.id)
+
+    def _request_sync(self):
+        self.api_server.send({
+            'method': 'sync',
+            'params': {'since': self.campaign.version}
+        })
+
+    def _handle_request(self, request, client_address):
+        method = request['method']
+        print('on_api_request', request)
+        # print('on_api_request', method, 'from', client_address)
+        params = request['params']
+        if method == 'hi':
+            if self.is_master and not self._join(params, client_address):
+                return
+            print('Adding player {} at address {}'.format(
+                params['player'], client_address))
+            self.api_server.set_player_page(
+                client_address, self.campaign.players_page_idx)
+            version = wire.negotiate(params.get('wire', ()))
+            self.api_server.send({
+                'method': 'hi_ack',
+                'params': {'wire': version}
+            }, client_address)
+            self.api_server.set_wire_version(client_address, version)
+        elif method == 'hi_ack':
+            self.api_server.set_wire_version(client_address, params['wire'])
+            # Catch up with the changes made since the campaign was loaded or
+            # since the connection was lost.
+            self._sync_requested = True
+            self._request_sync()
+            self._resend_pending()
+        elif method == 'sync':
+            # Answered by the relays too, from the changes that they keep.
+            since = params['since']
+            # Without a version the player needs the full state.
+            changes = (None if since is None else
+                       self.campaign.changes_since(since))
+            if changes is None:
+                print('Sending the full state to', client_address)
+                snapshot = {
+                    'method': 'state_snapshot',
+                    'version': self.campaign.version,
+                    'params': self.campaign.snapshot(exclude=self._withheld)
+                }
+                self.api_server.resend(client_address, None,
+                                       [(snapshot, None)])
+            else:
+                self.api_server.resend(client_address, since, changes)
+        elif method == 'state_snapshot':
+            # The patches that are still in flight will be confirmed after it.
+            self._pending_ops.clear()
+            self.campaign.apply_snapshot(params)
+        elif method == 'patch':
+            if self.is_master:
+                self._on_player_patch(params, client_address)
+            else:
+                self._on_patch(params)
+        elif method == 'update_token':
+            # Sent by the older versions instead of the patches.
+            token = params['token']
+            patch = dict(params, entity='token', id=token['id'], set=token)
+            if self.is_master:
+                patch['set'] = {'position': token['position']}
+                self._on_player_patch(patch, client_address)
+            else:
+                self._on_patch(patch)
+        elif method == 'patch_batch':
+            assert not self.is_master
+            for patch in params['patches']:
+                self._on_patch(patch)
+        elif method == 'patch_rejected':
+            assert not self.is_master
+            self._on_patch_rejected(params)
+        elif method == 'token_temp_position_changed':
+            if (self.is_master and
+                not self._check_control(params['token_id'], client_address)):
+                return
+            token = self.campaign.tokens[params['token_id']]
+            position = params['position']
+            if token is not self.state.dragged_token:
+                token.add_sample(position[0], position[1], params.get('t'))
+                if self.is_master:
+                    # Relayed with the timestamp of the sender, so that the
+                    # players interpolate at the sender's pace.
+                    self.movement.push(token.id, position, params.get('t'))
+        elif method == 'page_changed':
+            self.campaign.players_page_idx = params['players_page']
+            self.on_players_page_shown()
+        elif method == 'veils_updated':
+            page_id = params['page_id']
+            veils = params['veils']
+            self.campaign.pages[page_id].set_veils(
+                veils, params.get('version'))
+        elif method == 'veils_patch':
+            page = self.campaign.pages[params['page_id']]
+            if not page.apply_veils_patch(
+                    params['version'], params['veils'], params['removed']):
+                print('Missed veil updates on page', page.id)
+                self.api_server.send({
+                    'method': 'veils_resync',
+                    'params': {'page_id': page.id}
+                })
+        elif method == 'page_snapshot':
+            self.campaign.pages[params['page_id']].apply_snapshot(params)
+        elif method == 'veils_resync':
+            if params['page_id'] >= len(self.campaign.pages):
+                self.api_server.drop(client_address, 'no such page')
+                return
+            page = self.campaign.pages[params['page_id']]
+            self.api_server.send({
+                'method': 'veils_updated',
+                'params': {
+                    'page_id': page.id,
+                    'veils': page.veils,
+                    'version': page.veils_version
+                }
+            }, client_address)
+        elif method == 'relay_parent':
+            assert not self.is_master
+            self.api_server.relay_to(params['parent'])
+        elif method == 'relay_left':
+            if not self.is_master:
+                self._relay_left(params['player'])
+            elif self._may_report_left(params['player'], client_address):
+                # Its children join the master again once they notice.
+                self.relays.leave(params['player'])
+        elif method == 'player_chat':
+            assert self.state.is_master
+            player = self._sender(client_address)
+            if player is None:
+                return
+            # The name and the time are set by the master, so that the
+            # players can't impersonate each other.
+            self.campaign.add_chat({
+                'player': player,
+                'text': params['message']['text']
+            })
+        elif method == 'new_chat':
+            assert not self.state.is_master
+            print(request)
+            message = params['message']
+            self.campaign.add_chat(message)
+        else:
+            print('Unknown API request:', request, 'from', client_address)
+
+    def _on_player_patch(self, params, client_address):
+        """Applies a patch requested by a player on the master."""
+        entity, id = params['entity'], params['id']
+        set, unset = params.get('set', {}), params.get('unset', [])
+        op = params.get('op')
+        fields = {*set, *unset}
+        if not self._check_patch(entity, id, set, unset, client_address):
+            if op is not None:
+                self._reject(params, fields, client_address)
+            return
+        with self.campaign.lock:
+            self.campaign.patch(entity, id, set, unset, notify=False)
+            self._send_patch(entity, id, set, unset, op,
+                             self._sender(client_address))
+
+    def _reject(self, params, fields, client_address):
+        """Sends the current values of the fields of a rejected patch."""
+        try:
+            data = self.campaign.entity(params['entity'], params['id'])._data
+        except KeyError:
+            data = {}
+        self.api_server.send({
+            'method': 'patch_rejected',
+            'params': {
+                'op': params['op'],
+                'entity': params['entity'],
+                'id': params['id'],
+                'set': {name: data[name] for name in fields if name in data},
+                'unset': [name for name in fields if name not in data]
+            }
+        }, client_address)
+
+    def _held_fields(self, key) -> set:
+        """Returns the fields changed by the unconfirmed patches.
+
+        The patches that haven't been confirmed for `PENDING_OP_TIMEOUT` are
+        given up on, so that they don't hold the fields for the rest of the
+        game.
+        """
+        pending = self._pending_ops.get(key)
+        if pending:
+            deadline = self._clock() - PENDING_OP_TIMEOUT
+            pending[:] = [item for item in pending if item[2] > deadline]
+            if not pending:
+                del self._pending_ops[key]
+        return {name for _, fields, _ in self._pending_ops.get(key, ())
+                for name in fields}
+
+    def _resend_pending(self):
+        """Sends the unconfirmed patches again, in a new session.
+
+        They may have been lost with the old session. They are sent with the
+        current values of their fields, so applying them again is harmless.
+        """
+        pending = self._pending_ops
+        self._pending_ops = {}
+        for (entity, id), ops in pending.items():
+            fields = {name for _, names, _ in ops for name in names}
+            try:
+                data = self.campaign.entity(entity, id)._data
+            except KeyError:
+                continue
+            self.on_entity_patched(
+                entity, id,
+                {name: data[name] for name in fields if name in data},
+                [name for name in fields if name not in data])
+
+    def _confirm(self, key, op):
+        """Forgets the pending patches up to the given one."""
+        pending = self._pending_ops.get(key)
+        ops = [pending_op for pending_op, *_ in pending or ()]
+        if op not in ops:
+            return
+        del pending[:ops.index(op) + 1]
+        if not pending:
+            del self._pending_ops[key]
+
+    def _on_patch(self, params):
+        """Applies a patch from the master on a player.
+
+        The fields changed by the patches of this player that the master
+        hasn't confirmed yet keep the values that the player has set. The
+        master applies the patches in order, so once the player's last patch
+        is confirmed, the player has the same values as the master.
+        """
+        entity, id = params['entity'], params['id']
+        key = (entity, id)
+        if params.get('player') == self.state.player:
+            self._confirm(key, params.get('op'))
+        held = self._held_fields(key)
+        self._apply_patch(
+            entity, id,
+            {k: v for k, v in params.get('set', {}).items() if k not in held},
+            [k for k in params.get('unset', []) if k not in held])
+
+    def _on_patch_rejected(self, params):
+        key = (params['entity'], params['id'])
+        pending = self._pending_ops.get(key, [])
+        if params['op'] not in [op for op, *_ in pending]:
+            return
+        print('Patch of', params['entity'], params['id'],
+              'rejected by the master')
+        pending[:] = [item for item in pending if item[0] != params['op']]
+        if not pending:
+            del self._pending_ops[key]
+        # Restore the values of the master.
+        held = self._held_fields(key)
+        self._apply_patch(
+            params['entity'], params['id'],
+            {k: v for k, v in params['set'].items() if k not in held},
+            [k for k in params['unset'] if k not in held])
+
+    def _apply_patch(self, entity, id, set, unset):
+        if not set and not unset:
+            return
+        token = self.campaign.tokens.get(id) if entity == 'token' else None
+        if token is not None and token is self.state.dragged_token:
+            # Don't snap the token away from the cursor.
+            position = token.temp_position
+            self.campaign.patch(entity, id, set, unset, notify=False)
+            token.set_temp_position(*position, notify=False)
+        else:
+            self.campaign.patch(entity, id, set, unset, notify=False)
+
+    def _notify_temp_position(self, notification, token_id):
+        token = self.campaign.tokens[token_id]
+        if self.is_master and self._is_hidden(token):
+            return
+        self.api_server.notify(notification, page=token.page_id)
+
+    def _broadcast(self, notification, page=None):
+        """Sends a change of the campaign to the master or to the players.
+
+        On the master the change gets the next version of the campaign.
+        """
+        if self.is_master:
+            self.campaign.record(notification, page)
+        self.api_server.notify(notification, page=page)
+
+    def _entity_page(self, entity, id):
+        """Returns the page that the entity is on, or None."""
+        if entity == 'token':
+            return self.campaign.tokens[id].page_id
+        if entity == 'page':
+            return id
+        return None
+
+    def _send_patch(self, entity, id, set, unset, op=None, player=None):
+        """Sends the change of the fields of an entity.
+
+        Args:
+            entity, id: the changed entity.
+            set: the new values of the fields.
+            unset: the names of the removed fields.
+            op: the ID of the operation. Set by the player that has made the
+              change, and echoed by the master as the confirmation.
+            player: the player that has made the change, on the master.
+        """
+        if entity == 'token':
+            self.movement.commit(id)
+            if self.is_master and self._withhold(self.campaign.tokens[id]):
+                return
+        params = {'entity': entity, 'id': id}
+        if set:
+            params['set'] = set
+        if unset:
+            params['unset'] = unset
+        if op is not None:
+            params['op'] = op
+            if player is not None:
+                params['player'] = player
+        notification = {
+            'method': 'patch',
+            'params': params
+        }
+        self._broadcast(notification, page=self._entity_page(entity, id))
+
+    def on_entity_patched(self, entity, id, set, unset):
+        print('on_entity_patched:', entity, id, set, unset)
+        op = None
+        if not self.is_master:
+            # Applied optimistically until the master confirms it.
+            op = self._next_op
+            self._next_op += 1
+            self._pending_ops.setdefault((entity, id), []).append(
+                (op, [*set, *unset], self._clock()))
+        self._send_patch(entity, id, set, unset, op)
+
+    def on_token_temp_position_changed(self, token_id, position):
+        self.movement.push(token_id, position)
+
+    def on_page_changed(self, players_page):
+        if not self.is_master: return
+        print('on_page_changed', players_page)
+        page = self.campaign.pages[players_page]
+        for session in self.api_server.sessions:
+            if self.api_server.set_player_page(session.address, players_page):
+                self.api_server.send({
+                    'method': 'page_snapshot',
+                    'params': page.snapshot(exclude=self._withheld)
+                }, session.address)
+        notification = {
+            'method': 'page_changed',
+            'params': {
+                'players_page': players_page
+            }
+        }
+        self._broadcast(notification)
+
+    def on_veils_patched(self, page_id, version, changed, removed):
+        print('on_veils_patched, page', page_id)
+        if self.is_master:
+            # Before the veils, so that the tokens don't flash at their old
+            # positions.
+            self._reveal(self.campaign.pages[page_id])
+        notification = {
+            'method': 'veils_patch',
+            'params': {
+                'page_id': page_id,
+                'version': version,
+                'veils': changed,
+                'removed': removed
+            }
+        }
+        self._broadcast(notification, page=page_id)
+
+    def on_new_chat(self, message):
+        if not self.is_master: return
+        print('on_new_chat', message)
+        notification = {
+            'method': 'new_chat',
+            'params': {'message': message}
+        }
+        self._broadcast(notification)
@@ -0,0 +1,161 @@
+"""Compression and fragmentation of large datagrams.
+
+This layer sits between the encoding of the messages (`wire`) and the socket,
+below the reliability layer: a reliable message is compressed once, and the
+same fragments are retransmitted until the whole message is acknowledged.
+
+* Encoded messages longer than `COMPRESS_THRESHOLD` are compressed with zlib
+  and sent as a frame that starts with `COMPRESSED`, if that makes them
+  shorter.
+* Frames longer than `MAX_DATAGRAM` are split into fragments that start with
+  `FRAGMENT`, followed by the CRC-32 of the whole frame, which identifies the
+  frame, the index of the fragment and the number of fragments. Since the
+  retransmissions are byte-identical, fragments lost in one transmission can
+  be filled in by the next one.
+
+The marker bytes differ from the first bytes of JSON and of `wire.MAGIC`, so
+plain datagrams pass through unchanged. Only peers that have negotiated a
+binary wire encoding are sent compressed or fragmented frames. The peers
+that haven't are older versions that understand neither, so large messages
+to them go out as single datagrams, which rely on IP fragmentation and are
+limited to 64 KB.
+"""
+
+import struct
+import time
+import zlib
+
+COMPRESSED = 0xb6
+FRAGMENT = 0xb7
+
+COMPRESS_THRESHOLD = 512
+# Fits into the minimum IPv6 MTU of 1280 bytes with the IPv6 and UDP headers.
+MAX_DATAGRAM = 1200
+# Limit on the decompressed and on the reassembled size of a message.
+MAX_MESSAGE_SIZE = 4 * 1024 * 1024
+# Partially received messages are dropped after this many seconds.
+REASSEMBLY_TIMEOUT = 5.0
+MAX_PARTIAL_MESSAGES = 64
+
+_FRAGMENT_HEADER = struct.Struct('<BIHH')
+FRAGMENT_PAYLOAD = MAX_DATAGRAM - _FRAGMENT_HEADER.size
+MAX_FRAGMENTS = MAX_MESSAGE_SIZE // FRAGMENT_PAYLOAD + 1
+
+
+class FrameError(Exception):
+    pass
+
+
+def compress(data: bytes) -> bytes:
+    """Compresses the frame if it is large and compresses well."""
+    if len(data) <= COMPRESS_THRESHOLD:
+        return data
+    compressed = bytes([COMPRESSED]) + zlib.compress(data)
+    if len(compressed) >= len(data):
+        return data
+    return compressed
+
+
+def decompress(data: bytes) -> bytes:
+    if not data or data[0] != COMPRESSED:
+        return data
+    decompressor = zlib.decompressobj()
+    try:
+        result = decompressor.decompress(data[1:], MAX_MESSAGE_SIZE)
+    except zlib.error as e:
+        raise FrameError(str(e)) from e
+    if decompressor.unconsumed_tail:
+        raise FrameError('Decompressed message is too large')
+    return result
+
+
+def fragment(data: bytes) -> list:
+    """Splits a frame into datagrams of at most `MAX_DATAGRAM` bytes."""
+    if len(data) <= MAX_DATAGRAM:
+        return [data]
+    frame_id = zlib.crc32(data)
+    count = (len(data) + FRAGMENT_PAYLOAD - 1) // FRAGMENT_PAYLOAD
+    assert count <= MAX_FRAGMENTS
+    return [
+        _FRAGMENT_HEADER.pack(FRAGMENT, frame_id, i, count) +
+        data[i * FRAGMENT_PAYLOAD:(i + 1) * FRAGMENT_PAYLOAD]
+        for i in range(count)
+    ]
+
+
+class _Partial(object):
+    def __init__(self, count, now):
+        self.count = count
+        self.chunks = {}
+        self.started = now
+
+
+class Reassembler(object):
+    """Collects the fragments of the frames received from all the peers."""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        # Partially received frames by (address, frame ID), oldest first.
+        self._partial = {}
+        # Recently reassembled frames. Their retransmissions, which mean that
+        # the acknowledgement was lost, are passed on as soon as the first
+        # fragment arrives, so that the reliability layer acknowledges them
+        # again.
+        self._completed = {}
+
+        self.reassembled = 0
+        self.failed = 0
+
+    def receive(self, address, data: bytes):
+        """Processes a datagram.
+
+        Returns the complete frame, or None if more fragments are needed.
+        """
+        if not data or data[0] != FRAGMENT:
+            return data
+        try:
+            _, frame_id, index, count = _FRAGMENT_HEADER.unpack_from(data)
+        except struct.error as e:
+            raise FrameError(str(e)) from e
+        if not 0 < count <= MAX_FRAGMENTS or index >= count:
+            raise FrameError('Invalid fragment {}/{}'.format(index, count))
+        key = (address, frame_id)
+        if key in self._completed:
+            return self._completed[key][1] if index == 0 else None
+        partial = self._partial.get(key)
+        if partial is None:
+            if len(self._partial) >= MAX_PARTIAL_MESSAGES:
+                del self._partial[next(iter(self._partial))]
+                self.failed += 1
+            partial = self._partial[key] = _Partial(count, self._clock())
+        elif partial.count != count:
+            raise FrameError('Fragment count mismatch')
+        partial.chunks[index] = data[_FRAGMENT_HEADER.size:]
+        if len(partial.chunks) < count:
+            return None
+
+        del self._partial[key]
+        frame = b''.join(partial.chunks[i] for i in range(count))
+        if zlib.crc32(frame) != frame_id:
+            self.failed += 1
+            raise FrameError('Checksum mismatch')
+        if len(self._completed) >= MAX_PARTIAL_MESSAGES:
+            del self._completed[next(iter(self._completed))]
+        self._completed[key] = (self._clock(), frame)
+        self.reassembled += 1
+        return frame
+
+    def expire(self):
+        """Drops the frames that haven't been completed in time."""
+        deadline = self._clock() - REASSEMBLY_TIMEOUT
+        for key, partial in list(self._partial.items()):
+            if partial.started < deadline:
+                del self._partial[key]
+                self.failed += 1
+        for key, (completed, _) in list(self._completed.items()):
+            if completed < deadline:
+                del self._completed[key]
+
+    @property
+    def pending(self) -> int:
+        return len(self._partial)
@@ -58,12 +58,15 @@ class HealthText(ui.Text):
 class HealthBar(ui.VStackLayout):
     def __init__(self, focus_manager, get_char, padding=8, **kwargs):
         self._editing = False
+        self._get_char = get_char
         self.hp_input = ui.TextInput(focus_manager, min_width=40, font_size=20, flex_width=0,
                                 form_background=colors.GREY_900,
                                 get_hidden=self.is_not_editing)
         self.maxhp_input = ui.TextInput(focus_manager, min_width=40, font_size=20, flex_width=0,
                                  form_background=colors.GREY_900,
                                  get_hidden=self.is_not_editing)
+        self.hp_input.on_return = self.commit
+        self.maxhp_input.on_return = self.commit
         self.health_text = HealthText(get_char, is_editing=self.is_editing)
         self.text_hstack = ui.HStackLayout(
                     ui.Spacer(),
@@ -83,7 +86,12 @@ class HealthBar(ui.VStackLayout):
             ), min_height=50, flex_height=False, **kwargs)
 
     def on_mouse_press(self, *args):
+        char = self._get_char()
+        if char is None:
+            return
         self._editing = True
+        self.hp_input.document.text = str(char.hp)
+        self.maxhp_input.document.text = str(char.maxhp)
         print(self.hp_input.min_width)
         self.hp_input._update_dims()
         self.maxhp_input._update_dims()
@@ -91,6 +99,18 @@ class HealthBar(ui.VStackLayout):
         self.hp_input.focus()
         # self.text_hstack._resize(debug=True)
 
+    def commit(self):
+        """Applies the edited hit points, which are sent as a patch."""
+        self._editing = False
+        char = self._get_char()
+        try:
+            hp = int(self.hp_input.document.text)
+            maxhp = int(self.maxhp_input.document.text)
+        except ValueError:
+            return
+        if char is not None and maxhp > 0:
+            char.set_hp(min(hp, maxhp), maxhp)
+
     def is_editing(self):
         return self._editing
 
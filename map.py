@@ -189,7 +189,10 @@ class Map(ui.View):
     def _draw_token(self, token):
         gl.glEnable(gl.GL_BLEND)
         gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
-        x, y = token.temp_position
+        if token is self.state.dragged_token:
+            x, y = token.temp_position
+        else:
+            x, y = token.render_position
         w, h = token.fragment.size
 
         x0, y0 = self.map_to_screen(x, y)
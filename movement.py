@@ -0,0 +1,166 @@
+"""Transient token movement: the rate-limited channel that sends it, and the
+interpolation of the received positions."""
+
+import collections
+import time
+
+import pyglet
+
+# The receivers interpolate between the samples, so the positions don't have
+# to be sent at the frame rate.
+DEFAULT_RATE = 15
+# The remote movement is rendered this far in the past, so that there usually
+# is a sample after the rendered moment to interpolate to. About 1.5 send
+# intervals.
+INTERPOLATION_DELAY = 0.1
+# How far the movement can be extrapolated past the last sample when the
+# next one is late.
+MAX_EXTRAPOLATION = 0.1
+# A pause in the samples this long starts a new track.
+TRACK_TIMEOUT = 1.0
+MAX_SAMPLES = 16
+
+
+def timestamp(clock=time.monotonic) -> int:
+    """Returns the time of a sample in the wire format: milliseconds,
+    modulo 2**32."""
+    return int(clock() * 1000) % 2**32
+
+
+class MovementChannel(object):
+    """Collapses temporary token positions and sends them at a fixed rate.
+
+    Dragging a token produces a temporary position on every mouse event. The
+    channel keeps only the latest pending position for every token and sends
+    them all once per tick. Final positions are never delayed: `commit()` drops
+    the pending temporary position of the token, so that a stale preview can't
+    arrive after the committed `update_token`.
+    """
+
+    def __init__(self, send, rate=DEFAULT_RATE, clock=time.monotonic):
+        """Creates the channel.
+
+        Args:
+            send: function that is called with each outgoing notification and
+              the ID of the token.
+            rate: number of flushes per second.
+            clock: the clock of the timestamps of the positions.
+        """
+        self._send = send
+        self._pending = {}
+        self._clock = clock
+        self.rate = rate
+        pyglet.clock.schedule_interval(self.flush, 1 / rate)
+
+    def push(self, token_id, position, t=None):
+        """Queues a temporary position.
+
+        Args:
+            token_id: the ID of the token.
+            position: the position.
+            t: the timestamp of the position, if it is relayed from another
+              peer. Local positions are stamped with the current time.
+        """
+        if t is None:
+            t = timestamp(self._clock)
+        self._pending[token_id] = (position, t)
+
+    def commit(self, token_id):
+        self._pending.pop(token_id, None)
+
+    def flush(self, dt=None):
+        pending = self._pending
+        self._pending = {}
+        for token_id, (position, t) in pending.items():
+            self._send({
+                'method': 'token_temp_position_changed',
+                'params': {
+                    'token_id': token_id,
+                    'position': position,
+                    't': t
+                }
+            }, token_id)
+
+    def close(self):
+        pyglet.clock.unschedule(self.flush)
+
+
+class MotionTrack(object):
+    """Smooth rendering of a token that is moved by another peer.
+
+    The positions arrive with the timestamps of the sender, whose clock is
+    unrelated to ours. The offset between the clocks is estimated from the
+    fastest sample, and the track is rendered `INTERPOLATION_DELAY` behind
+    the sender: between two samples the position is interpolated, after the
+    last one it is extrapolated for up to `MAX_EXTRAPOLATION` and then
+    returns to the last sample.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        # Pairs (sender time in seconds, (x, y)).
+        self._samples = collections.deque(maxlen=MAX_SAMPLES)
+        self._last_raw = None
+        self._last_arrival = None
+        self._offset = None
+
+    def reset(self):
+        self._samples.clear()
+        self._last_raw = None
+        self._offset = None
+
+    @property
+    def active(self) -> bool:
+        return bool(self._samples)
+
+    def add(self, x, y, t=None):
+        """Adds a sample with the sender's timestamp `t` in milliseconds."""
+        now = self._clock()
+        if t is None:
+            t = timestamp(self._clock)
+        if (self._last_arrival is not None and
+            now - self._last_arrival > TRACK_TIMEOUT):
+            self.reset()
+        self._last_arrival = now
+
+        if self._last_raw is None:
+            sender_time = t / 1000
+        else:
+            # The timestamps wrap around.
+            delta = (t - self._last_raw) % 2**32
+            if delta >= 2**31:
+                # Reordered or duplicate sample.
+                return
+            sender_time = self._samples[-1][0] + delta / 1000
+            if delta == 0:
+                self._samples[-1] = (sender_time, (x, y))
+                return
+        self._last_raw = t
+        offset = now - sender_time
+        if self._offset is None or offset < self._offset:
+            self._offset = offset
+        self._samples.append((sender_time, (x, y)))
+
+    def position(self):
+        """Returns the position to render now, or None without samples."""
+        samples = self._samples
+        if not samples:
+            return None
+        t = self._clock() - self._offset - INTERPOLATION_DELAY
+        if t <= samples[0][0] or len(samples) == 1:
+            return samples[0][1] if t <= samples[0][0] else samples[-1][1]
+        for i in range(len(samples) - 1, 0, -1):
+            t0, (x0, y0) = samples[i - 1]
+            t1, (x1, y1) = samples[i]
+            if t0 <= t:
+                break
+        if t <= t1:
+            k = (t - t0) / (t1 - t0)
+        else:
+            # Extrapolate with the last velocity, then return to the last
+            # sample if the movement has stopped.
+            late = t - t1
+            if late > MAX_EXTRAPOLATION:
+                late = max(0, 2 * MAX_EXTRAPOLATION - late)
+            k = 1 + late / (t1 - t0)
+        return x0 + (x1 - x0) * k, y0 + (y1 - y0) * k
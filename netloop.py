@@ -0,0 +1,84 @@
+"""The network thread.
+
+All the network endpoints (the UDP API and the HTTP resource server) run in a
+single asyncio event loop in a separate thread. The results are passed to the
+pyglet event loop through `Bridge`.
+"""
+
+import asyncio
+import threading
+
+import pyglet
+
+
+class Bridge(pyglet.event.EventDispatcher):
+    """Passes events from the network thread to the pyglet loop in batches.
+
+    Events posted while the pyglet loop is busy are accumulated and dispatched
+    together, so that a burst of datagrams wakes up the main thread only once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = []
+        self._platform_event_loop = pyglet.app.platform_event_loop
+
+    def post(self, dispatcher, event, *args):
+        """Posts an event to be dispatched by `dispatcher` in the main thread.
+
+        Can be called from any thread.
+        """
+        with self._lock:
+            self._events.append((dispatcher, event, args))
+            first = len(self._events) == 1
+        if first:
+            self._platform_event_loop.post_event(self, 'on_batch')
+
+    def on_batch(self):
+        with self._lock:
+            events = self._events
+            self._events = []
+        for dispatcher, event, args in events:
+            dispatcher.dispatch_event(event, *args)
+
+
+Bridge.register_event_type('on_batch')
+
+
+class NetworkLoop(threading.Thread):
+    """Runs the asyncio event loop that hosts the network endpoints."""
+
+    def __init__(self):
+        super().__init__(name='NetworkLoop', daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self.bridge = Bridge()
+        self.start()
+
+    def run(self):
+        print('Starting the network loop')
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        print('Stopped the network loop')
+        # The tasks that are still running, like the ones cancelled on the
+        # shutdown of the endpoints, are let to finish.
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        self.loop.close()
+
+    def call_soon(self, callback, *args):
+        """Schedules a callback in the network thread.
+
+        Can be called from any thread.
+        """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def run_coroutine(self, coro):
+        """Runs a coroutine in the network thread and waits for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,150 @@
+"""Simulation of a bad network for local testing.
+
+`ImpairedTransport` wraps the datagram transport of `apiserver.ApiServer` and
+impairs the outgoing datagrams: drops, delays, duplicates and reorders them,
+and limits the bandwidth. Only the outgoing traffic is impaired, so with every
+endpoint impaired both directions are affected.
+
+A stream transport is impaired losslessly: its frames are only delayed and
+limited by the bandwidth, like over TCP, which retransmits what the network
+loses.
+"""
+
+import random
+
+# Extra delay of the reordered datagrams, on top of the normal delay.
+REORDER_DELAY = 0.05
+# Datagrams that would wait longer than this for the bandwidth are dropped,
+# like in a router with a full queue.
+MAX_QUEUE_DELAY = 1.0
+
+
+class Impairment(object):
+    """Parameters of the simulated network.
+
+    Args:
+        loss: probability that a datagram is dropped.
+        delay: one-way delay in seconds.
+        jitter: maximum random delay in seconds added to `delay`.
+        duplicate: probability that a datagram is sent twice.
+        reorder: probability that a datagram is held back for
+          `REORDER_DELAY`, so that the following ones overtake it.
+        bandwidth: bytes per second, or None for no limit.
+        seed: seed of the random number generator.
+    """
+
+    FIELDS = ('loss', 'delay', 'jitter', 'duplicate', 'reorder', 'bandwidth',
+              'seed')
+
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, duplicate=0.0,
+                 reorder=0.0, bandwidth=None, seed=None):
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.bandwidth = bandwidth
+        self.seed = seed
+
+    @classmethod
+    def parse(cls, spec):
+        """Parses a specification like 'loss=0.05,delay=0.04,jitter=0.01'."""
+        kwargs = {}
+        for item in spec.split(','):
+            if not item.strip():
+                continue
+            name, _, value = item.partition('=')
+            name = name.strip()
+            if name not in cls.FIELDS:
+                raise ValueError('Unknown impairment: {}'.format(name))
+            kwargs[name] = int(value) if name == 'seed' else float(value)
+        return cls(**kwargs)
+
+    def __repr__(self):
+        return 'Impairment({})'.format(', '.join(
+            '{}={}'.format(name, getattr(self, name)) for name in self.FIELDS))
+
+
+class ImpairedTransport(object):
+    """A datagram transport that impairs the outgoing datagrams.
+
+    Used in the network thread only.
+    """
+
+    def __init__(self, transport, loop, impairment, lossless=False):
+        self._transport = transport
+        self._loop = loop
+        self.impairment = impairment
+        # Whether the datagrams are only delayed, in order.
+        self.lossless = lossless
+        self._random = random.Random(impairment.seed)
+        # Time when the simulated link finishes sending the queued datagrams.
+        self._link_free = 0.0
+
+        self.sent = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+
+    def _delay(self, size):
+        """Returns the delay of a datagram, or None if it is dropped."""
+        impairment = self.impairment
+        if self.lossless:
+            # Without jitter, so that the frames stay in order.
+            delay = impairment.delay
+        else:
+            delay = impairment.delay + self._random.uniform(
+                0, impairment.jitter)
+            if self._random.random() < impairment.reorder:
+                delay += REORDER_DELAY
+                self.reordered += 1
+        if impairment.bandwidth:
+            now = self._loop.time()
+            start = max(now, self._link_free)
+            if start - now > MAX_QUEUE_DELAY and not self.lossless:
+                return None
+            self._link_free = start + size / impairment.bandwidth
+            delay += self._link_free - now
+        return delay
+
+    def sendto(self, data, address=None):
+        copies = 1
+        if (not self.lossless and
+            self._random.random() < self.impairment.duplicate):
+            copies = 2
+            self.duplicated += 1
+        for _ in range(copies):
+            if (not self.lossless and
+                self._random.random() < self.impairment.loss):
+                self.dropped += 1
+                continue
+            delay = self._delay(len(data))
+            if delay is None:
+                self.dropped += 1
+                continue
+            self.sent += 1
+            if delay > 0:
+                self._loop.call_later(delay, self._send, data, address)
+            else:
+                self._transport.sendto(data, address)
+
+    def _send(self, data, address):
+        if not self._transport.is_closing():
+            self._transport.sendto(data, address)
+
+    def stats(self) -> dict:
+        return {
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'duplicated': self.duplicated,
+            'reordered': self.reordered,
+        }
+
+    def is_closing(self):
+        return self._transport.is_closing()
+
+    def close(self):
+        self._transport.close()
+
+    def get_extra_info(self, name, default=None):
+        return self._transport.get_extra_info(name, default)
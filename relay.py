@@ -0,0 +1,183 @@
+"""Placement of the spectators in a relay tree.
+
+The master sends every change to every peer that it has a session with, so
+its upstream would grow with the audience. The spectators only receive the
+stream of changes, so they don't have to be connected to the master: any
+client that has room for them can forward what it receives from its own
+upstream to a bounded number of children.
+
+The master keeps the shape of the tree. A joining spectator says `hi` to the
+master, which either keeps it, if it has a free spectator slot, or sends it
+to the shallowest relay with a free slot. When a relay drops, its children
+notice that their upstream is gone and join the master again, which places
+them elsewhere together with their own subtrees.
+"""
+
+# Spectators connected directly to the master.
+MASTER_SLOTS = 2
+# The number of children that a client relays to by default.
+RELAY_FANOUT = 4
+
+
+class _Node(object):
+    __slots__ = ('name', 'address', 'capacity', 'spectator', 'parent',
+                 'children', 'attached')
+
+    def __init__(self, name, address, capacity, spectator):
+        self.name = name
+        self.address = address
+        self.capacity = capacity
+        self.spectator = spectator
+        # None if the node is connected to the master.
+        self.parent = None
+        self.children = []
+        # False while an orphaned spectator looks for a new parent.
+        self.attached = True
+
+
+class RelayTree(object):
+    """The tree of the clients that relay the changes, kept by the master.
+
+    The nodes are the players, which are always connected to the master, and
+    the spectators. Every node accepts up to its capacity of children.
+    """
+
+    def __init__(self, master_slots=MASTER_SLOTS):
+        self.master_slots = master_slots
+        self._nodes = {}
+
+    def add_player(self, name, address, capacity=0):
+        """Adds a player that can relay to `capacity` spectators."""
+        node = self._nodes.get(name)
+        if node is not None and node.spectator:
+            self.leave(name)
+            node = None
+        if node is None:
+            node = self._nodes[name] = _Node(name, address, capacity, False)
+        node.address = address
+        node.capacity = capacity
+        self._detach(node)
+        node.attached = True
+
+    def place(self, name, address, capacity=0):
+        """Places a joining spectator in the tree.
+
+        A spectator that joins again is moved together with its subtree.
+
+        Args:
+            name: the name of the spectator.
+            address: the address that the other clients reach it at.
+            capacity: the number of children that it can relay to.
+
+        Returns the address of the parent, or None for the master.
+        """
+        node = self._nodes.get(name)
+        if node is None or not node.spectator:
+            node = self._nodes[name] = _Node(name, address, capacity, True)
+        node.address = address
+        node.capacity = capacity
+        self._detach(node)
+        parent = self._find_parent(node)
+        node.parent = parent
+        node.attached = True
+        if parent is None:
+            return None
+        parent.children.append(node)
+        return parent.address
+
+    def leave(self, name) -> list:
+        """Removes a node that has disconnected.
+
+        Returns the names of its children, which have to join again.
+        """
+        node = self._nodes.pop(name, None)
+        if node is None:
+            return []
+        self._detach(node)
+        orphans = node.children
+        node.children = []
+        for child in orphans:
+            child.parent = None
+            child.attached = False
+        return [child.name for child in orphans]
+
+    def disable(self, name):
+        """Stops placing new children under a node that can't be reached."""
+        node = self._nodes.get(name)
+        if node is not None:
+            node.capacity = 0
+
+    def parent(self, name):
+        """Returns the name of the parent of a node, or None for the master.
+
+        Raises KeyError if the node is not in the tree.
+        """
+        parent = self._nodes[name].parent
+        return None if parent is None else parent.name
+
+    def ancestors(self, name) -> list:
+        """Returns the names of the relays between the node and the master.
+
+        Raises KeyError if the node is not in the tree.
+        """
+        names = []
+        node = self._nodes[name].parent
+        while node is not None:
+            names.append(node.name)
+            node = node.parent
+        return names
+
+    def depth(self, name) -> int:
+        """Returns the number of relays between the master and the node."""
+        node = self._nodes[name]
+        depth = 0
+        while node.parent is not None:
+            node = node.parent
+            depth += 1
+        return depth
+
+    def master_spectators(self) -> int:
+        return sum(1 for node in self._nodes.values()
+                   if node.spectator and node.attached and node.parent is None)
+
+    def __contains__(self, name):
+        return name in self._nodes
+
+    def _detach(self, node):
+        if node.parent is not None:
+            node.parent.children.remove(node)
+            node.parent = None
+
+    def _subtree(self, node) -> set:
+        nodes = {node}
+        stack = [node]
+        while stack:
+            for child in stack.pop().children:
+                nodes.add(child)
+                stack.append(child)
+        return nodes
+
+    def _find_parent(self, node):
+        """Returns the least loaded relay on the shallowest level with room.
+
+        The node's own subtree is skipped, so that it doesn't become its own
+        descendant. If no relay has room, the master takes the node anyway.
+        """
+        if self._master_has_room(node):
+            return None
+        excluded = self._subtree(node)
+        level = [n for n in self._nodes.values()
+                 if n.parent is None and n.attached and n not in excluded]
+        while level:
+            free = [n for n in level if len(n.children) < n.capacity]
+            if free:
+                return min(free, key=lambda n: len(n.children))
+            level = [child for n in level for child in n.children
+                     if child not in excluded]
+        return None
+
+    def _master_has_room(self, node) -> bool:
+        taken = sum(1 for n in self._nodes.values()
+                    if n is not node and n.spectator and n.attached and
+                    n.parent is None)
+        return taken < self.master_slots
@@ -0,0 +1,182 @@
+"""Reliable ordered delivery of the API messages over UDP.
+
+Every message, except for the ones in `UNRELIABLE_METHODS`, gets a sequence
+number in the field `seq`. The receiver delivers messages in the order of
+their sequence numbers, drops duplicates and reports what it has received in
+the fields `ack` (all messages up to this one have been received) and `sack`
+(messages received after a gap). The acknowledgements are attached to the
+outgoing reliable messages, or sent in separate `ack` messages if there is
+nothing else to send. The sender retransmits the messages that haven't been
+acknowledged within the retransmission timeout (with the acknowledgements that
+were current when the message was first sent), which is computed from the
+measured round trip time like in TCP (RFC 6298).
+
+Unreliable messages are delivered as soon as they arrive and are never
+retransmitted: only the latest temporary position of a token matters.
+
+A message that is still not acknowledged after `MAX_RETRANSMITS` is given up
+on. The receiver would wait for it forever, so the channel is marked as
+failed, and the session has to be replaced.
+
+Over a stream nothing is lost, so the sender doesn't keep the messages and
+never retransmits them. The round trip time is then only measured with pings.
+The sequence numbers still order the messages that the receiver holds back.
+"""
+
+import time
+
+UNRELIABLE_METHODS = {
+    'ack', 'ping', 'pong', 'reconnect', 'token_temp_position_changed'
+}
+
+INITIAL_RTO = 0.5
+MIN_RTO = 0.05
+MAX_RTO = 5.0
+MAX_RETRANSMITS = 10
+# Messages this far ahead of the first missing one are dropped instead of
+# being buffered.
+WINDOW = 1024
+MAX_SACK = 32
+
+
+def is_reliable(message: dict) -> bool:
+    return message['method'] not in UNRELIABLE_METHODS
+
+
+class _Pending(object):
+    def __init__(self, data, now, rto):
+        self.data = data
+        self.sent_at = now
+        self.rto = rto
+        self.retransmits = 0
+
+
+class ReliablePeer(object):
+    """The state of the reliable channel with a single peer."""
+
+    def __init__(self, clock=time.monotonic, retransmit=True):
+        self._clock = clock
+        self._retransmit = retransmit
+        self._next_seq = 1
+        self._unacked = {}
+        # All the messages up to this one have been delivered.
+        self._received = 0
+        self._out_of_order = {}
+        self._ack_pending = False
+
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+
+        self.retransmits = 0
+        self.duplicates = 0
+        self.lost = 0
+        # Set when a message is lost, after which nothing more can be
+        # delivered in order.
+        self.failed = False
+
+    def _attach_ack(self, message):
+        message['ack'] = self._received
+        if self._out_of_order:
+            message['sack'] = sorted(self._out_of_order)[:MAX_SACK]
+        else:
+            message.pop('sack', None)
+        self._ack_pending = False
+
+    def prepare(self, message: dict, encode) -> bytes:
+        """Adds the reliability fields to the message and encodes it.
+
+        The encoded message is kept until it is acknowledged, and is
+        retransmitted as is. This way the retransmissions don't depend on the
+        objects that were referenced by the message.
+
+        Args:
+            message: the message to be sent.
+            encode: function that converts a message into a datagram.
+        """
+        if not is_reliable(message):
+            return encode(message)
+        message = dict(message, seq=self._next_seq)
+        self._attach_ack(message)
+        data = encode(message)
+        if self._retransmit:
+            self._unacked[self._next_seq] = _Pending(data, self._clock(),
+                                                     self.rto)
+        self._next_seq += 1
+        return data
+
+    def _update_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def _on_ack(self, ack, sack):
+        now = self._clock()
+        sack = set(sack)
+        for seq in list(self._unacked):
+            if seq <= ack or seq in sack:
+                pending = self._unacked.pop(seq)
+                # Karn's algorithm: the RTT of retransmitted messages is
+                # ambiguous.
+                if pending.retransmits == 0:
+                    self._update_rtt(now - pending.sent_at)
+
+    def receive(self, message: dict) -> list:
+        """Processes an incoming message.
+
+        Returns the list of messages that are ready to be delivered, in order.
+        """
+        if 'ack' in message:
+            self._on_ack(message.pop('ack'), message.pop('sack', ()))
+        if message['method'] == 'ack':
+            return []
+        seq = message.pop('seq', None)
+        if seq is None:
+            return [message]
+
+        self._ack_pending = True
+        if (seq <= self._received or seq in self._out_of_order or
+            seq > self._received + WINDOW):
+            self.duplicates += 1
+            return []
+        self._out_of_order[seq] = message
+        delivered = []
+        while self._received + 1 in self._out_of_order:
+            self._received += 1
+            delivered.append(self._out_of_order.pop(self._received))
+        return delivered
+
+    def due(self, encode) -> list:
+        """Returns the datagrams that have to be (re)sent now.
+
+        These are the messages whose retransmission timeout has expired, and
+        possibly a standalone acknowledgement.
+        """
+        now = self._clock()
+        messages = []
+        for seq, pending in list(self._unacked.items()):
+            if now - pending.sent_at < pending.rto:
+                continue
+            if pending.retransmits >= MAX_RETRANSMITS:
+                del self._unacked[seq]
+                self.lost += 1
+                self.failed = True
+                continue
+            pending.retransmits += 1
+            pending.sent_at = now
+            pending.rto = min(MAX_RTO, 2 * pending.rto)
+            self.retransmits += 1
+            messages.append(pending.data)
+        if self._ack_pending:
+            ack = {'method': 'ack'}
+            self._attach_ack(ack)
+            messages.append(encode(ack))
+        return messages
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._unacked)
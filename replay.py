@@ -0,0 +1,154 @@
+"""Replays a recorded API trace against a headless controller.
+
+Usage:
+    python replay.py <trace> [--campaign DIR] [--player NAME] [--fast]
+
+The inbound messages of the trace are dispatched to a `Controller` without a
+window, either at the recorded pace or as fast as possible, and the time it
+takes to process them is reported for each method. The latency of a message
+is the time from its recorded arrival (or, with --fast, from the moment it is
+taken from the trace) until its handler returns, so at the recorded pace it
+includes the time spent waiting behind slow messages.
+
+The outbound messages are encoded but not sent anywhere. Use a copy of the
+campaign that the trace was recorded with: the campaign is never saved, but
+the trace is only meaningful against the same initial state.
+"""
+
+import argparse
+import collections
+import time
+
+import pyglet
+
+import apiserver
+import apitrace
+from campaign import Campaign
+from controller import Controller
+import relay
+import seer
+from state import State
+import wire
+
+# Transport-level messages that don't reach the controller.
+SKIPPED_METHODS = {'ack', 'ping', 'pong', 'reconnect'}
+
+
+class ReplayApiServer(apiserver.ApiEndpoint):
+    """Stands in for `ApiServer` and encodes the outbound messages.
+
+    The sessions and the routing are those of `ApiServer`. Only the transport
+    is missing.
+    """
+
+    def __init__(self, master=None):
+        super().__init__(master, relay_fanout=relay.RELAY_FANOUT)
+        self.sent = 0
+        self.bytes_sent = 0
+
+    def received(self, request, address):
+        """Opens the session of a peer that says `hi`."""
+        with self._lock:
+            self._open_session(request, address)
+
+    def _queue(self, request, session, data):
+        if data is None:
+            data = wire.encode(request, session.wire_version)
+        self.sent += 1
+        self.bytes_sent += len(data)
+
+    def relay_to(self, parent):
+        self.sessions.connect(None, tuple(parent))
+        self.master = tuple(parent)
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of sorted values (nearest rank)."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def replay(records, controller, fast=False, clock=time.perf_counter):
+    """Dispatches the inbound messages of the trace to the controller.
+
+    Returns a dict with the number of processed messages, the elapsed time
+    and the sorted latencies of every method.
+    """
+    api_server = controller.api_server
+    latencies = collections.defaultdict(list)
+    count = 0
+    start = clock()
+    for record in records:
+        if record['dir'] != apitrace.IN:
+            continue
+        request = record['message']
+        if request['method'] in SKIPPED_METHODS:
+            continue
+        if fast:
+            arrival = clock()
+        else:
+            arrival = start + record['t']
+            delay = arrival - clock()
+            if delay > 0:
+                time.sleep(delay)
+        # Flushes the movement channel and other scheduled work.
+        pyglet.clock.tick()
+        api_server.received(request, record['peer'])
+        api_server.dispatch_event('on_api_request', request, record['peer'])
+        latencies[request['method']].append(clock() - arrival)
+        count += 1
+    elapsed = clock() - start
+    for values in latencies.values():
+        values.sort()
+    return {'count': count, 'elapsed': elapsed, 'latencies': latencies}
+
+
+def print_report(result, api_server):
+    elapsed = result['elapsed']
+    print('Processed {} messages in {:.3f} s, {:.0f} messages/s'.format(
+        result['count'], elapsed,
+        result['count'] / elapsed if elapsed > 0 else 0))
+    print('Sent {} messages, {} bytes'.format(
+        api_server.sent, api_server.bytes_sent))
+    print('{:30} {:>7} {:>9} {:>9} {:>9}'.format(
+        'method', 'count', 'p50, ms', 'p90, ms', 'p99, ms'))
+    for method, values in sorted(result['latencies'].items()):
+        print('{:30} {:>7} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+            method, len(values), *(percentile(values, p) * 1000
+                                   for p in (50, 90, 99))))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replays a recorded API trace.')
+    parser.add_argument('trace')
+    parser.add_argument('--campaign', default='campaign',
+                        help='campaign directory (default: %(default)s)')
+    parser.add_argument('--player',
+                        help='replay as this player instead of the master')
+    parser.add_argument('--fast', action='store_true',
+                        help="don't wait between the messages")
+    args = parser.parse_args()
+
+    records = apitrace.read_trace(args.trace)
+    master = None
+    if args.player is not None:
+        inbound = [r for r in records if r['dir'] == apitrace.IN]
+        master = inbound[0]['peer'] if inbound else ('::1', 0)
+
+    resource_provider = seer.LocalResourceProvider(args.campaign)
+    resource_provider.can_save = False
+    campaign = Campaign(resource_provider)
+    state = State(campaign, args.player)
+    api_server = ReplayApiServer(master)
+    controller = Controller(state, api_server)
+
+    result = replay(records, controller, fast=args.fast)
+    controller.movement.close()
+    print_report(result, api_server)
+
+
+if __name__ == '__main__':
+    main()
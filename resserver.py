@@ -1,65 +1,423 @@
-import http.server
+import asyncio
+import concurrent.futures
+import gzip
+import hashlib
 from http import HTTPStatus
 import json
-import pyglet
-import queue
+import mimetypes
+import os.path
 import socket
-import socketserver
-import threading
+import urllib.parse
 
 PORT = 2215
+# Time to wait for the client to send the request headers.
+REQUEST_TIMEOUT = 30
+# Time to wait for the next request on a kept-alive connection, and the
+# number of requests served on a single connection.
+KEEP_ALIVE_TIMEOUT = 15
+MAX_KEEP_ALIVE_REQUESTS = 100
+CHUNK_SIZE = 64 * 1024
+# Threads that read the files, so that the disk doesn't block the network
+# loop.
+WORKERS = 4
+# Files and directories of the campaign that are not assets.
+NOT_ASSETS = {'data.json', 'backups'}
+# How often the version of the campaign is checked to refresh the snapshot
+# of data.json.
+SNAPSHOT_INTERVAL = 1
+# The types of the files that are worth compressing. JPEG and the like are
+# compressed already.
+COMPRESSIBLE_TYPES = {
+    'application/json', 'image/bmp', 'image/png', 'image/svg+xml',
+    'text/css', 'text/html', 'text/plain',
+}
+# A compressed variant is only sent if it is at most this fraction of the
+# original size. PNGs are deflated already, but often with a poor setting.
+MAX_COMPRESSED_RATIO = 0.9
+GZIP_LEVEL = 6
 
 
-class RequestHandler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, request, client_address, server):
-        super().__init__(request, client_address, server, directory=server.dir)
+def compress(data):
+    """Returns the gzip variant of the data, or None if it isn't smaller."""
+    compressed = gzip.compress(data, GZIP_LEVEL, mtime=0)
+    if len(compressed) > len(data) * MAX_COMPRESSED_RATIO:
+        return None
+    return compressed
 
-    def do_GET(self):
-        print(self.path)
-        if self.path == '/data.json':
-            self.server.platform_event_loop.post_event(
-                self.server.dispatcher, 'on_request_data')
-            data = self.server.data_queue.get()
-            self.send_response(HTTPStatus.OK)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Content-Length', len(data))
-            self.end_headers()
-            self.wfile.write(data)
-        else:
-            super().do_GET()
 
+class HttpError(Exception):
+    def __init__(self, status: HTTPStatus):
+        super().__init__(status.phrase)
+        self.status = status
 
-class ResourceServerImpl(socketserver.TCPServer):
-    address_family = socket.AF_INET6
 
-    def __init__(self, dir, dispatcher, data_queue):
-        self.dir = dir
-        self.dispatcher = dispatcher
-        self.data_queue = data_queue
-        self.platform_event_loop = pyglet.app.platform_event_loop
-        super().__init__(('::', PORT), RequestHandler)
+class Snapshot(object):
+    """`data.json` serialized at a version of the campaign."""
 
+    def __init__(self, version, data):
+        self.version = version
+        self.data = data
+        self.gzipped = compress(data)
 
-class ResourceServer(threading.Thread, pyglet.event.EventDispatcher):
-    def __init__(self, campaign_dir, campaign):
+
+class ResourceServer(object):
+    """Serves the campaign data and resources to the players over HTTP.
+
+    Runs in the network loop, and serves the players concurrently: the files
+    are read by a bounded pool of threads, and are sent to every player as
+    fast as it receives them. The connections are kept alive between the
+    requests, as in HTTP/1.1, so that a joining player downloads all the
+    assets over a single connection. The files have strong ETags, the hashes
+    of their content, and are not sent again to the players that already
+    have them (`If-None-Match`). `/manifest` lists all the assets with their
+    sizes and hashes, so that the players can download them in parallel and
+    skip the ones that they have cached. The clients that accept gzip get
+    the compressible files compressed: the compressed variants of the static
+    files are kept until the files are modified.
+
+    `data.json` is served from a snapshot of the campaign that is serialized
+    by a worker thread whenever the version of the campaign changes, so the
+    requests never wait for the main thread, and all the players joining at
+    once share the same serialized data. The snapshot may be a moment behind
+    the campaign, but the players catch up with the changes after the
+    version in the snapshot through the API.
+    """
+
+    def __init__(self, campaign_dir, campaign, net, port=PORT,
+                 workers=WORKERS, get_data=None):
+        """Starts the server.
+
+        Args:
+            campaign_dir: the directory with the campaign.
+            campaign: the `campaign.Campaign` that is served as `data.json`.
+            net: `netloop.NetworkLoop` that runs the server.
+            port: the TCP port, or 0 for any free port.
+            workers: the number of threads that read the files.
+            get_data: returns the data of the campaign to serve, without
+              what the players may not see. Called in the worker threads.
+              Defaults to all the data.
+        """
+        self.dir = os.path.abspath(campaign_dir)
         self.campaign = campaign
-        self.data_queue = queue.Queue()
-        self.httpd = ResourceServerImpl(campaign_dir, self, self.data_queue)
-        super().__init__()
-        self.start()
+        self._get_data = get_data or (lambda: campaign._data)
+        self.net = net
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='ResourceServer')
+        # The content hashes of the files, by path, with the modification
+        # time and the size that they were computed for.
+        self._hashes = {}
+        # The gzip variants of the files, or None if they are not worth it,
+        # with the modification time and the size of the file.
+        self._gzipped = {}
+        # The tasks that serve the open connections, cancelled on shutdown.
+        self._tasks = set()
+        self._snapshot = None
+        # The pending serialization of the campaign, in the network thread.
+        self._refreshing = None
+        print('Starting ResourceServer on port', port)
+        self.server = net.run_coroutine(self._start(port))
+        net.call_soon(self._check_version)
+
+    async def _start(self, port):
+        return await asyncio.start_server(
+            self._handle, host='::', port=port, family=socket.AF_INET6)
 
-    def run(self):
-        print('Starting ResourceServer on port', PORT)
-        self.httpd.serve_forever()
-        print('Stopped ResourcesServer')
-        self.httpd.server_close()
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
 
     def shutdown(self):
-        self.httpd.shutdown()
+        self.net.call_soon(self._close)
+        print('Stopped ResourceServer')
+
+    def _close(self):
+        self.server.close()
+        # Their connections are closed as they finish.
+        for task in self._tasks:
+            task.cancel()
+        # After the server, so that it doesn't start new work.
+        self._executor.shutdown(wait=False)
+
+    @staticmethod
+    async def _readline(reader):
+        try:
+            return await reader.readline()
+        except (ValueError, asyncio.LimitOverrunError):
+            # Longer than the limit of the reader.
+            raise HttpError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+    async def _read_request(self, reader):
+        """Returns the method, the target, the version and the headers.
+
+        Returns None if the client has closed the connection instead.
+        """
+        request_line = await self._readline(reader)
+        if not request_line:
+            return None
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST)
+        headers = {}
+        while True:
+            line = await self._readline(reader)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return method, target, version, headers
+
+    @staticmethod
+    def _keep_alive(version, headers) -> bool:
+        """Checks whether the client wants the connection to be kept."""
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def _translate_path(self, target):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        path = os.path.normpath(os.path.join(self.dir, path.lstrip('/')))
+        if os.path.commonpath([self.dir, path]) != self.dir:
+            raise HttpError(HTTPStatus.FORBIDDEN)
+        if not os.path.isfile(path):
+            raise HttpError(HTTPStatus.NOT_FOUND)
+        return path
+
+    async def _handle(self, reader, writer):
+        """Serves the requests of a connection until it is closed."""
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            timeout = REQUEST_TIMEOUT
+            for i in range(MAX_KEEP_ALIVE_REQUESTS):
+                request = await asyncio.wait_for(
+                    self._read_request(reader), timeout)
+                if request is None:
+                    break
+                method, target, version, headers = request
+                keep_alive = (self._keep_alive(version, headers) and
+                              i + 1 < MAX_KEEP_ALIVE_REQUESTS)
+                await self._respond(writer, method, target, headers,
+                                    keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+                timeout = KEEP_ALIVE_TIMEOUT
+        except HttpError as e:
+            self._write_headers(writer, e.status, 'text/plain', 0, False)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            print('ResourceServer:', e)
+        except asyncio.CancelledError:
+            # On shutdown. Nothing waits for the task, so it just ends.
+            pass
+        finally:
+            self._tasks.discard(task)
+            writer.close()
+
+    async def _respond(self, writer, method, target, headers, keep_alive):
+        print(method, target)
+        try:
+            if method not in ('GET', 'HEAD'):
+                raise HttpError(HTTPStatus.NOT_IMPLEMENTED)
+            if target == '/data.json':
+                snapshot = await self._get_snapshot()
+                self._write_data(writer, method, headers, keep_alive,
+                                 snapshot.data, snapshot.gzipped)
+            elif target == '/manifest':
+                data, gzipped = await self.net.loop.run_in_executor(
+                    self._executor, self._manifest_data)
+                self._write_data(writer, method, headers, keep_alive, data,
+                                 gzipped)
+            else:
+                await self._send_file(writer, method,
+                                      self._translate_path(target), headers,
+                                      keep_alive)
+        except HttpError as e:
+            # The connection stays usable after the errors of a request.
+            self._write_headers(writer, e.status, 'text/plain', 0,
+                                keep_alive)
+
+    def _write_headers(self, writer, status, content_type, length,
+                       keep_alive, extra=None):
+        lines = ['HTTP/1.1 {} {}'.format(status.value, status.phrase),
+                 'Content-Type: ' + content_type,
+                 'Content-Length: {}'.format(length),
+                 'Connection: ' + ('keep-alive' if keep_alive else 'close')]
+        for name, value in (extra or {}).items():
+            lines.append('{}: {}'.format(name, value))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    def _hash_file(self, path) -> str:
+        """Returns the content hash of a file. Called in the worker threads."""
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns,
+                                                 stat.st_size):
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        self._hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    @staticmethod
+    def _accepts_gzip(headers) -> bool:
+        for coding in headers.get('accept-encoding', '').split(','):
+            name, _, params = coding.partition(';')
+            if name.strip().lower() in ('gzip', '*'):
+                try:
+                    return float(params.strip().partition('q=')[2] or 1) > 0
+                except ValueError:
+                    return False
+        return False
+
+    def _write_data(self, writer, method, headers, keep_alive, data,
+                    gzipped):
+        """Sends a generated JSON document, compressed if the client wants."""
+        extra = {'Vary': 'Accept-Encoding'}
+        if gzipped is not None and self._accepts_gzip(headers):
+            data = gzipped
+            extra['Content-Encoding'] = 'gzip'
+        self._write_headers(writer, HTTPStatus.OK, 'application/json',
+                            len(data), keep_alive, extra)
+        if method == 'GET':
+            writer.write(data)
+
+    def _manifest_data(self):
+        """Returns the manifest and its gzip variant. In the worker threads."""
+        data = json.dumps({'assets': self._manifest()}).encode('utf-8')
+        return data, compress(data)
+
+    def _gzip_file(self, path):
+        """Returns the gzip variant of a file, or None if it isn't smaller.
+
+        Called in the worker threads.
+        """
+        stat = os.stat(path)
+        cached = self._gzipped.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns,
+                                                 stat.st_size):
+            return cached[2]
+        with open(path, 'rb') as file:
+            gzipped = compress(file.read())
+        self._gzipped[path] = (stat.st_mtime_ns, stat.st_size, gzipped)
+        return gzipped
+
+    def _manifest(self) -> dict:
+        """Returns the size and the hash of every asset, by the path.
+
+        Called in the worker threads.
+        """
+        assets = {}
+        for top, dirs, files in os.walk(self.dir):
+            if top == self.dir:
+                dirs[:] = [d for d in dirs if d not in NOT_ASSETS]
+                files = [f for f in files if f not in NOT_ASSETS]
+            for name in files:
+                path = os.path.join(top, name)
+                relative = os.path.relpath(path, self.dir).replace(os.sep, '/')
+                assets[relative] = {'size': os.path.getsize(path),
+                                    'hash': self._hash_file(path)}
+        return assets
+
+    @staticmethod
+    def _matches(etag, headers) -> bool:
+        """Checks whether the client already has this version of the file.
+
+        The compressed variant has its own ETag, but either of them means
+        that the client has the content.
+        """
+        tags = [tag.strip() for tag in
+                headers.get('if-none-match', '').split(',')]
+        return (etag in tags or etag[:-1] + '-gzip"' in tags or
+                '*' in tags)
+
+    async def _send_file(self, writer, method, path, headers, keep_alive):
+        content_type, _ = mimetypes.guess_type(path)
+        content_type = content_type or 'application/octet-stream'
+        loop = self.net.loop
+        etag = '"{}"'.format(await loop.run_in_executor(
+            self._executor, self._hash_file, path))
+        extra = {'ETag': etag}
+        if content_type in COMPRESSIBLE_TYPES:
+            extra['Vary'] = 'Accept-Encoding'
+        if self._matches(etag, headers):
+            # No body, but the length that the file would have.
+            self._write_headers(writer, HTTPStatus.NOT_MODIFIED, content_type,
+                                os.path.getsize(path), keep_alive, extra)
+            return
+        if content_type in COMPRESSIBLE_TYPES and self._accepts_gzip(headers):
+            gzipped = await loop.run_in_executor(
+                self._executor, self._gzip_file, path)
+            if gzipped is not None:
+                extra.update({'ETag': etag[:-1] + '-gzip"',
+                              'Content-Encoding': 'gzip'})
+                self._write_headers(writer, HTTPStatus.OK, content_type,
+                                    len(gzipped), keep_alive, extra)
+                if method == 'GET':
+                    writer.write(gzipped)
+                return
+        file = await loop.run_in_executor(self._executor, open, path, 'rb')
+        try:
+            self._write_headers(writer, HTTPStatus.OK, content_type,
+                                os.fstat(file.fileno()).st_size, keep_alive,
+                                extra)
+            if method == 'HEAD':
+                return
+            while True:
+                chunk = await loop.run_in_executor(
+                    self._executor, file.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                # Wait for the client to receive the data instead of
+                # buffering the whole file.
+                await writer.drain()
+        finally:
+            file.close()
+
+    def _serialize(self) -> Snapshot:
+        """Serializes the campaign. Called in the worker threads.
+
+        The campaign belongs to the main thread, which changes the data and
+        records the version of the change under the lock of the campaign.
+        The data is encoded under the same lock, so the snapshot has exactly
+        the changes up to its version. The main thread waits for the
+        encoding, but only if it changes the campaign in the meantime.
+        """
+        with self.campaign.lock:
+            version = self.campaign.version
+            data = json.dumps(self._get_data())
+        return Snapshot(version, data.encode('utf-8'))
+
+    def _refresh(self):
+        """Starts serializing the campaign, unless it is already underway."""
+        if self._refreshing is None:
+            self._refreshing = self.net.loop.run_in_executor(
+                self._executor, self._serialize)
+            self._refreshing.add_done_callback(self._refreshed)
+        return self._refreshing
+
+    def _refreshed(self, future):
+        self._refreshing = None
+        if not future.cancelled() and future.exception() is None:
+            self._snapshot = future.result()
 
-    def on_request_data(self):
-        data = self.campaign._data
-        data = json.dumps(data).encode('utf-8')
-        self.data_queue.put(data)
+    async def _get_snapshot(self) -> Snapshot:
+        """Returns the latest snapshot, waiting only if there is none."""
+        if self._snapshot is None:
+            return await asyncio.shield(self._refresh())
+        return self._snapshot
 
-ResourceServer.register_event_type('on_request_data')
\ No newline at end of file
+    def _check_version(self):
+        """Refreshes the snapshot when the campaign has changed."""
+        if not self.server.is_serving():
+            return
+        # The first snapshot is made right away, before the players ask.
+        if (self._snapshot is None or
+            self._snapshot.version != self.campaign.version):
+            self._refresh()
+        self.net.loop.call_later(SNAPSHOT_INTERVAL, self._check_version)
@@ -1,25 +1,40 @@
+import argparse
+import concurrent.futures
+import io
 import ipaddress
+import json
 import math
 import os.path
 import pyglet
 from pyglet.window import key, mouse
 from pyglet.event import EVENT_HANDLED, EVENT_UNHANDLED
 import requests
+import requests.adapters
 import shutil
-import sys
 import time
 
 import apiserver
+import apitrace
+import assetcache
 from campaign import Campaign
 import chat
 import colors
+from controller import Controller
 import healthbar
 from map import Map
+import movement
+import netloop
+import netsim
+import relay
 import resserver
 from state import State
 import ui
 
 
+# The number of assets that a player downloads at once when joining.
+PREFETCH_WORKERS = 4
+
+
 class LocalResourceProvider(object):
     def __init__(self, top_dir):
         self.can_save = True
@@ -49,26 +64,102 @@ class LocalResourceProvider(object):
 
 
 class RemoteResourceProvider(object):
-    def __init__(self, address):
+    def __init__(self, address, port=resserver.PORT, cache=None,
+                 workers=PREFETCH_WORKERS):
+        """Loads the campaign from the resource server of the master.
+
+        Args:
+            address: the address of the master.
+            port: the port of the resource server.
+            cache: `assetcache.AssetCache` that keeps the downloaded assets
+              between the games, or None.
+            workers: the number of assets downloaded at once by
+              `prefetch()`.
+        """
         self.can_save = False
-        self.netloc = 'http://[{}]:{}/'.format(address, resserver.PORT)
+        self.netloc = 'http://[{}]:{}/'.format(address, port)
+        self.cache = cache
+        self.workers = workers
+        # Keeps the connections to the master alive between the files, one
+        # for every download thread.
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=workers))
+        # The JSON and the PNGs are sent compressed. `requests` decodes them,
+        # and only gzip is offered by the server.
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        # Downloaded by `prefetch()` and not opened yet.
+        self._prefetched = {}
+
+    def prefetch(self):
+        """Downloads the campaign and all its assets in parallel.
+
+        Call before the campaign is loaded, so that it doesn't wait for the
+        assets one by one.
+        """
+        data = self._download('data.json')
+        self._prefetched['data.json'] = data
+        paths = {fragment['path'] for fragment
+                 in json.loads(data.decode('utf-8'))['fragments'].values()}
+        response = self.session.get(self.netloc + 'manifest')
+        manifest = response.json()['assets'] if response.ok else {}
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            downloads = {path: executor.submit(self._download, path,
+                                               manifest.get(path))
+                         for path in paths}
+        for path, download in downloads.items():
+            self._prefetched[path] = download.result()
+
+    def _download(self, path, asset=None) -> bytes:
+        """Returns the content of the file, from the cache if it is current.
+
+        Args:
+            path: the path of the file in the campaign.
+            asset: the entry of the file in the manifest, if known.
+        """
+        url = self.netloc + path
+        print('opening', url)
+        if self.cache is None:
+            return self.session.get(url).content
+        # Keyed by the path, since the master may have another address in
+        # the next game.
+        etag = self.cache.etag(path)
+        if asset is not None:
+            # The manifest is as good as a revalidation, and the content may
+            # have been cached under another name.
+            data = self.cache.get_object(asset['hash'])
+            if data is not None:
+                if etag != asset['hash']:
+                    self.cache.put(path, data, asset['hash'])
+                return data
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = '"{}"'.format(etag)
+        response = self.session.get(url, headers=headers)
+        if response.status_code == 304:
+            data = self.cache.get(path)
+            if data is not None:
+                return data
+            # Evicted or damaged in the meantime.
+            response = self.session.get(url)
+        etag = response.headers.get('ETag')
+        if response.ok and etag is not None:
+            self.cache.put(path, response.content, etag.strip('"'))
+        return response.content
 
     def open(self, path):
-        print('opening', self.netloc + path)
-        return requests.get(self.netloc + path, stream=True).raw
+        data = self._prefetched.pop(path, None)
+        if data is None:
+            data = self._download(path)
+        return io.BytesIO(data)
 
 
-class Manager(object):
-    def __init__(self, state: State, api_server):
-        self.state = state
+class Manager(Controller):
+    def __init__(self, state: State, api_server,
+                 movement_rate=movement.DEFAULT_RATE):
+        super().__init__(state, api_server, movement_rate=movement_rate)
         self.state.push_handlers(self)
 
-        self.campaign = state.campaign
-        self.campaign.push_handlers(self)
-
-        self.api_server = api_server
-        self.api_server.push_handlers(self)
-
         self.window = pyglet.window.Window(resizable=True)
         self.window.push_handlers(self)
         self.focus_manager = ui.FocusManager(self.window)
@@ -103,10 +194,6 @@ class Manager(object):
         # Make sure that on_draw is called regularly.
         pyglet.clock.schedule_interval(lambda _: None, 1 / 120)
 
-    @property
-    def is_master(self):
-        return self.state.is_master
-
     @property
     def pan_speed(self):
         return max(self.window.width, self.window.height)
@@ -161,110 +248,27 @@ class Manager(object):
 
         return True
 
-    def on_api_request(self, request, client_address):
-        method = request['method']
-        print('on_api_request', request)
-        # print('on_api_request', method, 'from', client_address)
-        params = request['params']
-        if method == 'hi':
-            print('Adding player {} at address {}'.format(
-                params['player'], client_address))
-            self.api_server.add_player(client_address)
-        elif method == 'update_token':
-            token = params['token']
-            self.campaign.tokens[token['id']].update_data(
-                token, notify=self.is_master)
-        elif method == 'token_temp_position_changed':
-            token = self.campaign.tokens[params['token_id']]
-            position = params['position']
-            if token is not self.state.dragged_token:
-                token.set_temp_position(
-                    position[0], position[1], notify=self.is_master)
-        elif method == 'page_changed':
-            self.campaign.players_page_idx = params['players_page']
-            self.map.scale_to_fit()
-        elif method == 'veils_updated':
-            page_id = params['page_id']
-            veils = params['veils']
-            self.campaign.pages[page_id].set_veils(veils)
-        elif method == 'player_chat':
-            assert self.state.is_master
-            message = params['message']
-            self.campaign.add_chat(message)
-        elif method == 'new_chat':
-            assert not self.state.is_master
-            print(request)
-            message = params['message']
-            self.campaign.add_chat(message)
-        else:
-            print('Unknown API request:', request, 'from', client_address)
-
-    def on_token_updated(self, token):
-        print('on_token_updated:', token._data)
-        notification = {
-            'method': 'update_token',
-            'params': {
-                'token': token._data
-            }
-        }
-        self.api_server.notify(notification)
-
-    def on_token_temp_position_changed(self, token_id, position):
-        print('on_token_temp_position_changed:', token_id, position)
-        notification = {
-            'method': 'token_temp_position_changed',
-            'params': {
-                'token_id': token_id,
-                'position': position
-            }
-        }
-        self.api_server.notify(notification)
-
-    def on_page_changed(self, players_page):
-        if not self.is_master: return
-        print('on_page_changed', players_page)
-        notification = {
-            'method': 'page_changed',
-            'params': {
-                'players_page': players_page
-            }
-        }
-        self.api_server.notify(notification)
-
-    def on_veils_updated(self, page_id, veils):
-        print('on_veils_updated, page', page_id)
-        notification = {
-            'method': 'veils_updated',
-            'params': {
-                'page_id': page_id,
-                'veils': veils
-            }
-        }
-        self.api_server.notify(notification)
-
-    def on_new_chat(self, message):
-        if not self.is_master: return
-        print('on_new_chat', message)
-        notification = {
-            'method': 'new_chat',
-            'params': {'message': message}
-        }
-        self.api_server.notify(notification)
+    def on_players_page_shown(self):
+        self.map.scale_to_fit()
 
     def on_current_char_changed(self):
         self.layout.update_layout()
 
-def master_main(campaign_dir):
+def master_main(campaign_dir, recorder=None, impairment=None):
     ip = requests.get('https://api6.ipify.org').text
     print('Address: {}'.format(ip))
 
     resource_provider = LocalResourceProvider(campaign_dir)
     campaign = Campaign(resource_provider)
     state = State(campaign, player=None)
-    res_server = resserver.ResourceServer(campaign_dir, campaign)
-    api_server = apiserver.ApiServer()
+    net = netloop.NetworkLoop()
+    api_server = apiserver.ApiServer(net, recorder=recorder,
+                                     impairment=impairment)
 
     manager = Manager(state, api_server)
+    # The joining players don't get the tokens hidden in the fog.
+    res_server = resserver.ResourceServer(campaign_dir, campaign, net,
+                                          get_data=manager.served_data)
 
     pyglet.app.run()
 
@@ -272,48 +276,81 @@ def master_main(campaign_dir):
 
     api_server.shutdown()
     res_server.shutdown()
-    api_server.join()
-    res_server.join()
+    net.stop()
+    net.join()
 
 
-def player_main(address, player, port):
+def player_main(address, player, port, recorder=None, impairment=None,
+                use_stream=False, spectator=False):
     address = ipaddress.ip_address(address)
     assert address.version == 6
     master_address = address.exploded
 
-    api_server = apiserver.ApiServer(master_address, port=port)
-    request = {
-        'id': 1,
-        'method': 'hi',
-        'params': {'player': player}
-    }
-    api_server.send(request)
-
-    resource_provider = RemoteResourceProvider(master_address)
+    net = netloop.NetworkLoop()
+    api_server = apiserver.ApiServer(net, master_address, port=port,
+                                     recorder=recorder, impairment=impairment,
+                                     use_stream=use_stream,
+                                     relay_fanout=relay.RELAY_FANOUT)
+    api_server.connect(player, spectator=spectator)
+
+    cache = assetcache.AssetCache(assetcache.default_dir())
+    resource_provider = RemoteResourceProvider(master_address, cache=cache)
+    resource_provider.prefetch()
+    # The hits of a warm join only update the recent uses in memory.
+    cache.save()
     campaign = Campaign(resource_provider)
     state = State(campaign, player)
     manager = Manager(state, api_server)
 
     pyglet.app.run()
 
+    cache.save()
     api_server.shutdown()
-    api_server.join()
+    net.stop()
+    net.join()
 
 
 HELP = """
 Usage:
-    python seer.py <campaign directory>
+    python seer.py [options] <campaign directory>
 or
-    python seer.py <master IPv6 address> <your name> [<port>]
+    python seer.py [options] <master IPv6 address> <your name> [<port>]
+
+Options:
+    --record <trace>    record the API traffic to a file
+    --impair <spec>     simulate a bad network, e.g. loss=0.05,delay=0.04
+    --tcp               connect to the master over TCP instead of UDP, for
+                        the networks that block or mangle UDP
+    --spectate          join as a spectator, which only watches the game
 """
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        master_main(sys.argv[1])
-    elif len(sys.argv) in (3, 4):
+    parser = argparse.ArgumentParser(usage=HELP)
+    parser.add_argument('args', nargs='+')
+    parser.add_argument('--record', metavar='TRACE',
+                        help='record the API traffic to this file')
+    parser.add_argument('--impair', metavar='SPEC',
+                        type=netsim.Impairment.parse,
+                        help='simulate a bad network for the outgoing '
+                             'traffic, e.g. loss=0.05,delay=0.04,jitter=0.01,'
+                             'duplicate=0.01,reorder=0.01,bandwidth=100000')
+    parser.add_argument('--tcp', action='store_true',
+                        help='use TCP instead of UDP')
+    parser.add_argument('--spectate', action='store_true',
+                        help='join as a spectator')
+    args = parser.parse_args()
+    recorder = None
+    if args.record is not None:
+        recorder = apitrace.TraceRecorder(args.record)
+    if len(args.args) == 1:
+        master_main(args.args[0], recorder, args.impair)
+    elif len(args.args) in (2, 3):
         port = None
-        if len(sys.argv) == 4:
-            port = int(sys.argv[3])
-        player_main(sys.argv[1], sys.argv[2], port)
+        if len(args.args) == 3:
+            port = int(args.args[2])
+        player_main(args.args[0], args.args[1], port, recorder, args.impair,
+                    args.tcp, args.spectate)
     else:
         print(HELP)
+    if recorder is not None:
+        recorder.close()
@@ -0,0 +1,194 @@
+"""Outbound queues of the API peers.
+
+Every session queues its outgoing messages in priority classes, and the
+queue is drained as fast as the token bucket of the session allows. When the
+link is saturated, the messages that matter most go first:
+
+1. `CONTROL`: handshakes, resyncs and page changes.
+2. `STATE`: committed changes of the tokens and the veils, snapshots.
+3. `CHAT`.
+4. `PREVIEW`: temporary token positions while dragging. Only the latest
+   preview of each token is kept, and previews that have waited for longer
+   than `PREVIEW_MAX_AGE` are dropped.
+
+A versioned change of the campaign never overtakes an earlier versioned
+change, since the players apply them strictly in order: when one is due, the
+earliest queued versioned change is sent in its place.
+
+The messages are queued encoded, but before they get sequence numbers, which
+are attached when they are sent. This way the sequence numbers follow the
+order of sending and the reliability layer doesn't see the reordering.
+"""
+
+import collections
+import time
+
+CONTROL = 0
+STATE = 1
+CHAT = 2
+PREVIEW = 3
+
+PRIORITIES = {
+    'hi': CONTROL,
+    'hi_ack': CONTROL,
+    'sync': CONTROL,
+    'page_changed': CONTROL,
+    'veils_resync': CONTROL,
+    'reconnect': CONTROL,
+    'ack': CONTROL,
+    'ping': CONTROL,
+    'pong': CONTROL,
+    'relay_parent': CONTROL,
+    'relay_left': CONTROL,
+    'update_token': STATE,
+    'veils_patch': STATE,
+    'veils_updated': STATE,
+    'page_snapshot': STATE,
+    'state_snapshot': STATE,
+    'patch': STATE,
+    'patch_rejected': STATE,
+    'patch_batch': STATE,
+    'player_chat': CHAT,
+    'new_chat': CHAT,
+    'token_temp_position_changed': PREVIEW,
+}
+
+# Bytes per second and the size of the burst that can be sent at once.
+PACING_RATE = 256 * 1024
+PACING_BURST = 32 * 1024
+PREVIEW_MAX_AGE = 0.1
+
+
+def priority(method) -> int:
+    return PRIORITIES.get(method, STATE)
+
+
+def coalesce_key(message):
+    """Returns the key of the messages that replace each other, or None."""
+    if message['method'] == 'token_temp_position_changed':
+        return message['params']['token_id']
+    return None
+
+
+class TokenBucket(object):
+    """Limits the rate of messages or bytes.
+
+    With `consume()` the bucket can go into debt: a datagram is sent as long
+    as there are any tokens left, and the following ones wait until the debt
+    is paid off. `take()` only succeeds if there are enough tokens.
+    """
+
+    def __init__(self, rate=PACING_RATE, burst=PACING_BURST,
+                 clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def consume(self, size):
+        if self.rate is None:
+            return
+        self._refill()
+        self._tokens -= size
+
+    def take(self, size) -> bool:
+        """Consumes the tokens only if there are enough of them."""
+        if self.rate is None:
+            return True
+        self._refill()
+        if self._tokens < size:
+            return False
+        self._tokens -= size
+        return True
+
+    def ready(self) -> bool:
+        if self.rate is None:
+            return True
+        self._refill()
+        return self._tokens > 0
+
+    def wait(self) -> float:
+        """Returns the time until the bucket is ready."""
+        if self.ready():
+            return 0
+        return -self._tokens / self.rate + 1e-3
+
+
+class Item(object):
+    __slots__ = ('method', 'data', 'versioned', 'key', 'queued_at')
+
+    def __init__(self, method, data, versioned, key, queued_at):
+        self.method = method
+        self.data = data
+        self.versioned = versioned
+        self.key = key
+        self.queued_at = queued_at
+
+
+class SendQueue(object):
+    """The outgoing messages of a single peer."""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._queues = [collections.deque() for _ in range(PREVIEW)]
+        # The latest preview of every token, the least recent first.
+        self._previews = collections.OrderedDict()
+        self._versioned = collections.deque()
+        # Set when the queue is going to be drained.
+        self.scheduled = False
+
+        self.coalesced = 0
+        self.dropped = 0
+
+    def push(self, method, data, versioned=False, key=None):
+        """Queues an encoded message.
+
+        Args:
+            method: the method of the message.
+            data: the encoded message.
+            versioned: whether it is a versioned change of the campaign.
+            key: messages with the same key replace each other. Only used
+              for previews.
+        """
+        item = Item(method, data, versioned, key, self._clock())
+        cls = priority(method)
+        if cls == PREVIEW:
+            if key in self._previews:
+                del self._previews[key]
+                self.coalesced += 1
+            self._previews[key] = item
+            return
+        self._queues[cls].append(item)
+        if versioned:
+            self._versioned.append(item)
+
+    def pop(self) -> Item:
+        """Returns the next message to be sent, or None."""
+        for queue in self._queues:
+            if queue:
+                item = queue[0]
+                if item.versioned and self._versioned[0] is not item:
+                    item = self._versioned[0]
+                    self._queues[priority(item.method)].remove(item)
+                else:
+                    queue.popleft()
+                if item.versioned:
+                    self._versioned.popleft()
+                return item
+        now = self._clock()
+        while self._previews:
+            _, item = self._previews.popitem(last=False)
+            if now - item.queued_at <= PREVIEW_MAX_AGE:
+                return item
+            self.dropped += 1
+        return None
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues) + len(self._previews)
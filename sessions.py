@@ -0,0 +1,187 @@
+"""Sessions of the peers connected to the API server."""
+
+import collections
+import time
+
+import reliable
+import sendqueue
+import wire
+
+# A session is closed if nothing has been received from the peer for this
+# long.
+SESSION_TIMEOUT = 15
+HEARTBEAT_INTERVAL = 2
+
+# Limits on the incoming messages of a player, as (messages per second,
+# burst), by method. Applied by the master, and by the relays to their
+# spectators.
+RATE_LIMITS = {
+    'token_temp_position_changed': (60, 30),
+    'update_token': (20, 20),
+    'patch': (20, 20),
+    'player_chat': (2, 10),
+    'sync': (1, 5),
+    'hi': (1, 5),
+    'relay_left': (10, 20),
+}
+DEFAULT_RATE_LIMIT = (50, 100)
+# Transport messages are cheap and are not passed on.
+UNLIMITED_METHODS = {'ack', 'ping', 'pong'}
+# Throttled reliable messages kept per stream session. A peer that sends
+# more is dropped.
+MAX_HELD = 256
+
+
+class Session(object):
+    """A connection with a single peer.
+
+    On the master there is a session for every player. On the players there
+    is a single session for the master.
+    """
+
+    def __init__(self, player, address, session_id=None, clock=time.monotonic,
+                 pacing_rate=sendqueue.PACING_RATE, stream=False):
+        self.player = player
+        self.address = address
+        self.id = session_id
+        # Whether the peer is connected over the TCP transport of `stream`,
+        # which doesn't lose anything, so nothing is retransmitted.
+        self.stream = stream
+        self.peer = reliable.ReliablePeer(clock=clock, retransmit=not stream)
+        self.queue = sendqueue.SendQueue(clock=clock)
+        self.bucket = sendqueue.TokenBucket(pacing_rate, clock=clock)
+        # Encoding negotiated with the peer.
+        self.wire_version = wire.JSON
+        self._clock = clock
+        self.started = clock()
+        self.last_seen = self.started
+        # The page that the player is viewing, and the pages that have been
+        # changed while the player was viewing another page.
+        self.page = None
+        self.stale_pages = set()
+        # The version of the last campaign change sent to the player.
+        self.version_sent = None
+        # Whether the peer only receives the changes, see `relay`.
+        self.spectator = False
+        # Set when the session is closed once it is acknowledged.
+        self.released = False
+        # Throttled reliable messages of a stream session, which are
+        # delivered once the rate limit allows instead of being dropped.
+        self.held = collections.deque()
+
+        # Token buckets of the incoming messages, by method.
+        self._limits = {}
+        self.throttled = 0
+        self.dropped = 0
+
+        self.packets_in = 0
+        self.packets_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # RTT measured with heartbeats.
+        self.ping_rtt = None
+
+    def received(self, size):
+        self.last_seen = self._clock()
+        self.packets_in += 1
+        self.bytes_in += size
+
+    def sent(self, size):
+        self.packets_out += 1
+        self.bytes_out += size
+
+    def allow(self, method) -> bool:
+        """Checks the rate limit of an incoming message."""
+        if method in UNLIMITED_METHODS:
+            return True
+        bucket = self._limits.get(method)
+        if bucket is None:
+            rate, burst = RATE_LIMITS.get(method, DEFAULT_RATE_LIMIT)
+            bucket = sendqueue.TokenBucket(rate, burst, clock=self._clock)
+            self._limits[method] = bucket
+        return bucket.take(1)
+
+    def expired(self, now) -> bool:
+        return now - self.last_seen > SESSION_TIMEOUT
+
+    @property
+    def rtt(self):
+        if self.peer.srtt is not None:
+            return self.peer.srtt
+        return self.ping_rtt
+
+    def stats(self) -> dict:
+        return {
+            'player': self.player,
+            'address': self.address,
+            'uptime': self._clock() - self.started,
+            'idle': self._clock() - self.last_seen,
+            'rtt': self.rtt,
+            'packets_in': self.packets_in,
+            'packets_out': self.packets_out,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'in_flight': self.peer.in_flight,
+            'retransmits': self.peer.retransmits,
+            'duplicates': self.peer.duplicates,
+            'lost': self.peer.lost,
+            'queued': len(self.queue),
+            'coalesced': self.queue.coalesced,
+            'dropped_previews': self.queue.dropped,
+            'throttled': self.throttled,
+            'dropped': self.dropped,
+        }
+
+
+class SessionTable(object):
+    """Live sessions, indexed by the player's name and by the address."""
+
+    def __init__(self, clock=time.monotonic,
+                 pacing_rate=sendqueue.PACING_RATE):
+        self._clock = clock
+        self._pacing_rate = pacing_rate
+        self._by_player = {}
+        self._by_address = {}
+
+    def connect(self, player, address, session_id=None,
+                stream=False) -> Session:
+        """Opens a new session, replacing the previous one of the player.
+
+        Returns the new session.
+        """
+        old = self._by_player.get(player)
+        if old is not None:
+            del self._by_address[old.address]
+        old = self._by_address.get(address)
+        if old is not None:
+            del self._by_player[old.player]
+        session = Session(player, address, session_id, clock=self._clock,
+                          pacing_rate=self._pacing_rate, stream=stream)
+        self._by_player[player] = session
+        self._by_address[address] = session
+        return session
+
+    def close(self, session):
+        if self._by_player.get(session.player) is session:
+            del self._by_player[session.player]
+            del self._by_address[session.address]
+
+    def get(self, address) -> Session:
+        return self._by_address.get(address)
+
+    def get_player(self, player) -> Session:
+        return self._by_player.get(player)
+
+    def evict_expired(self) -> list:
+        """Closes the sessions that have timed out and returns them."""
+        now = self._clock()
+        expired = [s for s in self._by_player.values() if s.expired(now)]
+        for session in expired:
+            self.close(session)
+        return expired
+
+    def __iter__(self):
+        return iter(list(self._by_player.values()))
+
+    def __len__(self):
+        return len(self._by_player)
@@ -0,0 +1,332 @@
+"""Runs a master and synthetic players in one process over loopback.
+
+Usage:
+    python simulate.py [--players N] [--spectators N] [--changes N]
+                       [--impair SPEC] [--tcp] [-v]
+
+The master makes random changes to the page that the players view: moves
+tokens, drags them, changes hit points, toggles veils and chats. The players
+chat too. The spectators join after the players and are placed in the relay
+tree. The network is impaired with `netsim`. When the script is over, the
+simulation waits until every player has the same state as the master and
+reports how long it took and how much traffic was sent.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import time
+
+import pyglet
+
+import apiserver
+from campaign import Campaign
+from controller import Controller
+import netloop
+import netsim
+import relay
+import seer
+from state import State
+import stream
+import wire
+
+POLL_INTERVAL = 0.001
+JOIN_TIMEOUT = 30
+CONVERGENCE_TIMEOUT = 60
+
+
+def load_campaign(campaign_dir):
+    resource_provider = seer.LocalResourceProvider(campaign_dir)
+    resource_provider.can_save = False
+    return Campaign(resource_provider)
+
+
+def digest(campaign):
+    """Returns the part of the state that the players must agree on.
+
+    The tokens hidden by the veils are left out, since the master doesn't
+    send their changes.
+    """
+    page = campaign.pages[campaign.players_page_idx]
+    hidden = {token.id for token in page.tokens if page.is_hidden(token)}
+    characters = {id: character._data
+                  for id, character in campaign.characters.items()}
+    return json.dumps([campaign.players_page_idx, page.snapshot(hidden),
+                       characters,
+                       campaign._data.get('chat', [])], sort_keys=True)
+
+
+class Peer(object):
+    """A headless instance of the game."""
+
+    def __init__(self, net, campaign_dir, player=None, master=None,
+                 impairment=None, use_stream=False, spectator=False,
+                 relay_fanout=0):
+        self.campaign = load_campaign(campaign_dir)
+        self.spectator = spectator
+        if (player is not None and not spectator and
+            player not in self.campaign.players):
+            # The synthetic players control the character of the first
+            # player of the campaign.
+            self.campaign.players[player] = next(
+                iter(self.campaign.players.values()))
+        self.api_server = apiserver.ApiServer(
+            net, master, port=0, impairment=impairment,
+            use_stream=use_stream, relay_fanout=relay_fanout)
+        self.controller = Controller(State(self.campaign, player),
+                                     self.api_server)
+
+    @property
+    def port(self):
+        return self.api_server.transport.get_extra_info('sockname')[1]
+
+    def close(self):
+        self.controller.movement.close()
+        self.api_server.shutdown()
+
+
+class Simulation(object):
+    def __init__(self, campaign_dir='campaign', players=2, impairment=None,
+                 seed=0, use_stream=False, spectators=0):
+        self._random = random.Random(seed)
+        self.net = netloop.NetworkLoop()
+
+        def impair(i):
+            if impairment is None:
+                return None
+            # Every endpoint gets its own random sequence.
+            params = {name: getattr(impairment, name)
+                      for name in netsim.Impairment.FIELDS}
+            params['seed'] = (impairment.seed or seed) * 1000 + i
+            return netsim.Impairment(**params)
+
+        self.master = Peer(self.net, campaign_dir, impairment=impair(0))
+        master_address = ('::1', self.master.port)
+        self.players = [
+            Peer(self.net, campaign_dir, 'Player {}'.format(i),
+                 master_address, impairment=impair(i),
+                 use_stream=use_stream, relay_fanout=relay.RELAY_FANOUT)
+            for i in range(1, players + 1)
+        ]
+        self.spectators = [
+            Peer(self.net, campaign_dir, 'Spectator {}'.format(i),
+                 master_address, impairment=impair(players + i),
+                 use_stream=use_stream, spectator=True,
+                 relay_fanout=relay.RELAY_FANOUT)
+            for i in range(1, spectators + 1)
+        ]
+
+    @property
+    def clients(self):
+        return self.players + self.spectators
+
+    def close(self):
+        for peer in [self.master] + self.clients:
+            peer.close()
+        self.net.stop()
+        self.net.join()
+
+    def run_for(self, duration, condition=None) -> bool:
+        """Runs the main loop for `duration` seconds or until `condition()`.
+
+        Returns True if the condition has been met.
+        """
+        deadline = time.monotonic() + duration
+        while True:
+            pyglet.clock.tick()
+            pyglet.app.platform_event_loop.dispatch_posted_events()
+            if condition is not None and condition():
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(POLL_INTERVAL)
+
+    def converged(self) -> bool:
+        expected = digest(self.master.campaign)
+        return all(digest(p.campaign) == expected for p in self.clients)
+
+    def settled(self) -> bool:
+        """Checks that the players have converged and nothing is in flight."""
+        if len(self.master.api_server.sessions) < len(self.players):
+            return False
+        for peer in self.clients:
+            # Not welcomed by the master or the relay yet.
+            api_server = peer.api_server
+            if (api_server.player is not None and
+                api_server.sessions.get(api_server.master).wire_version ==
+                    wire.JSON):
+                return False
+        for peer in [self.master] + self.clients:
+            for session in peer.api_server.sessions:
+                if session.peer.in_flight or session.released:
+                    return False
+        return self.converged()
+
+    def join(self) -> float:
+        """Connects the players and returns the time it took to sync them."""
+        start = time.monotonic()
+        for i, player in enumerate(self.players, 1):
+            player.api_server.connect('Player {}'.format(i))
+        if self.spectators:
+            # The players have to join first to relay to the spectators.
+            if not self.run_for(JOIN_TIMEOUT, self.settled):
+                raise TimeoutError('The players have not joined')
+            for i, spectator in enumerate(self.spectators, 1):
+                spectator.api_server.connect('Spectator {}'.format(i),
+                                             spectator=True)
+        if not self.run_for(JOIN_TIMEOUT, self.settled):
+            raise TimeoutError('The players have not joined')
+        return time.monotonic() - start
+
+    def random_change(self):
+        campaign = self.master.campaign
+        page = campaign.pages[campaign.players_page_idx]
+        choice = self._random.random()
+        if choice < 0.4 and page.tokens:
+            token = self._random.choice(page.tokens)
+            x, y = token.position
+            for _ in range(5):
+                x += self._random.uniform(-0.5, 0.5)
+                y += self._random.uniform(-0.5, 0.5)
+                token.set_temp_position(x, y)
+            token.set_position(round(x), round(y))
+        elif choice < 0.5 and campaign.characters:
+            character = self._random.choice(list(campaign.characters.values()))
+            character.set_hp(self._random.randint(0, character.maxhp),
+                             character.maxhp)
+        elif choice < 0.6:
+            if page.veils:
+                veil = self._random.choice(page.veils)
+                page.toggle_veil((veil['minx'] + veil['maxx']) / 2,
+                                 (veil['miny'] + veil['maxy']) / 2)
+            else:
+                page.add_veil(0, 0, 1, 1)
+        elif choice < 0.8:
+            campaign.add_chat({'player': None, 'text': 'Master says hi'})
+        else:
+            player = self._random.choice(self.players)
+            player.api_server.notify({
+                'method': 'player_chat',
+                'params': {
+                    'message': {'player': player.controller.state.player,
+                                'text': 'Player says hi'}
+                }
+            })
+
+    def traffic(self) -> dict:
+        def total(peer, field):
+            return sum(s[field] for s in peer.api_server.stats())
+
+        result = {
+            'master_bytes_out': total(self.master, 'bytes_out'),
+            'master_packets_out': total(self.master, 'packets_out'),
+            'players_bytes_out': sum(total(p, 'bytes_out')
+                                     for p in self.players),
+            'players_packets_out': sum(total(p, 'packets_out')
+                                       for p in self.players),
+            'spectators_bytes_out': sum(total(p, 'bytes_out')
+                                        for p in self.spectators),
+            'retransmits': sum(total(p, 'retransmits')
+                               for p in [self.master] + self.clients),
+            'lost': sum(total(p, 'lost')
+                        for p in [self.master] + self.clients),
+        }
+        for peer in [self.master] + self.clients:
+            framing_stats = peer.api_server.framing_stats()
+            for name in ('bytes_uncompressed', 'bytes_compressed',
+                         'fragments_sent', 'reassembly_failures'):
+                result[name] = result.get(name, 0) + framing_stats[name]
+            for transport in (peer.api_server.transport,
+                              peer.api_server.stream_transport):
+                if isinstance(transport, netsim.ImpairedTransport):
+                    for name, value in transport.stats().items():
+                        key = 'impaired_' + name
+                        result[key] = result.get(key, 0) + value
+                    transport = transport._transport
+                if isinstance(transport, stream._StreamTransport):
+                    for name, value in transport.stats().items():
+                        result[name] = result.get(name, 0) + value
+        return result
+
+    def rtt(self):
+        """Returns the mean RTT measured by the reliability layer."""
+        rtts = [session['rtt'] for peer in self.players
+                for session in peer.api_server.stats()
+                if session['rtt'] is not None]
+        return sum(rtts) / len(rtts) if rtts else None
+
+    def run(self, changes=100, interval=0.02) -> dict:
+        """Runs the whole scenario and returns the measurements."""
+        join_time = self.join()
+        start = time.monotonic()
+        for _ in range(changes):
+            self.random_change()
+            self.run_for(interval)
+        script_time = time.monotonic() - start
+        start = time.monotonic()
+        converged = self.run_for(CONVERGENCE_TIMEOUT, self.settled)
+        relays = self.master.controller.relays
+        result = {
+            'players': len(self.players),
+            'spectators': len(self.spectators),
+            'relay_depth': max((relays.depth(p.controller.state.player)
+                                for p in self.spectators), default=0),
+            'changes': changes,
+            'join_time': join_time,
+            'script_time': script_time,
+            'converged': converged,
+            'convergence_time': time.monotonic() - start,
+            'version': self.master.campaign.version,
+            'rtt': self.rtt(),
+        }
+        result.update(self.traffic())
+        return result
+
+
+def simulate(campaign_dir='campaign', players=2, changes=100,
+             impairment=None, seed=0, verbose=False, use_stream=False,
+             interval=0.02, spectators=0) -> dict:
+    """Runs a simulation and returns its measurements.
+
+    The output of the game is suppressed unless `verbose` is set.
+    """
+    output = contextlib.suppress() if verbose else \
+        contextlib.redirect_stdout(io.StringIO())
+    with output:
+        simulation = Simulation(campaign_dir, players, impairment, seed,
+                                use_stream, spectators)
+        try:
+            return simulation.run(changes, interval)
+        finally:
+            simulation.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulates a game with synthetic players.')
+    parser.add_argument('--campaign', default='campaign',
+                        help='campaign directory (default: %(default)s)')
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--spectators', type=int, default=0)
+    parser.add_argument('--changes', type=int, default=100)
+    parser.add_argument('--impair', metavar='SPEC',
+                        type=netsim.Impairment.parse,
+                        help='e.g. loss=0.05,delay=0.04,jitter=0.01')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tcp', action='store_true',
+                        help='connect the players over the stream transport')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    result = simulate(args.campaign, args.players, args.changes, args.impair,
+                      args.seed, args.verbose, args.tcp,
+                      spectators=args.spectators)
+    for name, value in result.items():
+        if type(value) is float:
+            value = '{:.3f}'.format(value)
+        print('{:24} {}'.format(name, value))
+
+
+if __name__ == '__main__':
+    main()
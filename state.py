@@ -13,7 +13,8 @@ class State(pyglet.event.EventDispatcher):
 
         self.dragged_token = None
         self._current_page_idx = None
-        if self.player:
+        # The spectators don't have characters.
+        if self.player in campaign.players:
             self._current_char = campaign.players[player].default_character
         else:
             self._current_char = None
@@ -0,0 +1,245 @@
+"""Stream transport of the API, for the networks that mangle UDP.
+
+The frames that `apiserver.ApiServer` would send as datagrams are sent over a
+single TCP connection per player instead, each prefixed with its length. All
+the message types share the connection, in the order in which the send queues
+of `sendqueue` release them, so the priority classes work as over UDP.
+
+The frames written during one iteration of the event loop are passed to the
+socket in a single call, and Nagle's algorithm is disabled, so that a burst of
+small messages goes out at once without waiting for the acknowledgements.
+
+`StreamServer` and `StreamClient` have the interface of the datagram transport
+that `ApiServer` uses, and run in the network thread.
+"""
+
+import asyncio
+import ipaddress
+import socket
+import struct
+
+import framing
+
+_LENGTH = struct.Struct('<I')
+# Longer frames close the connection.
+MAX_FRAME = framing.MAX_MESSAGE_SIZE + 64
+# Frames kept while the connection to the master is being established.
+MAX_PENDING = 1024
+
+
+class StreamError(Exception):
+    pass
+
+
+class FrameReader(object):
+    """Splits the received bytes into length-prefixed frames."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data) -> list:
+        """Returns the frames completed by the data."""
+        self._buffer += data
+        frames = []
+        offset = 0
+        while len(self._buffer) - offset >= _LENGTH.size:
+            size, = _LENGTH.unpack_from(self._buffer, offset)
+            if size > MAX_FRAME:
+                raise StreamError('Frame of {} bytes'.format(size))
+            end = offset + _LENGTH.size + size
+            if len(self._buffer) < end:
+                break
+            frames.append(bytes(self._buffer[offset + _LENGTH.size:end]))
+            offset = end
+        del self._buffer[:offset]
+        return frames
+
+
+class StreamConnection(asyncio.Protocol):
+    """A connection between the master and a player."""
+
+    def __init__(self, owner):
+        self._owner = owner
+        self._reader = FrameReader()
+        self._outgoing = []
+        self.transport = None
+        self.address = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        host, port = transport.get_extra_info('peername')[:2]
+        self.address = ipaddress.ip_address(host).compressed, port
+        self._owner._connected(self)
+
+    def data_received(self, data):
+        try:
+            frames = self._reader.feed(data)
+        except StreamError as e:
+            print('Closing the connection with', self.address, e)
+            self.transport.close()
+            return
+        for frame in frames:
+            self._owner._receive(frame, self.address)
+
+    def connection_lost(self, exc):
+        self._owner._disconnected(self)
+
+    def write(self, frame):
+        """Queues a frame, to be written at the end of the loop iteration."""
+        if not self._outgoing:
+            asyncio.get_event_loop().call_soon(self._flush)
+        self._outgoing.append(_LENGTH.pack(len(frame)))
+        self._outgoing.append(frame)
+        self._owner.frames_written += 1
+
+    def _flush(self):
+        outgoing = self._outgoing
+        self._outgoing = []
+        if not self.transport.is_closing():
+            self.transport.write(b''.join(outgoing))
+            self._owner.writes += 1
+
+
+class _StreamTransport(object):
+    def __init__(self, receive):
+        self._receive = receive
+        self._closing = False
+        # The number of frames and of the socket writes that carried them.
+        self.frames_written = 0
+        self.writes = 0
+
+    def _connected(self, connection):
+        pass
+
+    def _disconnected(self, connection):
+        pass
+
+    def is_closing(self):
+        return self._closing
+
+    def stats(self) -> dict:
+        return {'frames_written': self.frames_written, 'writes': self.writes}
+
+
+class StreamServer(_StreamTransport):
+    """Accepts the connections of the players on the master."""
+
+    def __init__(self, receive):
+        """Creates the transport. Use `start()` to listen.
+
+        Args:
+            receive: function that is called with every received frame and
+              the address of the player.
+        """
+        super().__init__(receive)
+        self._server = None
+        self._connections = {}
+
+    @classmethod
+    async def start(cls, port, receive):
+        transport = cls(receive)
+        transport._server = await asyncio.get_event_loop().create_server(
+            lambda: StreamConnection(transport), host='::', port=port,
+            family=socket.AF_INET6)
+        return transport
+
+    def _connected(self, connection):
+        self._connections[connection.address] = connection
+
+    def _disconnected(self, connection):
+        if self._connections.get(connection.address) is connection:
+            del self._connections[connection.address]
+
+    def sendto(self, data, address=None):
+        connection = self._connections.get(address)
+        if connection is not None:
+            connection.write(data)
+
+    def close(self):
+        self._closing = True
+        self._server.close()
+        for connection in list(self._connections.values()):
+            connection.transport.close()
+
+    def get_extra_info(self, name, default=None):
+        if name == 'sockname':
+            return self._server.sockets[0].getsockname()
+        return default
+
+
+class StreamClient(_StreamTransport):
+    """The connection of a player to the master.
+
+    Connects when the first frame is sent, and reconnects if the connection
+    is lost. The master then sees a new address and asks the player to open
+    a new session.
+    """
+
+    def __init__(self, loop, master, receive):
+        """Creates the transport.
+
+        Args:
+            loop: the event loop of the network thread.
+            master: the address of the master.
+            receive: function that is called with every received frame and
+              the address of the master.
+        """
+        super().__init__(receive)
+        self._loop = loop
+        self._master = master
+        self._connection = None
+        self._connecting = False
+        self._pending = []
+
+    def _connect(self):
+        self._connecting = True
+        connect = self._loop.create_connection(
+            lambda: StreamConnection(self), host=self._master[0],
+            port=self._master[1], family=socket.AF_INET6)
+        self._loop.create_task(connect).add_done_callback(self._on_connect)
+
+    def _on_connect(self, task):
+        self._connecting = False
+        if task.cancelled() or task.exception() is not None:
+            print('Failed to connect to the master:',
+                  None if task.cancelled() else task.exception())
+            self._pending.clear()
+            return
+        if self._closing:
+            task.result()[0].close()
+
+    def _connected(self, connection):
+        # The master is known by the address that the player has been given.
+        connection.address = self._master
+        self._connection = connection
+        for data in self._pending:
+            connection.write(data)
+        self._pending.clear()
+
+    def _disconnected(self, connection):
+        if self._connection is connection:
+            self._connection = None
+
+    def sendto(self, data, address=None):
+        if self._closing:
+            return
+        if self._connection is not None:
+            self._connection.write(data)
+            return
+        if len(self._pending) < MAX_PENDING:
+            self._pending.append(data)
+        if not self._connecting:
+            self._connect()
+
+    def close(self):
+        self._closing = True
+        if self._connection is not None:
+            self._connection.transport.close()
+
+    def get_extra_info(self, name, default=None):
+        if name == 'sockname' and self._connection is not None:
+            return self._connection.transport.get_extra_info('sockname')
+        return default
@@ -0,0 +1,257 @@
+import json
+import os
+import socket
+import time
+import unittest
+from unittest.mock import patch
+
+import apiserver
+import framing
+import netloop
+import wire
+
+
+class ValidateTest(unittest.TestCase):
+    def test_validate(self):
+        self.assertTrue(apiserver.validate(
+            {'method': 'hi', 'params': {'player': 'El'}}))
+        self.assertTrue(apiserver.validate({'method': 'ack', 'ack': 3}))
+        self.assertFalse(apiserver.validate([]))
+        self.assertFalse(apiserver.validate({'method': 1}))
+        self.assertFalse(apiserver.validate({'method': 'hi', 'params': 1}))
+        self.assertFalse(apiserver.validate({'method': 'hi', 'params': {}}))
+        self.assertFalse(apiserver.validate({'method': 'ack', 'ack': 'x'}))
+        self.assertFalse(apiserver.validate(
+            {'method': 'ack', 'ack': 1, 'sack': [2, -1]}))
+        self.assertFalse(apiserver.validate({
+            'method': 'token_temp_position_changed',
+            'params': {'token_id': [1], 'position': [0, 0]}
+        }))
+        self.assertTrue(apiserver.validate({
+            'method': 'update_token',
+            'params': {'token': {'id': 1, 'position': [0, 1.5]}}
+        }))
+        self.assertFalse(apiserver.validate({
+            'method': 'update_token',
+            'params': {'token': {'id': 1, 'position': ['0', 1]}}
+        }))
+        self.assertFalse(apiserver.validate({
+            'method': 'player_chat',
+            'params': {'message': {'text': 'x' * 100000}}
+        }))
+        self.assertFalse(apiserver.validate(
+            {'method': 'sync', 'params': {'since': -1}}))
+        self.assertFalse(apiserver.validate(
+            {'method': 'hi', 'params': {'player': 'El', 'wire': 1}}))
+        self.assertFalse(apiserver.validate(
+            {'method': 'hi', 'params': {'player': 'El', 'wire': ['1']}}))
+        self.assertFalse(apiserver.validate(
+            {'method': 'hi', 'params': {'player': 'El', 'session': 1}}))
+        self.assertTrue(apiserver.validate({
+            'method': 'hi',
+            'params': {'player': 'El', 'session': 'ab', 'wire': [1, 0]}
+        }))
+
+
+class ApiServerTest(unittest.TestCase):
+    CHAT = {'message': {'text': 'Hi'}}
+
+    def setUp(self):
+        self.net = netloop.NetworkLoop()
+        self.server = apiserver.ApiServer(self.net, port=0)
+        self.port = self.server.transport.get_extra_info('sockname')[1]
+        self.clients = []
+        self.received = []
+        self.server.push_handlers(on_api_request=lambda request, address:
+                                  self.received.append(request))
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.shutdown()
+        self.net.stop()
+        self.net.join()
+
+    def client(self):
+        client = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        client.bind(('::1', 0))
+        self.clients.append(client)
+        return client
+
+    def send(self, client, message):
+        client.sendto(json.dumps(message).encode('utf-8'), ('::1', self.port))
+
+    def connect(self, player):
+        client = self.client()
+        self.send(client, {
+            'method': 'hi',
+            'params': {'player': player, 'session': player},
+            'seq': 1
+        })
+        self.wait_inbox(1)
+        self.server.drain()
+        self.received.clear()
+        return client, apiserver.normalize_address(client.getsockname())
+
+    def wait_inbox(self, n):
+        for _ in range(100):
+            if len(self.server._inbox) >= n:
+                return
+            time.sleep(0.01)
+        self.fail('Timed out')
+
+    def test_drain_coalesces_temp_positions(self):
+        client, _ = self.connect('El')
+        for i in range(4):
+            self.send(client, {
+                'method': 'token_temp_position_changed',
+                'params': {'token_id': i % 2, 'position': [i, i]}
+            })
+        self.send(client,
+                  {'method': 'new_chat', 'params': self.CHAT, 'seq': 2})
+        self.send(client, ['not', 'a', 'message'])
+        self.wait_inbox(5)
+        self.server.drain()
+        self.assertEqual(self.received, [
+            {'method': 'token_temp_position_changed',
+             'params': {'token_id': 0, 'position': [2, 2]}},
+            {'method': 'token_temp_position_changed',
+             'params': {'token_id': 1, 'position': [3, 3]}},
+            {'method': 'new_chat', 'params': self.CHAT},
+        ])
+
+    def test_drain_budget(self):
+        client, _ = self.connect('El')
+        self.server.drain_budget = 0
+        for i in range(3):
+            self.send(client, {'method': 'new_chat', 'params': self.CHAT,
+                               'seq': i + 2})
+        self.wait_inbox(3)
+        self.server.drain()
+        self.assertEqual(len(self.received), 1)
+        self.server.drain()
+        self.assertEqual(len(self.received), 2)
+
+    def test_unknown_peer(self):
+        client = self.client()
+        client.settimeout(1)
+        self.send(client,
+                  {'method': 'new_chat', 'params': self.CHAT, 'seq': 1})
+        data, _ = client.recvfrom(1024)
+        self.assertEqual(json.loads(data), {'method': 'reconnect'})
+        self.assertEqual(len(self.server.sessions), 0)
+
+    def test_reconnect_from_player(self):
+        client, address = self.connect('El')
+        self.send(client, {'method': 'reconnect'})
+        self.send(client, {'method': 'ping', 'params': {'t': 0}})
+        for _ in range(100):
+            if self.server.sessions.get(address).packets_in == 3:
+                break
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.assertFalse(self.server.transport.is_closing())
+        self.assertEqual(len(self.server.sessions), 1)
+
+    @patch('reliable.MAX_RETRANSMITS', 0)
+    def test_lost_message(self):
+        client, address = self.connect('El')
+        client.settimeout(2)
+        self.server.send({'method': 'new_chat', 'params': self.CHAT},
+                         address)
+        # Not acknowledged, so the session is replaced.
+        methods = []
+        while 'reconnect' not in methods:
+            data, _ = client.recvfrom(1024)
+            methods.append(wire.decode(data)['method'])
+        self.assertIsNone(self.server.sessions.get(address))
+
+    def test_sessions(self):
+        _, address_a = self.connect('A')
+        client_b, address_b = self.connect('B')
+        self.assertEqual(len(self.server.sessions), 2)
+        stats = {s['player']: s for s in self.server.stats()}
+        self.assertEqual(stats['A']['packets_in'], 1)
+
+        # B reconnects from another address.
+        _, address_b2 = self.connect('B')
+        self.assertEqual(len(self.server.sessions), 2)
+        self.assertIsNone(self.server.sessions.get(address_b))
+        self.assertEqual(self.server.sessions.get(address_b2).player, 'B')
+
+    def test_interest(self):
+        _, a = self.connect('A')
+        _, b = self.connect('B')
+        self.assertFalse(self.server.set_player_page(a, 0))
+        self.assertFalse(self.server.set_player_page(b, 1))
+        self.assertEqual([s.address for s in self.server._interested(0)], [a])
+        self.assertEqual(len(self.server._interested(None)), 2)
+        # Player B has missed the changes on page 0.
+        self.assertTrue(self.server.set_player_page(b, 0))
+        self.assertFalse(self.server.set_player_page(a, 0))
+
+    def test_rate_limit(self):
+        client, address = self.connect('El')
+        for i in range(50):
+            self.send(client, {
+                'method': 'token_temp_position_changed',
+                'params': {'token_id': 1, 'position': [i, i]}
+            })
+        self.send(client, {'method': 'player_chat', 'params': {}, 'seq': 2})
+        self.send(client, {'method': 'ping', 'params': {'t': 0}})
+        for _ in range(100):
+            session = self.server.sessions.get(address)
+            if session.packets_in == 52:
+                break
+            time.sleep(0.01)
+        stats = self.server.stats()[0]
+        self.assertEqual(stats['throttled'], 20)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(len(self.server._inbox), 30)
+
+    def test_large_messages(self):
+        client, address = self.connect('A')
+        client.settimeout(1)
+        self.server.set_wire_version(address, wire.BINARY_V1)
+        text = os.urandom(10000).hex()
+        self.server.send({'method': 'new_chat',
+                          'params': {'message': {'text': text}}}, address)
+        reassembler = framing.Reassembler()
+        frame = None
+        while frame is None:
+            data, _ = client.recvfrom(2048)
+            self.assertLessEqual(len(data), framing.MAX_DATAGRAM)
+            frame = reassembler.receive(address, data)
+        message = wire.decode(framing.decompress(frame))
+        self.assertEqual(message['params']['message']['text'], text)
+        stats = self.server.framing_stats()
+        self.assertLess(stats['compression_ratio'], 1)
+        self.assertGreater(stats['fragments_sent'], 1)
+
+        # And in the other direction.
+        frame = framing.compress(wire.encode(
+            {'method': 'page_snapshot', 'params': {'text': text}, 'seq': 2},
+            wire.BINARY_V1))
+        for data in reversed(framing.fragment(frame)):
+            client.sendto(data, ('::1', self.port))
+        self.wait_inbox(1)
+        self.server.drain()
+        self.assertEqual(self.received[0]['params']['text'], text)
+        self.assertEqual(self.server.framing_stats()['reassembled'], 1)
+
+    def test_large_json_messages(self):
+        # The peers that haven't negotiated the binary encoding can't
+        # reassemble the fragments.
+        client, address = self.connect('A')
+        client.settimeout(1)
+        text = os.urandom(2000).hex()
+        self.server.send({'method': 'new_chat',
+                          'params': {'message': {'text': text}}}, address)
+        data, _ = client.recvfrom(65536)
+        self.assertGreater(len(data), framing.MAX_DATAGRAM)
+        self.assertEqual(json.loads(data)['params']['message']['text'], text)
+        self.assertEqual(self.server.framing_stats()['fragments_sent'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
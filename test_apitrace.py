@@ -0,0 +1,116 @@
+import copy
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import apitrace
+from campaign import Campaign
+from controller import Controller
+import replay
+from state import State
+import test_campaign
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TraceRecorderTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_round_trip(self):
+        clock = FakeClock()
+        recorder = apitrace.TraceRecorder(self.path, clock=clock)
+        message = {'method': 'player_chat', 'params': {'message': {}}}
+        clock.now += 0.5
+        recorder.record(apitrace.IN, ('::1', 2216), message)
+        # Changes made after recording don't affect the trace.
+        message['params']['message']['text'] = 'changed'
+        clock.now += 0.25
+        recorder.record(apitrace.OUT, ('::1', 2216), {'method': 'new_chat'})
+        recorder.close()
+        recorder.record(apitrace.OUT, ('::1', 2216), {'method': 'ignored'})
+
+        records = apitrace.read_trace(self.path)
+        self.assertEqual(records, [
+            {'t': 0.5, 'dir': 'in', 'peer': ('::1', 2216),
+             'message': {'method': 'player_chat',
+                         'params': {'message': {}}}},
+            {'t': 0.75, 'dir': 'out', 'peer': ('::1', 2216),
+             'message': {'method': 'new_chat'}},
+        ])
+        self.assertEqual(recorder.count, 2)
+
+
+@patch('pyglet.image.load')
+class ReplayTest(unittest.TestCase):
+    PLAYER = ('::1', 2216)
+
+    def test_replay_master(self, load):
+        data = copy.deepcopy(test_campaign.CampaignVersionTest.DATA)
+        data['characters'] = {
+            'pc': {'fragment': 'f', 'name': 'Aengus', 'player': 'Aengus'}
+        }
+        data['pages'][0]['tokens'][0] = {'id': 1, 'character': 'pc',
+                                         'position': [0, 0]}
+        campaign = Campaign(test_campaign.FakeProvider(data))
+        api_server = replay.ReplayApiServer()
+        controller = Controller(State(campaign, None), api_server)
+        records = [
+            {'t': 0, 'dir': 'in', 'peer': self.PLAYER,
+             'message': {'method': 'hi',
+                         'params': {'player': 'Aengus', 'wire': [0]}}},
+            {'t': 0.001, 'dir': 'in', 'peer': self.PLAYER,
+             'message': {'method': 'ping', 'params': {'t': 1}}},
+            {'t': 0.001, 'dir': 'out', 'peer': self.PLAYER,
+             'message': {'method': 'hi_ack', 'params': {'wire': 0}}},
+            {'t': 0.002, 'dir': 'in', 'peer': self.PLAYER,
+             'message': {'method': 'update_token',
+                         'params': {'token': {'id': 1,
+                                              'position': [3, 4]}}}},
+            # The player doesn't control this token.
+            {'t': 0.002, 'dir': 'in', 'peer': self.PLAYER,
+             'message': {'method': 'update_token',
+                         'params': {'token': {'id': 2,
+                                              'position': [3, 4]}}}},
+            {'t': 0.003, 'dir': 'in', 'peer': self.PLAYER,
+             'message': {'method': 'player_chat',
+                         'params': {'message': {'player': 'El',
+                                                'text': 'Hi'}}}},
+        ]
+        result = replay.replay(records, controller)
+        controller.movement.close()
+
+        self.assertEqual(result['count'], 4)
+        self.assertEqual(sorted(result['latencies']),
+                         ['hi', 'player_chat', 'update_token'])
+        self.assertGreaterEqual(result['elapsed'], 0.003)
+        self.assertEqual(list(campaign.tokens[1].position), [3, 4])
+        self.assertEqual(campaign.tokens[2].position, [0, 0])
+        self.assertEqual(api_server.sessions.get(self.PLAYER).dropped, 1)
+        # The sender of the chat message is set by the master.
+        self.assertEqual(campaign._data['chat'][-1]['player'], 'Aengus')
+        self.assertEqual(campaign.version, 2)
+        # hi_ack, update_token and new_chat.
+        self.assertEqual(api_server.sent, 3)
+
+    def test_percentile(self, load):
+        values = list(range(1, 101))
+        self.assertEqual(replay.percentile(values, 50), 50)
+        self.assertEqual(replay.percentile(values, 99), 99)
+        self.assertEqual(replay.percentile([7], 90), 7)
+        self.assertIsNone(replay.percentile([], 50))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import tempfile
+import unittest
+
+from assetcache import AssetCache, content_hash
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+class AssetCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.clock = FakeClock()
+        self.cache = AssetCache(self.dir.name, max_size=250, clock=self.clock)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_content_addressed(self):
+        self.cache.put('a/1.png', b'x' * 100)
+        self.cache.put('b/1.png', b'x' * 100, content_hash(b'x' * 100))
+        self.assertEqual(self.cache.size(), 100)
+        self.assertEqual(self.cache.etag('b/1.png'),
+                         content_hash(b'x' * 100))
+        self.assertEqual(self.cache.get('a/1.png'), b'x' * 100)
+        self.assertEqual(self.cache.get_object(content_hash(b'x' * 100)),
+                         b'x' * 100)
+        self.assertIsNone(self.cache.get('a/2.png'))
+        self.assertIsNone(self.cache.get_object(content_hash(b'y')))
+
+        # A wrong ETag is not trusted.
+        self.cache.put('a/2.png', b'y', 'abc')
+        self.assertEqual(self.cache.etag('a/2.png'), content_hash(b'y'))
+
+    def test_lru(self):
+        self.cache.put('1', b'1' * 100)
+        self.cache.put('2', b'2' * 100)
+        self.cache.get('1')
+        self.cache.put('3', b'3' * 100)
+        self.assertIsNone(self.cache.get('2'))
+        self.assertEqual(self.cache.get('1'), b'1' * 100)
+        self.assertEqual(len(os.listdir(os.path.join(self.dir.name,
+                                                     'objects'))), 2)
+
+    def test_persistent(self):
+        self.cache.put('1', b'1' * 100)
+        self.cache.put('2', b'2' * 100)
+        os.remove(os.path.join(self.dir.name, 'objects',
+                               content_hash(b'2' * 100)))
+        cache = AssetCache(self.dir.name)
+        self.assertEqual(cache.get('1'), b'1' * 100)
+        self.assertIsNone(cache.etag('2'))
+
+    def test_saved_uses(self):
+        self.cache.put('1', b'1' * 100)
+        self.cache.put('2', b'2' * 100)
+        self.cache.get('1')
+        self.cache.save()
+        cache = AssetCache(self.dir.name, max_size=250, clock=self.clock)
+        cache.put('3', b'3' * 100)
+        self.assertIsNone(cache.etag('2'))
+        self.assertEqual(cache.get('1'), b'1' * 100)
+
+    def test_damaged(self):
+        self.cache.put('1', b'1' * 100)
+        with open(os.path.join(self.dir.name, 'objects',
+                               content_hash(b'1' * 100)), 'wb') as file:
+            file.write(b'2')
+        self.assertIsNone(self.cache.get('1'))
+        self.assertIsNone(self.cache.etag('1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+import copy
+import io
+import json
+import unittest
+from unittest.mock import MagicMock, Mock, patch
+
+import campaign
+from campaign import Campaign, Page
+
+
+class VeilsTest(unittest.TestCase):
+    def setUp(self):
+        self.data = {
+            'tokens': [],
+            'veils': [
+                {'covered': True, 'minx': 0, 'miny': 0, 'maxx': 2, 'maxy': 2},
+                {'covered': False, 'minx': 2, 'miny': 0, 'maxx': 4,
+                 'maxy': 2},
+            ]
+        }
+        self.master_campaign = MagicMock()
+        self.master = Page(0, self.data, self.master_campaign)
+        self.player = Page(0, copy.deepcopy(self.data), Mock())
+
+    def patches(self):
+        return [c[0][1:] for c in
+                self.master_campaign.dispatch_event.call_args_list
+                if c[0][0] == 'on_veils_patched']
+
+    def test_ids(self):
+        self.assertEqual([v['id'] for v in self.master.veils], [1, 2])
+
+    def test_toggle(self):
+        self.master.toggle_veil(1, 1)
+        self.master.toggle_veil(10, 10)
+        self.assertEqual(self.patches(), [
+            (0, 1, [{'id': 1, 'covered': False, 'minx': 0, 'miny': 0,
+                     'maxx': 2, 'maxy': 2}], [])
+        ])
+        _, version, changed, removed = self.patches()[0]
+        self.assertTrue(self.player.apply_veils_patch(
+            version, copy.deepcopy(changed), removed))
+        self.assertEqual(self.player.veils, self.master.veils)
+        self.assertEqual(self.player.veils_version, 1)
+
+    def test_add_remove(self):
+        veil_id = self.master.add_veil(5, 5, 6, 6)
+        self.master.remove_veil(1)
+        for _, version, changed, removed in self.patches():
+            self.assertTrue(self.player.apply_veils_patch(
+                version, copy.deepcopy(changed), removed))
+        self.assertEqual(self.player.veils, self.master.veils)
+        self.assertEqual([v['id'] for v in self.player.veils], [2, veil_id])
+
+    def test_gap(self):
+        self.master.toggle_veil(1, 1)
+        self.master.toggle_veil(3, 1)
+        _, version, changed, removed = self.patches()[1]
+        self.assertFalse(self.player.apply_veils_patch(
+            version, changed, removed))
+        self.player.set_veils(copy.deepcopy(self.master.veils),
+                              self.master.veils_version)
+        self.assertEqual(self.player.veils, self.master.veils)
+        # Patches that were already applied are ignored.
+        self.assertTrue(self.player.apply_veils_patch(
+            version, changed, removed))
+
+    def test_covers(self):
+        self.master.add_veil(0, 2, 4, 3)
+        self.assertTrue(self.master.covers(0.5, 0.5, 1.5, 1.5))
+        # Not covered by any of the veils alone.
+        self.assertTrue(self.master.covers(0.5, 1.5, 1.5, 2.5))
+        self.assertFalse(self.master.covers(3, 1, 3.5, 1.5))
+        self.assertFalse(self.master.covers(1, 2.5, 1.5, 3.5))
+        self.assertFalse(self.master.covers(10, 10, 11, 11))
+
+
+class PageSnapshotTest(unittest.TestCase):
+    def test_snapshot(self):
+        data = {
+            'tokens': [{'id': 1, 'fragment': 'f', 'position': [0, 0]}],
+            'veils': [{'covered': True, 'minx': 0, 'miny': 0, 'maxx': 2,
+                       'maxy': 2}]
+        }
+        campaign = MagicMock()
+        campaign.fragments = {'f': Mock()}
+        master = Page(3, data, campaign)
+        player = Page(3, copy.deepcopy(data), campaign)
+        master.tokens[0].set_position(5, 6)
+        master.toggle_veil(1, 1)
+
+        player.apply_snapshot(copy.deepcopy(master.snapshot()))
+        self.assertEqual(player.tokens[0].position, (5, 6))
+        self.assertEqual(player.tokens[0].page_id, 3)
+        self.assertEqual(player.veils, master.veils)
+        self.assertEqual(player.veils_version, 1)
+
+
+class FakeProvider(object):
+    can_save = False
+
+    def __init__(self, data):
+        self.data = data
+
+    def open(self, path):
+        return io.BytesIO(json.dumps(self.data).encode('utf-8'))
+
+
+@patch('pyglet.image.load')
+class CampaignVersionTest(unittest.TestCase):
+    DATA = {
+        'fragments': {'f': {'path': 'f.png', 'type': 'token'}},
+        'characters': {'pc': {'fragment': 'f', 'name': 'El', 'hp': 5,
+                              'maxhp': 8}},
+        'pages': [{'tokens': [{'id': 1, 'fragment': 'f',
+                               'position': [0, 0]}]},
+                  {'tokens': [{'id': 2, 'fragment': 'f',
+                               'position': [0, 0]}]}],
+        'players': {},
+        'players_page': 0
+    }
+
+    def test_changes_since(self, load):
+        c = Campaign(FakeProvider(self.DATA))
+        self.assertEqual(c.version, 0)
+        self.assertEqual(c.changes_since(0), [])
+        messages = [{'method': str(i)} for i in range(3)]
+        for message in messages:
+            c.record(message, page=1)
+        self.assertEqual(c.version, 3)
+        self.assertEqual([m['version'] for m in messages], [1, 2, 3])
+        self.assertEqual(c.changes_since(1),
+                         [(messages[1], 1), (messages[2], 1)])
+        self.assertEqual(c.changes_since(3), [])
+
+    def test_history_copies(self, load):
+        c = Campaign(FakeProvider(self.DATA))
+        veil = {'id': 1, 'covered': True}
+        c.record({'method': 'veils_patch', 'params': {'veils': [veil]}})
+        veil['covered'] = False
+        message, _ = c.changes_since(0)[0]
+        self.assertTrue(message['params']['veils'][0]['covered'])
+
+    def test_history_rollover(self, load):
+        c = Campaign(FakeProvider(self.DATA))
+        for i in range(campaign.HISTORY_SIZE + 2):
+            c.record({'method': 'new_chat'})
+        self.assertIsNone(c.changes_since(1))
+        self.assertEqual(len(c.changes_since(2)), campaign.HISTORY_SIZE)
+
+    def test_snapshot(self, load):
+        master = Campaign(FakeProvider(self.DATA))
+        player = Campaign(FakeProvider(self.DATA))
+        master.tokens[2].set_position(3, 4)
+        master.characters['pc'].set_hp(2, 8)
+        master.add_chat({'player': None, 'text': 'Hello'})
+        master.players_page_idx = 1
+
+        player.apply_snapshot(json.loads(json.dumps(master.snapshot())))
+        self.assertEqual(player.tokens[2].position, [3, 4])
+        self.assertEqual(player.players_page_idx, 1)
+        self.assertEqual(player._data['chat'], master._data['chat'])
+        self.assertEqual(player.characters['pc'].hp, 2)
+
+    def test_patch(self, load):
+        c = Campaign(FakeProvider(self.DATA))
+        patched = Mock()
+        c.push_handlers(on_entity_patched=patched)
+        token = c.tokens[1]
+        token.set_temp_position(5, 5, notify=False)
+        c.patch('token', 1, {'position': [2, 3], 'player': 'El'})
+        self.assertEqual(token.position, [2, 3])
+        self.assertEqual(token.temp_position, [2, 3])
+        self.assertIs(token._data, c._data['pages'][0]['tokens'][0])
+        c.patch('token', 1, unset=['player'], notify=False)
+        self.assertNotIn('player', token._data)
+        c.patch('page', 1, {'name': 'Cave'})
+        self.assertEqual(c._data['pages'][1]['name'], 'Cave')
+        c.patch('campaign', None, {'title': 'Test'})
+        self.assertEqual(c._data['title'], 'Test')
+        self.assertEqual(patched.call_count, 3)
+        patched.assert_called_with('campaign', None, {'title': 'Test'}, [])
+        for entity, id in (('token', 7), ('page', 2), ('character', 'x'),
+                           ('veil', 1)):
+            with self.assertRaises(KeyError):
+                c.patch(entity, id, {'a': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,412 @@
+import copy
+import json
+import unittest
+from unittest.mock import ANY, patch
+
+from campaign import Campaign
+from controller import Controller, PENDING_OP_TIMEOUT
+import relay
+import replay
+from state import State
+import test_campaign
+
+MASTER = ('::1', 2215)
+PLAYER = ('::1', 2216)
+SPECTATOR = ('::1', 2217)
+
+
+class LinkedApiServer(replay.ReplayApiServer):
+    """Keeps the sent messages until they are delivered by the test."""
+
+    def __init__(self, master=None):
+        super().__init__(master)
+        self.outbox = []
+
+    def _queue(self, request, session, data):
+        self.outbox.append(json.loads(json.dumps(request)))
+        super()._queue(request, session, data)
+
+    def deliver(self, peer, address, count=None):
+        """Dispatches the sent messages to the peer as if from `address`."""
+        count = len(self.outbox) if count is None else count
+        messages = self.outbox[:count]
+        del self.outbox[:count]
+        for message in messages:
+            peer.received(message, address)
+            peer.dispatch_event('on_api_request', message, address)
+
+
+class ControllerTestCase(unittest.TestCase):
+    """Connects a master and a player."""
+
+    def setUp(self):
+        data = copy.deepcopy(test_campaign.CampaignVersionTest.DATA)
+        data['characters'] = {
+            'pc': {'fragment': 'f', 'name': 'Aengus', 'player': 'Aengus',
+                   'hp': 10, 'maxhp': 10},
+            'npc': {'fragment': 'f', 'name': 'Goblin', 'hp': 5, 'maxhp': 5}
+        }
+        data['players'] = {'Aengus': {'default_character': 'pc'}}
+        data['pages'][0]['tokens'].append(
+            {'id': 3, 'character': 'pc', 'position': [0, 0]})
+        self.data = data
+
+    def connect(self):
+        self.master = Campaign(test_campaign.FakeProvider(self.data))
+        self.player = Campaign(test_campaign.FakeProvider(self.data))
+        self.master_server = LinkedApiServer()
+        self.player_server = LinkedApiServer(MASTER)
+        self.controllers = [
+            Controller(State(self.master, None), self.master_server),
+            Controller(State(self.player, 'Aengus'), self.player_server),
+        ]
+        self.handshake(self.master_server, self.player_server, PLAYER,
+                       {'player': 'Aengus'})
+
+    def handshake(self, server, client, address, params):
+        """Opens a session: `hi`, `hi_ack` and the catch-up sync."""
+        hi = {'method': 'hi', 'params': params}
+        server.received(hi, address)
+        server.dispatch_event('on_api_request', hi, address)
+        server.deliver(client, MASTER)
+        client.deliver(server, address)
+        server.deliver(client, MASTER)
+
+    def tearDown(self):
+        for controller in self.controllers:
+            controller.movement.close()
+
+    def to_master(self):
+        self.player_server.deliver(self.master_server, PLAYER)
+
+    def to_player(self, count=None):
+        self.master_server.deliver(self.player_server, MASTER, count)
+
+
+@patch('pyglet.image.load')
+class TokenMoveTest(ControllerTestCase):
+    def test_concurrent_moves(self, load):
+        self.connect()
+        self.player.tokens[3].set_position(3, 4)
+        self.master.tokens[3].set_position(7, 7)
+        self.to_master()
+        self.assertEqual(list(self.master.tokens[3].position), [3, 4])
+
+        # The move of the master doesn't snap the token back.
+        self.to_player(1)
+        self.assertEqual(list(self.player.tokens[3].position), [3, 4])
+        self.assertEqual(self.player.version, 1)
+        self.to_player()
+        self.assertEqual(list(self.player.tokens[3].position), [3, 4])
+        self.assertEqual(self.player.version, 2)
+        self.assertEqual(self.controllers[1]._pending_ops, {})
+
+        # Updates of the token that isn't being moved apply immediately.
+        self.master.tokens[3].set_position(1, 1)
+        self.to_player()
+        self.assertEqual(list(self.player.tokens[3].position), [1, 1])
+
+    def test_several_pending_moves(self, load):
+        self.connect()
+        self.player.tokens[3].set_position(1, 0)
+        self.player.tokens[3].set_position(2, 0)
+        self.to_master()
+        self.to_player(1)
+        self.assertEqual(list(self.player.tokens[3].position), [2, 0])
+        self.assertEqual(self.controllers[1]._pending_ops,
+                         {('token', 3): [(2, ['position'], ANY)]})
+        self.to_player()
+        self.assertEqual(list(self.player.tokens[3].position), [2, 0])
+        self.assertEqual(self.controllers[1]._pending_ops, {})
+
+    def test_lost_with_session(self, load):
+        self.connect()
+        self.player.tokens[3].set_position(4, 4)
+        self.player_server.outbox.clear()
+        self.master_server.sessions.close(
+            self.master_server.sessions.get(PLAYER))
+        self.handshake(self.master_server, self.player_server, PLAYER,
+                       {'player': 'Aengus'})
+        self.assertEqual(list(self.master.tokens[3].position), [4, 4])
+        self.assertEqual(self.controllers[1]._pending_ops, {})
+
+    def test_unconfirmed_timeout(self, load):
+        self.connect()
+        now = [0]
+        self.controllers[1]._clock = lambda: now[0]
+        self.player.tokens[3].set_position(4, 4)
+        self.player_server.outbox.clear()
+        self.master.tokens[3].set_position(7, 7)
+        self.to_player()
+        self.assertEqual(list(self.player.tokens[3].position), [4, 4])
+        now[0] += PENDING_OP_TIMEOUT + 1
+        self.master.tokens[3].set_position(8, 8)
+        self.to_player()
+        self.assertEqual(list(self.player.tokens[3].position), [8, 8])
+        self.assertEqual(self.controllers[1]._pending_ops, {})
+
+    def test_rejected(self, load):
+        self.connect()
+        # The player doesn't control this token.
+        self.player.tokens[1].set_position(5, 5)
+        self.to_master()
+        self.assertEqual(self.master.tokens[1].position, [0, 0])
+        self.assertEqual(self.master_server.outbox[0]['method'],
+                         'patch_rejected')
+        self.to_player()
+        self.assertEqual(self.player.tokens[1].position, [0, 0])
+        self.assertEqual(self.controllers[1]._pending_ops, {})
+
+    def test_hp(self, load):
+        self.connect()
+        self.player.characters['pc'].set_hp(7, 12)
+        self.assertEqual(self.player_server.outbox, [{
+            'method': 'patch',
+            'params': {'entity': 'character', 'id': 'pc',
+                       'set': {'hp': 7, 'maxhp': 12}, 'op': 1}
+        }])
+        self.to_master()
+        self.assertEqual(self.master.characters['pc'].hp, 7)
+        self.master.characters['npc'].set_hp(1, 5)
+        self.to_player()
+        self.assertEqual(self.player.characters['pc'].maxhp, 12)
+        self.assertEqual(self.player.characters['npc'].hp, 1)
+        self.assertEqual(self.controllers[1]._pending_ops, {})
+
+    def test_forbidden_fields(self, load):
+        self.connect()
+        self.player.patch('token', 3, {'fragment': 'g'}, ['position'])
+        self.player.patch('character', 'npc', {'hp': 0})
+        self.player.patch('campaign', None, {'players_page': 1})
+        self.to_master()
+        self.assertNotIn('fragment', self.master.tokens[3]._data)
+        self.assertEqual(self.master.characters['npc'].hp, 5)
+        self.assertEqual(self.master.players_page_idx, 0)
+        self.assertEqual(
+            self.master_server.sessions.get(PLAYER).dropped, 3)
+        self.to_player()
+        self.assertEqual(self.player.tokens[3]._data,
+                         self.master.tokens[3]._data)
+        self.assertEqual(self.player.characters['npc'].hp, 5)
+        self.assertEqual(self.player.players_page_idx, 0)
+
+    def test_invalid_values(self, load):
+        self.connect()
+        self.player.patch('token', 3, {'position': 'xy'})
+        self.player.patch('character', 'pc', {'maxhp': 0})
+        self.player.patch('character', 'pc', {'hp': '7'})
+        self.player.patch('character', 'pc', {}, ['hp'])
+        self.to_master()
+        self.assertEqual(self.master.tokens[3].position, [0, 0])
+        self.assertEqual(self.master.characters['pc'].hp, 10)
+        self.assertEqual(self.master.characters['pc'].maxhp, 10)
+        self.assertEqual(
+            self.master_server.sessions.get(PLAYER).dropped, 4)
+
+    def test_forbidden_methods(self, load):
+        self.connect()
+        patch = {'entity': 'token', 'id': 1, 'set': {'position': [9, 9]}}
+        requests = [
+            {'method': 'state_snapshot', 'version': 9,
+             'params': self.master.snapshot()},
+            {'method': 'veils_updated', 'params': {'page_id': 0,
+                                                   'veils': []}},
+            {'method': 'page_changed', 'params': {'players_page': 1}},
+            {'method': 'patch_batch', 'params': {'patches': [patch]}},
+            {'method': 'patch_rejected', 'params': dict(patch, op=1)},
+            {'method': 'new_chat', 'params': {'message': {'text': 'Hi'}}},
+            {'method': 'relay_parent', 'params': {'parent': ['::1', 1]}},
+            {'method': 'veils_resync', 'params': {'page_id': 7}},
+        ]
+        for request in requests:
+            self.master_server.dispatch_event('on_api_request', request,
+                                              PLAYER)
+        self.assertEqual(
+            self.master_server.sessions.get(PLAYER).dropped, len(requests))
+        self.assertEqual(self.master.tokens[1].position, [0, 0])
+        self.assertEqual(self.master.players_page_idx, 0)
+        self.assertEqual(self.master.version, 0)
+
+
+@patch('pyglet.image.load')
+class SyncTest(ControllerTestCase):
+    def test_change_before_sync(self, load):
+        self.connect()
+        # The player reconnects after missing a change.
+        self.master_server.sessions.close(
+            self.master_server.sessions.get(PLAYER))
+        self.master.tokens[1].set_position(1, 1)
+        hi = {'method': 'hi', 'params': {'player': 'Aengus'}}
+        self.master_server.received(hi, PLAYER)
+        self.master_server.dispatch_event('on_api_request', hi, PLAYER)
+        # A live change overtakes the answer to the sync.
+        self.master.tokens[3].set_position(2, 2)
+        self.to_player()
+        self.assertEqual(self.player.version, 0)
+        self.to_master()
+        self.to_player()
+        self.assertEqual(list(self.player.tokens[1].position), [1, 1])
+        self.assertEqual(list(self.player.tokens[3].position), [2, 2])
+        self.assertEqual(self.player.version, 2)
+
+
+@patch('pyglet.image.load')
+class FogTest(ControllerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data['fragments']['f'].update(width=1, height=1)
+        self.data['pages'][0]['veils'] = [
+            {'covered': True, 'minx': -1, 'miny': -1, 'maxx': 2, 'maxy': 4},
+            {'covered': True, 'minx': 2, 'miny': -1, 'maxx': 4, 'maxy': 4},
+        ]
+
+    def methods(self):
+        return [message['method'] for message in self.master_server.outbox]
+
+    def test_hidden_tokens(self, load):
+        self.connect()
+        token = self.master.tokens[1]
+        token.set_temp_position(1, 1)
+        self.controllers[0].movement.flush()
+        token.set_position(1, 1)
+        self.assertEqual(self.methods(), [])
+
+        # Leaves the fog and comes back.
+        token.set_position(5, 5)
+        token.set_position(1.5, 1)
+        token.set_position(2.5, 2)
+        self.assertEqual(self.methods(), ['patch', 'patch'])
+        self.to_player()
+        self.assertEqual(self.player.tokens[1].position, [1.5, 1])
+
+        # The player's own character is never hidden.
+        self.master.tokens[3].set_position(1, 1)
+        self.assertEqual(self.methods(), ['patch'])
+        self.to_player()
+
+        # The withheld state is sent before the veil is lifted.
+        self.master.pages[0].toggle_veil(3, 0)
+        self.assertEqual(self.methods(), ['patch_batch', 'veils_patch'])
+        self.to_player()
+        self.assertEqual(self.player.tokens[1].position, [2.5, 2])
+        self.assertEqual(self.player.pages[0].veils,
+                         self.master.pages[0].veils)
+        self.master.tokens[1].set_position(3, 3)
+        self.assertEqual(self.methods(), ['patch'])
+
+    def test_revealed_history(self, load):
+        self.connect()
+        token = self.master.tokens[1]
+        token.set_position(1, 1)
+        self.master.pages[0].toggle_veil(1, 0)
+        # Covered again, and moved in the fog.
+        self.master.pages[0].toggle_veil(1, 0)
+        token.set_position(1.5, 1.5)
+        token.set_position(0.5, 0.5)
+        batches = [message for message, _ in self.master.changes_since(0)
+                   if message['method'] == 'patch_batch']
+        self.assertEqual(
+            list(batches[0]['params']['patches'][0]['set']['position']),
+            [1, 1])
+
+    def test_snapshot(self, load):
+        self.connect()
+        self.master.tokens[1].set_position(1, 1)
+        self.master_server.received(
+            {'method': 'sync', 'params': {'since': None}}, PLAYER)
+        self.master_server.dispatch_event(
+            'on_api_request', {'method': 'sync', 'params': {'since': None}},
+            PLAYER)
+        snapshot = self.master_server.outbox[-1]
+        self.assertEqual(snapshot['method'], 'state_snapshot')
+        self.assertEqual(
+            [t['id'] for t in snapshot['params']['pages'][0]['tokens']], [3])
+
+    def test_served_data(self, load):
+        self.connect()
+        controller = self.controllers[0]
+        self.master.tokens[1].set_position(1, 1)
+        self.master.tokens[3].set_position(1, 1)
+        tokens = {t['id']: t for t in
+                  controller.served_data()['pages'][0]['tokens']}
+        # The joining players see the hidden token where it vanished.
+        self.assertEqual(tokens[1]['position'], [0, 0])
+        self.assertEqual(list(tokens[3]['position']), [1, 1])
+
+        self.master.pages[0].toggle_veil(1, 0)
+        tokens = {t['id']: t for t in
+                  controller.served_data()['pages'][0]['tokens']}
+        self.assertEqual(list(tokens[1]['position']), [1, 1])
+
+
+
+@patch('pyglet.image.load')
+class RelayTest(ControllerTestCase):
+    def hi(self, server, params, address):
+        request = {'method': 'hi', 'params': params}
+        server.received(request, address)
+        server.dispatch_event('on_api_request', request, address)
+
+    def test_spectator(self, load):
+        self.connect()
+        self.controllers[0].relays.master_slots = 0
+        self.handshake(self.master_server, self.player_server, PLAYER,
+                       {'player': 'Aengus', 'relay': 2})
+        self.master.tokens[1].set_position(1, 1)
+        self.to_player()
+
+        spectator = Campaign(test_campaign.FakeProvider(self.data))
+        spectator_server = LinkedApiServer(MASTER)
+        self.controllers.append(
+            Controller(State(spectator, 'Watcher'), spectator_server))
+        self.hi(self.master_server, {'player': 'Watcher', 'spectator': True},
+                SPECTATOR)
+        self.assertEqual(self.master_server.outbox, [{
+            'method': 'relay_parent', 'params': {'parent': list(PLAYER)}
+        }])
+        self.master_server.deliver(spectator_server, MASTER)
+        self.assertEqual(spectator_server.master, PLAYER)
+        # The master doesn't send the changes to the moved spectator.
+        self.master.tokens[1].set_position(2, 2)
+        self.assertEqual(len(self.master_server.outbox), 1)
+
+        # The relay has kept the changes that the spectator has missed.
+        self.hi(self.player_server, {'player': 'Watcher', 'spectator': True},
+                SPECTATOR)
+        self.player_server.deliver(spectator_server, PLAYER)
+        self.assertEqual(spectator_server.outbox[-1]['method'], 'sync')
+        spectator_server.deliver(self.player_server, SPECTATOR)
+        self.player_server.deliver(spectator_server, PLAYER)
+        self.assertEqual(spectator.tokens[1].position, [1, 1])
+        self.to_player()
+        self.player_server.deliver(spectator_server, PLAYER)
+        self.assertEqual(spectator.tokens[1].position, [2, 2])
+        self.assertEqual(spectator.version, self.master.version)
+
+        # The spectators can't change anything through the relay.
+        spectator.tokens[1].set_position(5, 5)
+        spectator_server.deliver(self.player_server, SPECTATOR)
+        self.assertEqual(self.player_server.sessions.get(SPECTATOR).dropped,
+                         1)
+        self.assertEqual(self.player_server.outbox, [])
+
+        # Only the relays above a spectator can report that it has left.
+        OTHER = ('::1', 2218)
+        self.hi(self.master_server, {'player': 'Mallory', 'relay': 1000},
+                OTHER)
+        self.assertEqual(self.controllers[0].relays._nodes['Mallory'].capacity,
+                         relay.RELAY_FANOUT)
+        self.master_server.dispatch_event('on_api_request', {
+            'method': 'relay_left', 'params': {'player': 'Watcher'}
+        }, OTHER)
+        self.assertIn('Watcher', self.controllers[0].relays)
+        self.assertEqual(self.master_server.sessions.get(OTHER).dropped, 1)
+
+        self.controllers[1].on_session_closed(
+            self.player_server.sessions.get(SPECTATOR))
+        self.to_master()
+        self.assertNotIn('Watcher', self.controllers[0].relays)
+
+
+if __name__ == '__main__':
+    unittest.main()
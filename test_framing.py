@@ -0,0 +1,94 @@
+import os
+import unittest
+import zlib
+
+import framing
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class CompressionTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = b'{"veils":[' + b'{"covered":true},' * 100 + b']}'
+        compressed = framing.compress(data)
+        self.assertEqual(compressed[0], framing.COMPRESSED)
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(framing.decompress(compressed), data)
+
+    def test_small_and_incompressible(self):
+        self.assertEqual(framing.compress(b'{}'), b'{}')
+        data = os.urandom(1000)
+        self.assertEqual(framing.compress(data), data)
+        self.assertEqual(framing.decompress(data), data)
+
+    def test_too_large(self):
+        bomb = bytes([framing.COMPRESSED]) + zlib.compress(
+            b'0' * (framing.MAX_MESSAGE_SIZE + 1))
+        with self.assertRaises(framing.FrameError):
+            framing.decompress(bomb)
+        with self.assertRaises(framing.FrameError):
+            framing.decompress(bytes([framing.COMPRESSED]) + b'garbage')
+
+
+class ReassemblerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.reassembler = framing.Reassembler(clock=self.clock)
+        self.data = bytes(i % 251 for i in range(5000))
+        self.fragments = framing.fragment(self.data)
+
+    def test_small(self):
+        self.assertEqual(framing.fragment(b'{}'), [b'{}'])
+        self.assertEqual(self.reassembler.receive('a', b'{}'), b'{}')
+
+    def test_out_of_order(self):
+        self.assertEqual(len(self.fragments), 5)
+        for data in self.fragments:
+            self.assertLessEqual(len(data), framing.MAX_DATAGRAM)
+        for data in reversed(self.fragments[1:]):
+            self.assertIsNone(self.reassembler.receive('a', data))
+        # Fragments from another peer are kept apart.
+        self.assertIsNone(self.reassembler.receive('b', self.fragments[0]))
+        self.assertEqual(
+            self.reassembler.receive('a', self.fragments[0]), self.data)
+        self.assertEqual(self.reassembler.reassembled, 1)
+
+    def test_retransmission(self):
+        # The first transmission loses a fragment, the second one fills it.
+        for data in self.fragments[:-1]:
+            self.assertIsNone(self.reassembler.receive('a', data))
+        self.assertIsNone(self.reassembler.receive('a', self.fragments[0]))
+        self.assertEqual(
+            self.reassembler.receive('a', self.fragments[-1]), self.data)
+        # A retransmission after the acknowledgement was lost.
+        self.assertEqual(
+            self.reassembler.receive('a', self.fragments[0]), self.data)
+        self.assertIsNone(self.reassembler.receive('a', self.fragments[1]))
+
+    def test_timeout(self):
+        self.reassembler.receive('a', self.fragments[0])
+        self.assertEqual(self.reassembler.pending, 1)
+        self.clock.now += framing.REASSEMBLY_TIMEOUT + 1
+        self.reassembler.expire()
+        self.assertEqual(self.reassembler.pending, 0)
+        self.assertEqual(self.reassembler.failed, 1)
+
+    def test_corrupt(self):
+        corrupt = self.fragments[1][:-1] + b'x'
+        for data in [self.fragments[0], corrupt] + self.fragments[2:-1]:
+            self.reassembler.receive('a', data)
+        with self.assertRaises(framing.FrameError):
+            self.reassembler.receive('a', self.fragments[-1])
+        with self.assertRaises(framing.FrameError):
+            self.reassembler.receive('a', self.fragments[0][:4])
+        self.assertEqual(self.reassembler.failed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+from unittest.mock import Mock
+
+import movement
+from movement import MotionTrack, MovementChannel
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class MovementChannelTest(unittest.TestCase):
+    def setUp(self):
+        self.send = Mock()
+        self.clock = FakeClock()
+        self.channel = MovementChannel(self.send, rate=20, clock=self.clock)
+
+    def tearDown(self):
+        self.channel.close()
+
+    def test_coalesce(self):
+        self.channel.push(1, (0, 0))
+        self.channel.push(1, (1, 1))
+        self.channel.push(2, (5, 5))
+        self.send.assert_not_called()
+        self.channel.flush()
+        self.assertEqual(self.send.call_count, 2)
+        sent = {c[0][0]['params']['token_id']: c[0][0]['params']['position']
+                for c in self.send.call_args_list}
+        self.assertEqual(sent, {1: (1, 1), 2: (5, 5)})
+
+        self.send.reset_mock()
+        self.channel.flush()
+        self.send.assert_not_called()
+
+    def test_commit_drops_pending(self):
+        self.channel.push(1, (0, 0))
+        self.channel.push(2, (5, 5))
+        self.channel.commit(1)
+        self.channel.flush()
+        self.send.assert_called_once_with({
+            'method': 'token_temp_position_changed',
+            'params': {'token_id': 2, 'position': (5, 5), 't': 100000}
+        }, 2)
+
+    def test_relayed_timestamp(self):
+        self.channel.push(1, (0, 0), t=7)
+        self.channel.flush()
+        self.assertEqual(self.send.call_args[0][0]['params']['t'], 7)
+
+
+class MotionTrackTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.track = MotionTrack(self.clock)
+
+    def add(self, x, t, delay=0.02):
+        """Adds a sample sent at `t` ms that arrives after `delay`."""
+        self.clock.now = 100 + t / 1000 + delay
+        self.track.add(x, 0, t)
+
+    def at(self, t):
+        """Returns the x rendered at the sender time `t` ms."""
+        self.clock.now = (100 + t / 1000 + 0.02 +
+                          movement.INTERPOLATION_DELAY)
+        return self.track.position()[0]
+
+    def test_interpolation(self):
+        self.assertIsNone(self.track.position())
+        for t in range(0, 301, 100):
+            self.add(t / 100, t)
+        self.assertAlmostEqual(self.at(-50), 0)
+        self.assertAlmostEqual(self.at(50), 0.5)
+        self.assertAlmostEqual(self.at(125), 1.25)
+        self.assertAlmostEqual(self.at(300), 3)
+
+    def test_extrapolation(self):
+        self.add(0, 0)
+        self.add(1, 100)
+        self.assertAlmostEqual(self.at(150), 1.5)
+        self.assertAlmostEqual(self.at(200), 2)
+        # Returns to the last sample if no more samples come.
+        self.assertAlmostEqual(self.at(250), 1.5)
+        self.assertAlmostEqual(self.at(400), 1)
+
+    def test_clock_offset(self):
+        # The fastest sample defines the offset of the clocks.
+        self.add(0, 0, delay=0.05)
+        self.add(1, 100, delay=0.02)
+        self.add(2, 200, delay=0.04)
+        self.assertAlmostEqual(self.at(150), 1.5)
+
+    def test_reordering(self):
+        self.add(0, 0)
+        self.add(2, 200)
+        self.add(1, 100)
+        self.assertAlmostEqual(self.at(100), 1)
+
+    def test_wraparound(self):
+        self.add(0, 2**32 - 100)
+        self.add(1, 0)
+        self.clock.now = self.track._offset + (
+            (2**32 - 50) / 1000 + movement.INTERPOLATION_DELAY)
+        self.assertAlmostEqual(self.track.position()[0], 0.5)
+
+    def test_timeout(self):
+        self.add(0, 0)
+        self.add(1, 100)
+        self.add(5, 100 + 1000 * (movement.TRACK_TIMEOUT + 1))
+        self.assertEqual(len(self.track._samples), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+
+import netsim
+import simulate
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+
+    def is_closing(self):
+        return False
+
+
+class FakeLoop(object):
+    def __init__(self):
+        self.now = 0.0
+        self.scheduled = []
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback, *args):
+        self.scheduled.append((self.now + delay, callback, args))
+
+    def run(self):
+        for _, callback, args in sorted(self.scheduled, key=lambda s: s[0]):
+            callback(*args)
+        self.scheduled = []
+
+
+class ImpairedTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.loop = FakeLoop()
+
+    def impaired(self, **kwargs):
+        return netsim.ImpairedTransport(
+            self.transport, self.loop, netsim.Impairment(seed=1, **kwargs))
+
+    def test_no_impairment(self):
+        impaired = self.impaired()
+        impaired.sendto(b'a', 'addr')
+        self.assertEqual(self.transport.sent, [(b'a', 'addr')])
+        self.assertEqual(self.loop.scheduled, [])
+
+    def test_loss(self):
+        impaired = self.impaired(loss=1)
+        impaired.sendto(b'a', 'addr')
+        self.assertEqual(self.transport.sent, [])
+        self.assertEqual(impaired.dropped, 1)
+
+    def test_duplicate(self):
+        impaired = self.impaired(duplicate=1)
+        impaired.sendto(b'a', 'addr')
+        self.assertEqual(self.transport.sent, [(b'a', 'addr')] * 2)
+
+    def test_delay_and_jitter(self):
+        impaired = self.impaired(delay=0.1, jitter=0.05)
+        for i in range(10):
+            impaired.sendto(bytes([i]), 'addr')
+        self.assertEqual(self.transport.sent, [])
+        for at, _, _ in self.loop.scheduled:
+            self.assertTrue(0.1 <= at <= 0.15)
+        self.loop.run()
+        self.assertEqual(len(self.transport.sent), 10)
+
+    def test_reorder(self):
+        impaired = self.impaired(reorder=1)
+        impaired.sendto(b'a', 'addr')
+        self.assertEqual(self.loop.scheduled[0][0], netsim.REORDER_DELAY)
+
+    def test_bandwidth(self):
+        impaired = self.impaired(bandwidth=1000)
+        for _ in range(3):
+            impaired.sendto(b'x' * 100, 'addr')
+        self.assertEqual([round(s[0], 6) for s in self.loop.scheduled],
+                         [0.1, 0.2, 0.3])
+        # The queue is full.
+        for _ in range(20):
+            impaired.sendto(b'x' * 100, 'addr')
+        self.assertEqual(impaired.dropped, 12)
+
+    def test_lossless(self):
+        impaired = netsim.ImpairedTransport(
+            self.transport, self.loop,
+            netsim.Impairment(loss=1, duplicate=1, reorder=1, jitter=0.05,
+                              delay=0.1, bandwidth=1000, seed=1),
+            lossless=True)
+        for i in range(20):
+            impaired.sendto(bytes([i]) * 100, 'addr')
+        self.loop.run()
+        self.assertEqual([data[0] for data, _ in self.transport.sent],
+                         list(range(20)))
+        self.assertEqual(impaired.dropped, 0)
+
+    def test_parse(self):
+        impairment = netsim.Impairment.parse('loss=0.1, delay=0.05,seed=3')
+        self.assertEqual(impairment.loss, 0.1)
+        self.assertEqual(impairment.delay, 0.05)
+        self.assertEqual(impairment.seed, 3)
+        self.assertIsNone(impairment.bandwidth)
+        with self.assertRaises(ValueError):
+            netsim.Impairment.parse('latency=1')
+
+
+class SimulationTest(unittest.TestCase):
+    def test_converges_with_loss(self):
+        impairment = netsim.Impairment(loss=0.1, delay=0.01, duplicate=0.05,
+                                       reorder=0.05)
+        result = simulate.simulate(players=2, changes=20,
+                                   impairment=impairment)
+        self.assertTrue(result['converged'])
+        self.assertEqual(result['version'], 20)
+        self.assertGreater(result['impaired_dropped'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+from relay import RelayTree
+
+
+class RelayTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = RelayTree(master_slots=1)
+        self.tree.add_player('El', ('::1', 1), capacity=2)
+        self.tree.add_player('Aengus', ('::1', 2), capacity=1)
+
+    def test_placement(self):
+        self.assertIsNone(self.tree.place('s1', ('::1', 11), capacity=2))
+        # The least loaded relay on the shallowest level.
+        self.assertEqual(self.tree.place('s2', ('::1', 12)), ('::1', 1))
+        self.assertEqual(self.tree.place('s3', ('::1', 13)), ('::1', 2))
+        self.assertEqual(self.tree.place('s4', ('::1', 14)), ('::1', 11))
+        self.assertEqual(self.tree.place('s5', ('::1', 15)), ('::1', 1))
+        self.assertEqual(self.tree.place('s6', ('::1', 16)), ('::1', 11))
+        self.assertEqual(self.tree.depth('s6'), 1)
+        # No room left: the master takes it.
+        self.assertIsNone(self.tree.place('s7', ('::1', 17)))
+        self.assertEqual(self.tree.master_spectators(), 2)
+
+    def test_relay_lost(self):
+        self.tree.master_slots = 0
+        self.tree.place('s1', ('::1', 11), capacity=1)
+        self.tree.place('s2', ('::1', 12), capacity=1)
+        self.tree.place('s3', ('::1', 13), capacity=1)
+        self.tree.place('s4', ('::1', 14), capacity=1)
+        self.assertEqual(self.tree.parent('s4'), 's1')
+        self.assertEqual(self.tree.leave('El'), ['s1', 's3'])
+        self.assertEqual(self.tree.parent('s4'), 's1')
+
+        # The orphans join again with their subtrees, never below
+        # themselves.
+        self.assertEqual(self.tree.place('s1', ('::1', 11), capacity=1),
+                         ('::1', 12))
+        self.assertEqual(self.tree.depth('s4'), 3)
+        self.assertEqual(self.tree.ancestors('s4'), ['s1', 's2', 'Aengus'])
+        self.assertEqual(self.tree.place('s3', ('::1', 13), capacity=1),
+                         ('::1', 14))
+
+    def test_disable(self):
+        self.tree.master_slots = 0
+        self.tree.disable('El')
+        self.assertEqual(self.tree.place('s1', ('::1', 11)), ('::1', 2))
+        self.assertIsNone(self.tree.place('s2', ('::1', 12)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import json
+import unittest
+
+from reliable import ReliablePeer, INITIAL_RTO, MAX_RETRANSMITS
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def chat(i):
+    return {'method': 'new_chat', 'params': {'message': {'text': str(i)}}}
+
+
+class ReliablePeerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sender = ReliablePeer(clock=self.clock)
+        self.receiver = ReliablePeer(clock=self.clock)
+
+    def transfer(self, data, to):
+        return to.receive(json.loads(data))
+
+    def test_in_order(self):
+        for i in range(3):
+            message = self.sender.prepare(chat(i), json.dumps)
+            self.assertEqual(self.transfer(message, self.receiver), [chat(i)])
+        self.assertEqual(self.sender.in_flight, 3)
+
+        self.clock.now += 0.1
+        ack, = self.receiver.due(json.dumps)
+        self.assertEqual(json.loads(ack), {'method': 'ack', 'ack': 3})
+        self.assertEqual(self.transfer(ack, self.sender), [])
+        self.assertEqual(self.sender.in_flight, 0)
+        self.assertAlmostEqual(self.sender.srtt, 0.1)
+        self.assertEqual(self.receiver.due(json.dumps), [])
+
+    def test_reorder_and_duplicates(self):
+        messages = [self.sender.prepare(chat(i), json.dumps) for i in range(3)]
+        self.assertEqual(self.transfer(messages[2], self.receiver), [])
+        self.assertEqual(self.transfer(messages[0], self.receiver), [chat(0)])
+        self.assertEqual(self.transfer(messages[0], self.receiver), [])
+        self.assertEqual(self.receiver.duplicates, 1)
+
+        ack, = self.receiver.due(json.dumps)
+        self.assertEqual(json.loads(ack),
+                         {'method': 'ack', 'ack': 1, 'sack': [3]})
+        self.transfer(ack, self.sender)
+        self.assertEqual(self.sender.in_flight, 1)
+
+        self.clock.now += INITIAL_RTO
+        retransmitted, = self.sender.due(json.dumps)
+        self.assertEqual(json.loads(retransmitted)['seq'], 2)
+        self.assertEqual(self.transfer(retransmitted, self.receiver),
+                         [chat(1), chat(2)])
+
+    def test_unreliable(self):
+        message = {
+            'method': 'token_temp_position_changed',
+            'params': {'token_id': 1, 'position': [0, 0]}
+        }
+        data = self.sender.prepare(message, json.dumps)
+        self.assertEqual(json.loads(data), message)
+        self.assertEqual(self.sender.in_flight, 0)
+        self.assertEqual(self.transfer(data, self.receiver), [message])
+        self.assertEqual(self.receiver.due(json.dumps), [])
+
+    def test_give_up(self):
+        self.sender.prepare(chat(0), json.dumps)
+        for _ in range(MAX_RETRANSMITS + 1):
+            self.clock.now += 10
+            self.sender.due(json.dumps)
+        self.assertEqual(self.sender.in_flight, 0)
+        self.assertEqual(self.sender.lost, 1)
+        self.assertTrue(self.sender.failed)
+        self.assertEqual(self.sender.retransmits, MAX_RETRANSMITS)
+
+    def test_no_retransmit(self):
+        sender = ReliablePeer(clock=self.clock, retransmit=False)
+        for i in range(3):
+            message = sender.prepare(chat(i), json.dumps)
+            self.assertEqual(self.transfer(message, self.receiver), [chat(i)])
+        self.assertEqual(sender.in_flight, 0)
+        self.clock.now += 10
+        self.assertEqual(sender.due(json.dumps), [])
+        self.assertFalse(sender.failed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+import gzip
+import http.client
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from assetcache import AssetCache
+import netloop
+import resserver
+import seer
+
+
+class FakeCampaign(object):
+    def __init__(self):
+        self._data = {'fragments': {'map': {'path': 'large.jpg'},
+                                    'token': {'path': 'small.png'}},
+                      'version': 1}
+        self.lock = threading.RLock()
+
+    @property
+    def version(self):
+        return self._data['version']
+
+
+class ResourceServerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.files = {
+            'small.png': os.urandom(1000),
+            'tiles.png': bytes(10000),
+            'large.jpg': os.urandom(16 * 1024 * 1024),
+        }
+        for name, data in self.files.items():
+            with open(os.path.join(self.dir.name, name), 'wb') as file:
+                file.write(data)
+        self.campaign = FakeCampaign()
+        self.net = netloop.NetworkLoop()
+        self.server = resserver.ResourceServer(self.dir.name, self.campaign,
+                                               self.net, port=0)
+        self.connections = []
+
+    def tearDown(self):
+        for connection in self.connections:
+            connection.close()
+        self.server.shutdown()
+        self.net.stop()
+        self.net.join()
+        self.dir.cleanup()
+
+    def connect(self):
+        connection = http.client.HTTPConnection('::1', self.server.port,
+                                                timeout=5)
+        self.connections.append(connection)
+        return connection
+
+    def get(self, connection, path, headers={}):
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_keep_alive(self):
+        connection = self.connect()
+        response, data = self.get(connection, '/small.png')
+        self.assertEqual(data, self.files['small.png'])
+        self.assertEqual(response.getheader('Connection'), 'keep-alive')
+        sock = connection.sock
+        response, _ = self.get(connection, '/missing.png')
+        self.assertEqual(response.status, 404)
+        response, data = self.get(connection, '/small.png')
+        self.assertEqual(data, self.files['small.png'])
+        self.assertIs(connection.sock, sock)
+
+        response, _ = self.get(connection, '/small.png',
+                               {'Connection': 'close'})
+        self.assertEqual(response.getheader('Connection'), 'close')
+        self.assertIsNone(connection.sock)
+
+    def test_long_header(self):
+        connection = self.connect()
+        response, _ = self.get(connection, '/small.png',
+                               {'X-Long': 'x' * 100000})
+        self.assertEqual(response.status, 431)
+
+    def test_shutdown_with_open_connection(self):
+        connection = socket.create_connection(('::1', self.server.port))
+        self.connections.append(connection)
+        for _ in range(100):
+            if self.server._tasks:
+                break
+            time.sleep(0.01)
+        task, = self.server._tasks
+        self.server.shutdown()
+        for _ in range(100):
+            if task.done():
+                break
+            time.sleep(0.01)
+        self.assertTrue(task.done())
+        connection.settimeout(5)
+        self.assertEqual(connection.recv(1), b'')
+
+    def test_concurrent(self):
+        # A player that downloads a large map slowly doesn't hold up the
+        # others.
+        slow = self.connect()
+        slow.request('GET', '/large.jpg')
+        response = slow.getresponse()
+        response.read(1000)
+        start = time.monotonic()
+        _, data = self.get(self.connect(), '/small.png')
+        self.assertEqual(data, self.files['small.png'])
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(response.read(), self.files['large.jpg'][1000:])
+
+    def test_etag(self):
+        connection = self.connect()
+        response, _ = self.get(connection, '/small.png')
+        etag = response.getheader('ETag')
+        response, data = self.get(connection, '/small.png',
+                                  {'If-None-Match': 'W/"x", ' + etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(data, b'')
+
+        with open(os.path.join(self.dir.name, 'small.png'), 'wb') as file:
+            file.write(b'changed')
+        response, data = self.get(connection, '/small.png',
+                                  {'If-None-Match': etag})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(data, b'changed')
+
+    def test_cached_join(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for _ in range(2):
+                provider = seer.RemoteResourceProvider(
+                    '::1', self.server.port, AssetCache(cache_dir))
+                with provider.open('small.png') as file:
+                    self.assertEqual(file.read(), self.files['small.png'])
+                provider.session.close()
+            self.assertEqual(provider.cache.hits, 1)
+            self.assertEqual(provider.cache.size(), 1000)
+
+    def test_prefetch(self):
+        with open(os.path.join(self.dir.name, 'data.json'), 'w') as file:
+            json.dump(self.campaign._data, file)
+        connection = self.connect()
+        _, data = self.get(connection, '/manifest')
+        self.assertEqual(json.loads(data)['assets']['small.png']['size'],
+                         1000)
+        self.assertNotIn('data.json', json.loads(data)['assets'])
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # The master's address is written differently the second time.
+            for address in ('::1', '0:0:0:0:0:0:0:1'):
+                provider = seer.RemoteResourceProvider(
+                    address, self.server.port, AssetCache(cache_dir))
+                provider.prefetch()
+                provider.session.close()
+                self.assertEqual(provider._prefetched['small.png'],
+                                 self.files['small.png'])
+            # Only data.json and the manifest are requested again.
+            self.assertEqual(provider.cache.hits, 2)
+        self.server.shutdown()
+        with provider.open('large.jpg') as file:
+            self.assertEqual(file.read(), self.files['large.jpg'])
+
+    def test_gzip(self):
+        connection = self.connect()
+        response, data = self.get(connection, '/tiles.png',
+                                  {'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(gzip.decompress(data), self.files['tiles.png'])
+        # Either ETag revalidates the content.
+        response, _ = self.get(connection, '/tiles.png', {
+            'If-None-Match': response.getheader('ETag')})
+        self.assertEqual(response.status, 304)
+
+        for encoding in ('identity', 'gzip;q=0'):
+            response, data = self.get(connection, '/tiles.png',
+                                      {'Accept-Encoding': encoding})
+            self.assertIsNone(response.getheader('Content-Encoding'))
+            self.assertEqual(data, self.files['tiles.png'])
+        # Not worth compressing.
+        response, data = self.get(connection, '/small.png',
+                                  {'Accept-Encoding': 'gzip'})
+        self.assertIsNone(response.getheader('Content-Encoding'))
+        self.assertEqual(data, self.files['small.png'])
+
+        # Large enough to be worth compressing.
+        self.campaign._data = {'notes': 'x' * 1000, 'version': 2}
+        for _ in range(300):
+            response, data = self.get(connection, '/data.json',
+                                      {'Accept-Encoding': 'deflate, gzip'})
+            if response.getheader('Content-Encoding') == 'gzip':
+                break
+            time.sleep(0.01)
+        self.assertEqual(json.loads(gzip.decompress(data)),
+                         self.campaign._data)
+
+        provider = seer.RemoteResourceProvider('::1', self.server.port)
+        with provider.open('tiles.png') as file:
+            self.assertEqual(file.read(), self.files['tiles.png'])
+        provider.session.close()
+
+    def test_data_snapshot(self):
+        connection = self.connect()
+        _, data = self.get(connection, '/data.json')
+        self.assertEqual(json.loads(data), self.campaign._data)
+        self.campaign._data = {'version': 2}
+        # Refreshed within SNAPSHOT_INTERVAL.
+        for _ in range(300):
+            _, data = self.get(connection, '/data.json')
+            if json.loads(data)['version'] == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(json.loads(data), {'version': 2})
+
+    def test_snapshot_consistent(self):
+        with self.campaign.lock:
+            # A change that hasn't been recorded yet.
+            self.campaign._data = dict(self.campaign._data, chat=['Hi'])
+            future = self.server._executor.submit(self.server._serialize)
+            time.sleep(0.05)
+            self.campaign._data['version'] = 2
+        snapshot = future.result(timeout=5)
+        self.assertEqual(snapshot.version, 2)
+        self.assertEqual(json.loads(snapshot.data)['version'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+import sendqueue
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class SendQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.queue = sendqueue.SendQueue(clock=self.clock)
+
+    def drain(self):
+        methods = []
+        while True:
+            item = self.queue.pop()
+            if item is None:
+                return methods
+            methods.append(item.method)
+
+    def test_priorities(self):
+        self.queue.push('token_temp_position_changed', b'', key=1)
+        self.queue.push('new_chat', b'')
+        self.queue.push('update_token', b'')
+        self.queue.push('page_changed', b'')
+        self.queue.push('some_future_method', b'')
+        self.assertEqual(len(self.queue), 5)
+        self.assertEqual(self.drain(), [
+            'page_changed', 'update_token', 'some_future_method', 'new_chat',
+            'token_temp_position_changed'])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_versioned_order(self):
+        self.queue.push('new_chat', b'1', versioned=True)
+        self.queue.push('player_chat', b'')
+        self.queue.push('update_token', b'2', versioned=True)
+        self.queue.push('page_changed', b'3', versioned=True)
+        self.queue.push('hi_ack', b'')
+        # The page change can't overtake the earlier changes, but the
+        # messages that are not versioned can.
+        self.assertEqual(self.drain(), [
+            'new_chat', 'update_token', 'page_changed', 'hi_ack',
+            'player_chat'])
+
+    def test_previews(self):
+        for i in range(3):
+            self.queue.push('token_temp_position_changed', bytes([i]), key=1)
+        self.queue.push('token_temp_position_changed', b'a', key=2)
+        self.assertEqual(self.queue.coalesced, 2)
+        self.assertEqual(self.queue.pop().data, b'\x02')
+        self.clock.now += sendqueue.PREVIEW_MAX_AGE * 2
+        self.assertIsNone(self.queue.pop())
+        self.assertEqual(self.queue.dropped, 1)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_pacing(self):
+        clock = FakeClock()
+        bucket = sendqueue.TokenBucket(rate=1000, burst=100, clock=clock)
+        self.assertTrue(bucket.ready())
+        bucket.consume(300)
+        self.assertFalse(bucket.ready())
+        self.assertAlmostEqual(bucket.wait(), 0.201)
+        clock.now += 0.201
+        self.assertTrue(bucket.ready())
+        # Unused tokens don't accumulate beyond the burst.
+        clock.now += 10
+        bucket.consume(150)
+        self.assertFalse(bucket.ready())
+
+    def test_unlimited(self):
+        bucket = sendqueue.TokenBucket(rate=None)
+        bucket.consume(10 ** 9)
+        self.assertTrue(bucket.ready())
+        self.assertEqual(bucket.wait(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
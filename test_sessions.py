@@ -0,0 +1,64 @@
+import unittest
+
+import sessions
+from sessions import SessionTable, SESSION_TIMEOUT
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SessionTableTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.table = SessionTable(clock=self.clock)
+
+    def test_reconnect(self):
+        old = self.table.connect('El', ('::1', 1), 'a')
+        new = self.table.connect('El', ('::1', 2), 'b')
+        self.assertEqual(list(self.table), [new])
+        self.assertIsNone(self.table.get(('::1', 1)))
+        self.assertIs(self.table.get_player('El'), new)
+        # Closing the replaced session doesn't affect the new one.
+        self.table.close(old)
+        self.assertEqual(len(self.table), 1)
+
+    def test_address_reused(self):
+        self.table.connect('El', ('::1', 1))
+        aengus = self.table.connect('Aengus', ('::1', 1))
+        self.assertEqual(list(self.table), [aengus])
+
+    def test_evict(self):
+        el = self.table.connect('El', ('::1', 1))
+        aengus = self.table.connect('Aengus', ('::1', 2))
+        self.clock.now = SESSION_TIMEOUT / 2
+        aengus.received(100)
+        self.clock.now = SESSION_TIMEOUT + 1
+        self.assertEqual(self.table.evict_expired(), [el])
+        self.assertEqual(list(self.table), [aengus])
+        self.assertEqual(aengus.stats()['bytes_in'], 100)
+
+
+class RateLimitTest(unittest.TestCase):
+    def test_allow(self):
+        clock = FakeClock()
+        session = sessions.Session('El', ('::1', 1), clock=clock)
+        rate, burst = sessions.RATE_LIMITS['player_chat']
+        for _ in range(burst):
+            self.assertTrue(session.allow('player_chat'))
+        self.assertFalse(session.allow('player_chat'))
+        # The limits are separate for every method.
+        self.assertTrue(session.allow('update_token'))
+        for _ in range(1000):
+            self.assertTrue(session.allow('ping'))
+        clock.now += 1 / rate
+        self.assertTrue(session.allow('player_chat'))
+        self.assertFalse(session.allow('player_chat'))
+
+
+if __name__ == '__main__':
+    unittest.main()
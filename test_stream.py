@@ -0,0 +1,136 @@
+import os
+import struct
+import time
+import unittest
+
+import apiserver
+import netloop
+import sessions
+import stream
+
+
+def frame(data):
+    return struct.pack('<I', len(data)) + data
+
+
+class FrameReaderTest(unittest.TestCase):
+    def test_split(self):
+        reader = stream.FrameReader()
+        data = frame(b'hello') + frame(b'') + frame(b'world')
+        self.assertEqual(reader.feed(data[:3]), [])
+        self.assertEqual(reader.feed(data[3:13]), [b'hello', b''])
+        self.assertEqual(reader.feed(data[13:]), [b'world'])
+        self.assertEqual(reader.feed(b''), [])
+
+    def test_too_large(self):
+        reader = stream.FrameReader()
+        with self.assertRaises(stream.StreamError):
+            reader.feed(struct.pack('<I', stream.MAX_FRAME + 1))
+
+
+class StreamApiServerTest(unittest.TestCase):
+    def setUp(self):
+        self.net = netloop.NetworkLoop()
+        self.master = apiserver.ApiServer(self.net, port=0)
+        port = self.master.transport.get_extra_info('sockname')[1]
+        self.player = apiserver.ApiServer(self.net, ('::1', port),
+                                          port=0, use_stream=True)
+        # Another player over UDP.
+        self.udp_player = apiserver.ApiServer(self.net, ('::1', port),
+                                              port=0)
+        self.received = {self.master: [], self.player: [],
+                         self.udp_player: []}
+        for server in self.received:
+            server.push_handlers(
+                on_api_request=lambda request, address, server=server:
+                self.received[server].append(request))
+
+    def tearDown(self):
+        self.udp_player.shutdown()
+        self.player.shutdown()
+        self.master.shutdown()
+        self.net.stop()
+        self.net.join()
+
+    def wait(self, server, method):
+        for _ in range(200):
+            server.drain()
+            if any(r['method'] == method for r in self.received[server]):
+                return
+            time.sleep(0.01)
+        self.fail('Timed out waiting for ' + method)
+
+    def test_round_trip(self):
+        self.player.connect('El')
+        self.wait(self.master, 'hi')
+        address = self.master.sessions.get_player('El').address
+        self.master.send({'method': 'hi_ack', 'params': {'wire': 1}},
+                         address)
+        self.master.set_wire_version(address, 1)
+        self.wait(self.player, 'hi_ack')
+        self.player.set_wire_version(self.player.master, 1)
+
+        # Large messages are not fragmented.
+        text = os.urandom(10000).hex()
+        for i in range(3):
+            self.master.notify({'method': 'page_snapshot',
+                                'params': {'text': text}})
+        self.player.notify({'method': 'player_chat',
+                            'params': {'message': {'text': 'Hi'}}})
+        self.wait(self.master, 'player_chat')
+        self.wait(self.player, 'page_snapshot')
+        for _ in range(200):
+            self.player.drain()
+            if len(self.received[self.player]) == 4:
+                break
+            time.sleep(0.01)
+        self.assertEqual(
+            [r['params']['text'] for r in self.received[self.player][1:]],
+            [text] * 3)
+        self.assertEqual(self.master.framing_stats()['fragments_sent'], 0)
+        stats = self.master.stream_transport.stats()
+        self.assertLessEqual(stats['writes'], stats['frames_written'])
+        # Nothing is retransmitted over the stream.
+        session = self.master.sessions.get(address)
+        self.assertTrue(session.stream)
+        self.assertEqual(session.peer.retransmits, 0)
+
+    def test_both_transports(self):
+        self.player.connect('El')
+        self.udp_player.connect('Aengus')
+        self.wait(self.master, 'hi')
+        for _ in range(200):
+            if self.master.sessions.get_player('Aengus') is not None:
+                break
+            time.sleep(0.01)
+        self.assertTrue(self.master.sessions.get_player('El').stream)
+        self.assertFalse(self.master.sessions.get_player('Aengus').stream)
+        self.master.notify({'method': 'player_chat',
+                            'params': {'message': {'text': 'Hi'}}})
+        self.wait(self.player, 'player_chat')
+        self.wait(self.udp_player, 'player_chat')
+
+    def test_throttled_messages_wait(self):
+        self.player.connect('El')
+        self.wait(self.master, 'hi')
+        # Two more than the burst of the rate limit.
+        count = sessions.RATE_LIMITS['player_chat'][1] + 2
+        for i in range(count):
+            self.player.send({'method': 'player_chat',
+                              'params': {'message': {'text': str(i)}}})
+        for _ in range(300):
+            self.master.drain()
+            chats = [r['params']['message']['text']
+                     for r in self.received[self.master]
+                     if r['method'] == 'player_chat']
+            if len(chats) == count:
+                break
+            time.sleep(0.01)
+        # Delivered in order once the rate limit allows.
+        self.assertEqual(chats, [str(i) for i in range(count)])
+        session = self.master.sessions.get_player('El')
+        self.assertGreater(session.throttled, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+
+import wire
+
+
+class WireTest(unittest.TestCase):
+    MESSAGES = [
+        {'method': 'hi', 'id': 1, 'params': {'player': 'El', 'wire': [1, 0]}},
+        {'method': 'update_token',
+         'params': {'token': {'id': 2, 'character': 'pc-el',
+                              'position': [1.5, 2]}}},
+        {'method': 'new_chat',
+         'params': {'message': {'player': None, 'text': 'Привет'}}},
+        {'method': 'some_future_method', 'params': {}},
+    ]
+
+    def test_roundtrip(self):
+        for version in wire.VERSIONS:
+            for message in self.MESSAGES:
+                self.assertEqual(
+                    wire.decode(wire.encode(message, version)), message)
+
+    def test_temp_position(self):
+        message = {
+            'method': 'token_temp_position_changed',
+            'params': {'token_id': 3, 'position': [1.25, -7.5]}
+        }
+        encoded = wire.encode(message, wire.BINARY_V1)
+        self.assertEqual(len(encoded), 15)
+        self.assertEqual(wire.decode(encoded), message)
+
+        message['params']['t'] = 2**32 - 1
+        encoded = wire.encode(message, wire.BINARY_V1)
+        self.assertEqual(len(encoded), 19)
+        self.assertEqual(wire.decode(encoded), message)
+        del message['params']['t']
+
+        # String IDs don't fit the packed format, but still can be sent.
+        message['params']['token_id'] = 'goblin'
+        self.assertEqual(
+            wire.decode(wire.encode(message, wire.BINARY_V1)), message)
+
+    def test_add_fields(self):
+        fields = {'seq': 3, 'ack': 1, 'sack': [4]}
+        for version in wire.VERSIONS:
+            for message in self.MESSAGES + [{'method': 'ack'}]:
+                encoded = wire.add_fields(wire.encode(message, version),
+                                          fields)
+                self.assertEqual(wire.decode(encoded), dict(message, **fields))
+        packed = wire.encode({
+            'method': 'token_temp_position_changed',
+            'params': {'token_id': 3, 'position': [1, 2]}
+        }, wire.BINARY_V1)
+        self.assertEqual(wire.add_fields(packed, {}), packed)
+        with self.assertRaises(ValueError):
+            wire.add_fields(packed, fields)
+
+    def test_negotiate(self):
+        self.assertEqual(wire.negotiate([0, 1]), wire.BINARY_V1)
+        self.assertEqual(wire.negotiate([0, 17]), wire.JSON)
+        self.assertEqual(wire.negotiate([]), wire.JSON)
+
+    def test_malformed(self):
+        header = bytes([wire.MAGIC, wire.BINARY_V1,
+                        wire.METHODS.index('new_chat')])
+        for data in (b'', b'{"meth', bytes([wire.MAGIC, 99, 1]),
+                     bytes([wire.MAGIC, 1, 4, 0]), header + b'[]',
+                     header + b'1'):
+            with self.assertRaises(wire.DecodeError):
+                wire.decode(data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+"""Encoding of the API messages into datagrams.
+
+Two encodings are supported:
+
+* JSON, which is always understood and is used until the peers agree on
+  something better in the `hi` handshake.
+* Binary frames. Every frame starts with `MAGIC`, the version of the encoding
+  and a numeric method ID. Hot messages have a packed body, the rest carry
+  compact JSON with the method name stripped.
+
+`decode()` recognizes both encodings, so the receiving side doesn't need to
+know which one the sender has chosen.
+"""
+
+import json
+import struct
+
+JSON = 0
+BINARY_V1 = 1
+# Encodings supported by this version of the program, in the order of
+# preference.
+VERSIONS = (BINARY_V1, JSON)
+
+MAGIC = 0xb5
+_HEADER = struct.Struct('<BBB')
+_TEMP_POSITION = struct.Struct('<Iff')
+# With the timestamp of the sample in milliseconds.
+_TIMED_TEMP_POSITION = struct.Struct('<IffI')
+
+# Method IDs. New methods must be appended to keep the IDs stable. ID 0 is
+# reserved for the messages with methods unknown to this table.
+METHODS = (
+    None,
+    'hi',
+    'hi_ack',
+    'update_token',
+    'token_temp_position_changed',
+    'page_changed',
+    'veils_updated',
+    'player_chat',
+    'new_chat',
+    'veils_patch',
+    'veils_resync',
+    'ack',
+    'page_snapshot',
+    'ping',
+    'pong',
+    'reconnect',
+    'sync',
+    'state_snapshot',
+    'patch_rejected',
+    'patch',
+    'patch_batch',
+    'relay_parent',
+    'relay_left',
+)
+METHOD_IDS = {method: i for i, method in enumerate(METHODS) if method}
+_TEMP_POSITION_ID = METHOD_IDS['token_temp_position_changed']
+
+
+class DecodeError(Exception):
+    pass
+
+
+def negotiate(versions):
+    """Chooses the best encoding supported by both sides."""
+    for version in VERSIONS:
+        if version in versions:
+            return version
+    return JSON
+
+
+def _dump_json(data) -> bytes:
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def _encode_temp_position(message):
+    params = message.get('params')
+    if (len(message) != 2 or params is None or
+        len(params) != (3 if 't' in params else 2)):
+        return None
+    token_id = params.get('token_id')
+    position = params.get('position')
+    if (type(token_id) is not int or not 0 <= token_id < 2**32 or
+        position is None or len(position) != 2):
+        return None
+    if 't' not in params:
+        return _TEMP_POSITION.pack(token_id, position[0], position[1])
+    t = params['t']
+    if type(t) is not int or not 0 <= t < 2**32:
+        return None
+    return _TIMED_TEMP_POSITION.pack(token_id, position[0], position[1], t)
+
+
+def encode(message: dict, version=JSON) -> bytes:
+    if version == JSON:
+        return _dump_json(message)
+    assert version == BINARY_V1
+
+    method_id = METHOD_IDS.get(message['method'], 0)
+    header = _HEADER.pack(MAGIC, version, method_id)
+    if method_id == _TEMP_POSITION_ID:
+        body = _encode_temp_position(message)
+        if body is not None:
+            return header + body
+        # Doesn't fit into the packed format, send it as generic message.
+        header = _HEADER.pack(MAGIC, version, 0)
+        return header + _dump_json(message)
+    if method_id == 0:
+        return header + _dump_json(message)
+    rest = {k: v for k, v in message.items() if k != 'method'}
+    return header + _dump_json(rest)
+
+
+def add_fields(data: bytes, fields: dict) -> bytes:
+    """Adds top-level fields to an encoded message.
+
+    Used to attach the reliability fields to a message that was encoded in
+    advance. Doesn't work for the packed temporary positions, which are
+    never sent reliably.
+    """
+    if not fields:
+        return data
+    header = b''
+    body = data
+    if data[0] == MAGIC:
+        header = data[:_HEADER.size]
+        body = data[_HEADER.size:]
+        if header[2] == _TEMP_POSITION_ID:
+            raise ValueError("Packed messages can't have extra fields")
+    extra = _dump_json(fields)
+    if body == b'{}':
+        return header + extra
+    return header + body[:-1] + b',' + extra[1:]
+
+
+def decode(data: bytes) -> dict:
+    try:
+        if not data or data[0] != MAGIC:
+            return json.loads(data)
+        magic, version, method_id = _HEADER.unpack_from(data)
+        if version != BINARY_V1:
+            raise DecodeError(
+                'Unsupported encoding version {}'.format(version))
+        body = data[_HEADER.size:]
+        if method_id == 0:
+            return json.loads(body)
+        if method_id >= len(METHODS):
+            raise DecodeError('Unknown method ID {}'.format(method_id))
+        method = METHODS[method_id]
+        if method_id == _TEMP_POSITION_ID:
+            # The two packed formats differ in length.
+            if len(body) == _TIMED_TEMP_POSITION.size:
+                token_id, x, y, t = _TIMED_TEMP_POSITION.unpack(body)
+                params = {'token_id': token_id, 'position': [x, y], 't': t}
+            else:
+                token_id, x, y = _TEMP_POSITION.unpack(body)
+                params = {'token_id': token_id, 'position': [x, y]}
+            return {'method': method, 'params': params}
+        message = json.loads(body)
+        if type(message) is not dict:
+            raise DecodeError('The body of {} is not an object'.format(
+                method))
+        message['method'] = method
+        return message
+    except (ValueError, struct.error) as e:
+        raise DecodeError(str(e)) from e